@@ -0,0 +1,187 @@
+""" Packing of output trees into tar archives, for devices that are far
+    quicker to copy one big file to than thousands of small ones """
+
+import os
+import pickle
+import tarfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+from clint.textui import puts
+
+from metrics import METRICS
+from output import OutputTree
+from signature import Signature
+from util.data import parse_size
+
+
+class OutputArchiver(object):
+  """ Write the files of an output tree into tar archives.  The tree itself is
+      built as normal, so keeps its signatures and incremental updates; it is
+      the copy the archives are made from.  A state file at the root of the
+      tree records what has been archived, so a delta archive need only hold
+      files added or changed since the last one, plus a list of those deleted.
+      Archives may be split into chunks of at most `max_size` bytes, bar any
+      single file bigger than that.  """
+
+  STATE_FILE_NAME = '.bulklift-archive.pickle'
+
+  # Member of a delta archive listing files deleted since the last one
+  DELETED_NAME = '.bulklift-deleted'
+
+  # Bump this whenever the format of the state changes
+  VERSION = 1
+
+  # Names never archived
+  SKIP_NAMES = frozenset(
+    OutputTree.PROTECTED_NAMES + (Signature.SIGNATURE_FILE_NAME, STATE_FILE_NAME)
+  )
+
+  def __init__(self, root_path, archive_dir, name, max_size=None):
+    """ Initialize the archiver to pack the tree at `root_path` into archives
+        in `archive_dir` whose names start with `name` """
+    super(OutputArchiver, self).__init__()
+    self.root_path = Path(root_path)
+    self.archive_dir = Path(archive_dir)
+    self.name = name
+    self.max_size = parse_size(max_size)
+    self.state_path = self.root_path / self.STATE_FILE_NAME
+
+  def scan(self):
+    """ Return a dict of path relative to the root -> (size, mtime_ns) for
+        every file in the tree """
+    files = {}
+    stack = [('', str(self.root_path))]
+    while stack:
+      rel_dir, abs_dir = stack.pop()
+      with os.scandir(abs_dir) as it:
+        for entry in it:
+          if entry.name in self.SKIP_NAMES or entry.is_symlink():
+            continue
+          rel = rel_dir + entry.name
+          if entry.is_dir():
+            stack.append((rel + '/', entry.path))
+          else:
+            st = entry.stat()
+            files[rel] = (st.st_size, st.st_mtime_ns)
+    return files
+
+  def loadState(self):
+    """ Return the files recorded as archived last time, or an empty dict """
+    try:
+      with self.state_path.open('rb') as stream:
+        version, files = pickle.load(stream)
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+      return {}
+    return files if version == self.VERSION else {}
+
+  def saveState(self, files):
+    """ Record `files` as archived.  The file is replaced atomically.  """
+    tmp_path = self.state_path.with_name(self.state_path.name + '.tmp')
+    with tmp_path.open('wb') as stream:
+      pickle.dump((self.VERSION, files), stream, pickle.HIGHEST_PROTOCOL)
+    os.replace(str(tmp_path), str(self.state_path))
+
+  def changes(self, files, full=False):
+    """ Return a tuple of (sorted list of paths to archive, sorted list of
+        paths deleted) given the `files` now in the tree """
+    if full:
+      return (sorted(files), [])
+    previous = self.loadState()
+    changed = [p for p, fp in files.items() if previous.get(p) != fp]
+    return (sorted(changed), sorted(set(previous) - set(files)))
+
+  def archivePaths(self, kind, stamp):
+    """ Yield the paths of successive chunks of an archive of `kind`, never
+        those of an existing archive """
+    n = 1
+    while True:
+      path = self.archive_dir / '{}-{}-{}-{:03d}.tar'.format(
+        self.name, stamp, kind, n
+      )
+      if not path.exists():
+        yield path
+      n += 1
+
+  @staticmethod
+  def memberSize(size):
+    """ Return the space a file of `size` bytes takes in a tar, allowing for
+        a pax header for long names """
+    return 3 * tarfile.BLOCKSIZE + -(-size // tarfile.BLOCKSIZE) \
+           * tarfile.BLOCKSIZE
+
+  @staticmethod
+  def closedSize(offset):
+    """ Return the size of a tar with `offset` bytes of members once closed,
+        which adds two empty blocks and pads it to a whole record """
+    return -(-(offset + 2 * tarfile.BLOCKSIZE) // tarfile.RECORDSIZE) \
+           * tarfile.RECORDSIZE
+
+  def write(self, full=False, verbose=True):
+    """ Archive the tree, or just what has changed since the last archive
+        unless `full`.  Returns a list of the archives written.  State is only
+        saved once they are all complete.  """
+    files = self.scan()
+    changed, deleted = self.changes(files, full=full)
+    if not changed and not deleted:
+      if verbose:
+        puts("Nothing new to archive")
+      return []
+    self.archive_dir.mkdir(parents=True, exist_ok=True)
+    kind = 'full' if full or not self.state_path.exists() else 'delta'
+    paths = self.archivePaths(kind, time.strftime('%Y%m%d-%H%M%S'))
+    written = []
+    tar = None
+    try:
+      for rel in changed:
+        size = files[rel][0]
+        if tar is None or (
+          self.max_size is not None and tar.offset > 0 and
+          self.closedSize(tar.offset + self.memberSize(size)) > self.max_size
+        ):
+          if tar is not None:
+            tar.close()
+          written.append(next(paths))
+          tar = tarfile.open(str(self.tmpPath(written[-1])), 'w')
+          if deleted and len(written) == 1:
+            self.addDeleted(tar, deleted)
+        tar.add(str(self.root_path / rel), arcname=rel, recursive=False)
+        METRICS.inc('archive_bytes_written_total', size, output=self.name)
+      if tar is None:   # only deletions
+        written.append(next(paths))
+        tar = tarfile.open(str(self.tmpPath(written[-1])), 'w')
+        self.addDeleted(tar, deleted)
+      tar.close()
+    except BaseException:
+      if tar is not None:
+        tar.close()
+      for path in written:
+        try:
+          self.tmpPath(path).unlink()
+        except FileNotFoundError:
+          pass
+      raise
+    for path in written:
+      os.replace(str(self.tmpPath(path)), str(path))
+      if verbose:
+        puts("Wrote {}".format(path))
+    self.saveState(files)
+    if verbose:
+      puts("Archived {} files and {} deletions in {} archive(s)".format(
+        len(changed), len(deleted), len(written)
+      ))
+    return written
+
+  @staticmethod
+  def tmpPath(path):
+    """ Return the path an archive is written to before it is complete """
+    return path.with_name('.' + path.name + '.tmp')
+
+  def addDeleted(self, tar, deleted):
+    """ Add a member to `tar` listing the paths in `deleted` """
+    data = ''.join(p + '\n' for p in deleted).encode('utf8')
+    info = tarfile.TarInfo(self.DELETED_NAME)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, BytesIO(data))
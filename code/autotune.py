@@ -0,0 +1,174 @@
+""" Benchmarking of transcoding settings, to find the fastest mix of parallel
+    jobs and ffmpeg threads for this host """
+
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from clint.textui import puts
+
+from handlers import FORMAT_HANDLERS
+from probe import probe_file
+from scheduler import JobScheduler
+from wrappers import FFmpegWrapper, SoxWrapper
+from util.data import available_cpu_count, yaml_load, yaml_dump
+from util.file import AUDIO_FORMATS_LOSSLESS
+
+
+def library_sample(root, files=8, seed=None):
+  """ Return up to `files` lossless sources picked at random from the tree at
+      `root`, skipping hidden dirs as the walk for transcoding does """
+  found = []
+  for dirpath, dirnames, filenames in os.walk(str(root)):
+    dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+    found += [
+      Path(dirpath) / n for n in filenames
+      if not n.startswith('.')
+      and n.rsplit('.', 1)[-1].lower() in AUDIO_FORMATS_LOSSLESS
+    ]
+  found.sort()
+  return random.Random(seed).sample(found, min(files, len(found)))
+
+
+def synthetic_sample(dest_dir, files=8, duration=60):
+  """ Write `files` flac files of `duration` seconds to `dest_dir` and return
+      their paths """
+  paths = []
+  for n in range(files):
+    path = Path(dest_dir) / 'autotune-{:02d}.flac'.format(n)
+    SoxWrapper(output_path=path, duration=duration).run()
+    paths.append(path)
+  return paths
+
+
+def powers_of_two(limit):
+  """ Return 1, 2, 4... up to and including `limit`, which is always present """
+  values = []
+  n = 1
+  while n < limit:
+    values.append(n)
+    n *= 2
+  return values + [limit]
+
+
+def candidates(cpus, outputs=1):
+  """ Return a list of (jobs, ffmpeg threads, split_outputs) settings worth
+      trying on a host with `cpus` cores.  ffmpeg threads of None leaves ffmpeg
+      to choose.  Modes of splitting are only tried with several outputs.  """
+  modes = JobScheduler.SPLIT_MODES if outputs > 1 else ('tail',)
+  combos = []
+  for jobs in powers_of_two(cpus):
+    for ffmpeg_threads in [None] + powers_of_two(max(1, cpus // jobs)):
+      for mode in modes:
+        combos.append((jobs, ffmpeg_threads, mode))
+  return combos
+
+
+class Autotuner(object):
+  """ Time transcodes of a sample of sources to the formats of a set of
+      outputs, under different settings, as a real run would do them """
+
+  def __init__(self, sources, oconfs, ffmpeg_binary=None, priority=None,
+               repeat=1):
+    """ Initialize the tuner to transcode `sources` to the primary format of
+        each ManifestOutput in `oconfs`.  Each setting is timed `repeat` times
+        and the fastest kept.  """
+    super(Autotuner, self).__init__()
+    self.sources = sources
+    self.oconfs = oconfs
+    self.ffmpeg_binary = ffmpeg_binary
+    self.priority = priority
+    self.repeat = repeat
+    self.audio_seconds = sum(
+      (probe_file(p).duration or 0) for p in sources
+    ) * len(oconfs)
+
+  def jobs(self, out_dir, ffmpeg_threads):
+    """ Return a list of FFmpegWrappers transcoding our sample into
+        `out_dir`.  Outputs are prefixed with their source's index in the
+        sample, since sources from different albums may share a name.  """
+    jobs = []
+    for n, source in enumerate(self.sources):
+      ffmpeg = FFmpegWrapper(
+        source_path=source, binary=self.ffmpeg_binary,
+        priority=self.priority, threads=ffmpeg_threads
+      )
+      for oconf in self.oconfs:
+        dest = out_dir / oconf['name']
+        dest.mkdir(exist_ok=True)
+        handler = FORMAT_HANDLERS[oconf['formats'][0]](source, dest, oconf)
+        handler.output_path = dest / '{:02d}-{}'.format(n, handler.output_name)
+        handler.addToFFmpeg(ffmpeg)
+      jobs.append(ffmpeg)
+    return jobs
+
+  def time(self, jobs, ffmpeg_threads, split_outputs):
+    """ Return the fastest wall-clock seconds taken to transcode our sample
+        with the given settings """
+    best = None
+    for n in range(self.repeat):
+      with tempfile.TemporaryDirectory(prefix='bulklift-autotune-') as out_dir:
+        scheduler = JobScheduler(jobs, split_outputs=split_outputs)
+        for job in self.jobs(Path(out_dir), ffmpeg_threads):
+          scheduler.add(job)
+        start = time.monotonic()
+        scheduler.run(lambda j: j.run())
+        elapsed = time.monotonic() - start
+      if scheduler.failures:
+        job, e, io = scheduler.failures[0]
+        raise e
+      best = elapsed if best is None else min(best, elapsed)
+    return best
+
+  def run(self, settings, verbose=True):
+    """ Time each of `settings`, a list of (jobs, ffmpeg threads,
+        split_outputs), and return a list of (seconds, settings), fastest
+        first """
+    results = []
+    for n, (jobs, ffmpeg_threads, split_outputs) in enumerate(settings, 1):
+      seconds = self.time(jobs, ffmpeg_threads, split_outputs)
+      results.append((seconds, (jobs, ffmpeg_threads, split_outputs)))
+      if verbose:
+        puts("[{}/{}] jobs={} ffmpeg_threads={} split_outputs={}: {:.2f}s{}".format(
+          n, len(settings), jobs, ffmpeg_threads or 'auto', split_outputs,
+          seconds, self.speedText(seconds)
+        ))
+    results.sort(key=lambda r: r[0])
+    return results
+
+  def speedText(self, seconds):
+    """ Return a description of the speed achieved in `seconds` """
+    if not self.audio_seconds or not seconds:
+      return ''
+    return " ({:.0f}x realtime)".format(self.audio_seconds / seconds)
+
+
+def write_host_config(path, jobs, ffmpeg_threads, split_outputs):
+  """ Save transcoding settings to the host config at `path`, keeping anything
+      else already in it.  The file is replaced atomically.  """
+  path = Path(path)
+  try:
+    with path.open('r') as stream:
+      data = yaml_load(stream) or {}
+  except FileNotFoundError:
+    data = {}
+  tc = data.setdefault('config', {}).setdefault('transcoding', {})
+  tc['threads'] = jobs
+  tc['ffmpeg_threads'] = ffmpeg_threads
+  tc['split_outputs'] = split_outputs
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = path.with_name('.' + path.name + '.tmp')
+  with tmp_path.open('w') as stream:
+    stream.write("# Written by `bulklift autotune`\n")
+    yaml_dump(data, stream, default_flow_style=False)
+  os.replace(str(tmp_path), str(path))
+
+
+def host_cpus(priority=None):
+  """ Return the number of cores transcoding may use, given the
+      ProcessPriority `priority` might pin it to some """
+  if priority is not None and priority.cpus is not None:
+    return len(priority.cpus)
+  return available_cpu_count()
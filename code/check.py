@@ -0,0 +1,167 @@
+""" Validation of every manifest in a source tree, without transcoding """
+
+import os
+import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from manifest import Manifest, ManifestError
+from input import bake_metadata
+from output import album_path
+from handlers import FORMAT_HANDLERS
+from scheduler import JobScheduler
+from prefetch import Prefetcher
+from util.data import parse_size
+from util.file import AUDIO_FORMATS
+from util.sanitize import FILENAME_SANITIZERS
+
+
+# Number of dirs handed to a worker process at a time
+CHUNK_SIZE = 64
+
+RE_OPUS_BITRATE = re.compile(r'^([0-9]+(?:\.[0-9]+)?)([kK]?)$')
+
+R128GAIN_TYPES = (None, False, 'null', 'album', 'track')
+R128GAIN_MODES = ('r128gain', 'cache')
+
+
+def find_manifest_dirs(root):
+  """ Yield every dir below and including `root` that has a manifest, skipping
+      hidden dirs as the walk for transcoding does """
+  for dirpath, dirnames, filenames in os.walk(str(root)):
+    dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+    if Manifest.MANIFEST_FILE_NAME in filenames:
+      yield Path(dirpath)
+
+
+def check_config(mconf):
+  """ Return a list of problems with ManifestConfig `mconf` """
+  problems = []
+  tc = mconf['transcoding']
+  if tc['split_outputs'] not in JobScheduler.SPLIT_MODES:
+    problems.append("unknown transcoding.split_outputs '{}'".format(
+      tc['split_outputs']
+    ))
+  if tc['prefetch']['mode'] not in Prefetcher.MODES:
+    problems.append("unknown transcoding.prefetch.mode '{}'".format(
+      tc['prefetch']['mode']
+    ))
+  try:
+    mconf.process_priority
+  except ManifestError as e:
+    problems.append(str(e))
+  rg = mconf['r128gain']
+  if rg['type'] not in R128GAIN_TYPES:
+    problems.append("unknown r128gain.type '{}'".format(rg['type']))
+  if rg['mode'] not in R128GAIN_MODES:
+    problems.append("unknown r128gain.mode '{}'".format(rg['mode']))
+  return problems
+
+
+def check_output(oconf):
+  """ Return a list of problems with ManifestOutput `oconf` """
+  problems = []
+  name = oconf['name']
+  formats = oconf['formats']
+  if not formats:
+    problems.append("output '{}' has no formats".format(name))
+  elif formats[0] not in FORMAT_HANDLERS:
+    problems.append("output '{}' can't transcode to '{}'; choose from: {}".format(
+      name, formats[0], ', '.join(FORMAT_HANDLERS)
+    ))
+  for f in formats[1:]:
+    if f not in AUDIO_FORMATS:
+      problems.append("output '{}' accepts unknown format '{}'".format(name, f))
+  if oconf['sanitize_paths'] not in FILENAME_SANITIZERS:
+    problems.append("output '{}' has unknown sanitize_paths '{}'".format(
+      name, oconf['sanitize_paths']
+    ))
+  m = RE_OPUS_BITRATE.match(str(oconf['opus_bitrate']))
+  kbps = None if m is None else float(m.group(1)) / (1 if m.group(2) else 1000)
+  if kbps is None or not 6 <= kbps <= 510:   # libopus' limits
+    problems.append("output '{}' has invalid opus_bitrate '{}'".format(
+      name, oconf['opus_bitrate']
+    ))
+  if oconf['lame_vbr'] not in range(0, 10):
+    problems.append("output '{}' has invalid lame_vbr '{}'; use 0-9".format(
+      name, oconf['lame_vbr']
+    ))
+  try:
+    oconf.archive_path
+    parse_size(oconf['archive']['max_size'])
+  except (ManifestError, ValueError) as e:
+    problems.append(str(e))
+  if oconf['aac_vbr'] not in range(1, 6):
+    problems.append("output '{}' has invalid aac_vbr '{}'; use 1-5".format(
+      name, oconf['aac_vbr']
+    ))
+  return problems
+
+
+def check_dir(path):
+  """ Check the manifest for dir `path`, merged with its parents.  Returns a
+      tuple of (list of problems, list of (output name, album path) for the
+      albums it would transcode).  Runs in a worker process.  """
+  try:
+    manifest = Manifest.fromDir(path)
+  except ManifestError as e:
+    return ([str(e)], [])
+  except (KeyError, TypeError, ValueError, AttributeError) as e:
+    return (["malformed manifest ({}: {})".format(type(e).__name__, e)], [])
+  outputs = manifest.outputs_enabled
+  if not outputs:
+    return ([], [])
+  problems = check_config(manifest['config'])
+  metadata = manifest['metadata']
+  missing = [
+    k for k in Manifest.METADATA_REQUIRED if metadata.get(k) in (None, '')
+  ]
+  if missing:
+    problems.append("missing metadata: {}".format(', '.join(missing)))
+  try:
+    bake_metadata(
+      path, metadata, manifest['config']['transcoding']['rewrite_metadata']
+    )
+  except ManifestError as e:
+    problems.append(str(e))
+  albums = []
+  for oconf in outputs:
+    output_problems = check_output(oconf)
+    problems += output_problems
+    if output_problems or missing:
+      continue
+    try:
+      albums.append(
+        (oconf['name'], str(album_path(manifest['config'], oconf, metadata)))
+      )
+    except ManifestError as e:
+      problems.append(str(e))
+  return (problems, albums)
+
+
+def check_tree(root, workers=None):
+  """ Check every manifest in the tree at `root` over a pool of `workers`
+      processes.  Returns a tuple of (number of manifests checked, dict of
+      path -> list of problems).  Albums from different dirs that would be
+      written to the same output dir are reported as problems too.  """
+  dirs = list(find_manifest_dirs(Path(root).resolve()))
+  problems = {}
+  destinations = defaultdict(list)    # (output, album path) -> source dirs
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    results = pool.map(check_dir, dirs, chunksize=CHUNK_SIZE)
+    for path, (dir_problems, albums) in zip(dirs, results):
+      if dir_problems:
+        problems[path] = dir_problems
+      for dest in albums:
+        destinations[dest].append(path)
+  for (output_name, dest), sources in destinations.items():
+    if len(sources) > 1:
+      for path in sources:
+        problems.setdefault(path, []).append(
+          "output '{}' album dir {} is shared with: {}".format(
+            output_name, dest,
+            ', '.join(str(p) for p in sources if p != path)
+          )
+        )
+  return (len(dirs), problems)
@@ -1,39 +1,105 @@
 import os.path
 from pathlib import Path
 import shutil
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from clint.textui import indent, puts, colored
 
 from manifest import Manifest, MetadataError
 from wrappers import FFmpegWrapper, NothingToDoError
-from output import OutputAlbum
+from output import OutputAlbum, album_path
+from scheduler import JobScheduler, JobsInterrupted
+from prefetch import Prefetcher
+from probe import ProbeIndex
+from quarantine import Quarantine, failure_reason, is_source_failure
+from metrics import METRICS
+from util.data import parse_size
+from util.file import DirSnapshot, AUDIO_FORMATS
 
 
 class TranscodingError(Exception):
   "Failure within a transcoding job"
 
 
+def bake_metadata(path, metadata, rewrites):
+  """ Return the metadata rewrites for the album at `path`, interpolating
+      `metadata` into each template in `rewrites` """
+  none_to_str = lambda s: '' if s is None else s
+  metadata = {k : none_to_str(v) for k, v in metadata.items()}
+  rewritten = {}   # dict comprehension would prevent raising meaningful err
+  for k, tpl in rewrites.items():
+    if tpl is not None:
+      try:
+        rewritten[k] = tpl.format(**metadata)
+      except KeyError:
+        raise MetadataError(
+          "{}: a metadata field required by template '{}' is missing".format(
+            path, tpl
+          )
+        )
+  return rewritten
+
+
 class MediaSourceDir(object):
   """ A single directory within the media source tree, which may or may not be
       an album to transcode.  """
 
-  def __init__(self, path, debug=False):
-    """ Initialize the MediaSourceDir given its path  """
+  def __init__(self, path, debug=False, output=None):
+    """ Initialize the MediaSourceDir given its path.  If `output` is given
+        only the output of that name is considered.  """
     self.path = Path(path).resolve()  # resolve() is important - keep it!
-    self.manifest = Manifest.fromDir(path, debug=debug)
+    self.debug = debug
+    self.output = output
+    self.manifest = Manifest.fromDir(self.path, debug=debug)
 
   def walk(self):
     """ Recursively walk our tree, yielding a MediaSourceDir for every
         subdirectory we find.  """
     for p in self.path.iterdir():
       if p.is_dir() and not p.name.startswith('.'):
-        yield from self.__class__(p).walk()
+        yield from self.__class__(p, debug=self.debug, output=self.output).walk()
     if self.is_transcodable():
       yield self
 
+  def albums(self, shard=None, elsewhere=None):
+    """ Recursively walk our tree, yielding an InputAlbum for every
+        transcodable dir we find.  Given a Shard only albums belonging to it
+        are yielded; the output dirs of the rest are added to set
+        `elsewhere`, if given, so cleanup knows to keep them.  """
+    walker = self.walk()
+    while True:
+      with METRICS.phase('walk'):
+        msd = next(walker, None)
+      if msd is None:
+        return
+      if shard is not None and not shard.contains(msd.path.relative_to(self.path)):
+        if elsewhere is not None:
+          with METRICS.phase('plan'):
+            elsewhere.update(str(p) for p in msd.albumPaths())
+        METRICS.inc('albums_total', stage='other_shard')
+        continue
+      with METRICS.phase('plan'):
+        album = msd.album()
+      METRICS.inc('albums_total', stage='planned')
+      yield album
+
+  @property
+  def outputs_wanted(self):
+    """ Return the enabled output specs, limited to `output` if we have one """
+    return [
+      o for o in self.manifest.outputs_enabled
+      if self.output is None or o['name'] == self.output
+    ]
+
   def is_transcodable(self):
-    return self.manifest.exists() and len(self.manifest.outputs_enabled) > 0
+    return self.manifest.exists() and len(self.outputs_wanted) > 0
+
+  def albumPaths(self):
+    """ Return the paths of the output albums this dir would be transcoded
+        to, without planning any work """
+    return [
+      album_path(self.manifest['config'], oconf, self.manifest['metadata'])
+      for oconf in self.outputs_wanted
+    ]
 
   def album(self):
     """ Return an InputAlbum for this source dir or raise ValueError if it
@@ -42,7 +108,7 @@ class MediaSourceDir(object):
       raise ValueError("Only transcodable dirs can have an album")
     return InputAlbum(
       self.path,
-      mconf=self.manifest['config'], oconfs=self.manifest.outputs_enabled,
+      mconf=self.manifest['config'], oconfs=self.outputs_wanted,
       metadata=self.manifest['metadata']
     )
 
@@ -50,95 +116,269 @@ class MediaSourceDir(object):
 class InputAlbum(object):
   """ Represent a single dir of files we may transcode """
 
+  # A ProbeIndex shared by all albums
+  probe_index = None
+
+  # A Quarantine of failed sources shared by all albums
+  quarantine = None
+
   def __init__(self, path, mconf, oconfs, metadata):
     """ Initialize InputAlbum and setup its outputs.  `metadata` is straight
         from the manifest; replacements are applied here.   """
     self.path = path
+    self.snapshot = DirSnapshot(path)   # shared by all outputs' signatures
     self.mconf = mconf
     self.transcoding_threads = mconf['transcoding']['threads']
+    self.split_outputs = mconf['transcoding']['split_outputs']
     self.metadata_rewrites = self.bakeMetadata(
       metadata, mconf['transcoding']['rewrite_metadata']
     )
     self.output_albums = [
-      OutputAlbum(mconf, oconf, metadata) for oconf in oconfs if oconf['enabled']
+      OutputAlbum(mconf, oconf, metadata, source_snapshot=self.snapshot)
+      for oconf in oconfs if oconf['enabled']
     ]
+    self.failures = []      # (source path, reason, quarantined) for failed jobs
+    self.quarantined = []   # (source path, reason) for sources skipped
 
   def files(self):
     """ Return list of valid files in the source directory.  The sorting order
         is designed to process the larger files first, leaving smaller jobs to
         soak up empty cores at the end.  The middle element is moved to the top"""
-    candidates = list(filter(
-      lambda c: c.is_file() and not c.name.startswith('.'),
-      self.path.iterdir()
-    ))
-    candidates.sort(reverse=True, key=lambda c: c.stat().st_size)
+    names = [n for n in self.snapshot.files() if not n.startswith('.')]
+    names.sort(reverse=True, key=lambda n: self.snapshot.stat(n).st_size)
+    candidates = [self.path / n for n in names]
     if len(candidates) > 2:
       candidates.insert(1, candidates.pop(int(len(candidates) / 2)))
     return candidates
 
   def bakeMetadata(self, metadata, rewrites):
     """ Assemble the set of metadata rewrites """
-    none_to_str = lambda s: '' if s is None else s
-    metadata = {k : none_to_str(v) for k, v in metadata.items()}
-    rewritten = {}   # dict comprehension would prevent raising meaningful err
-    for k, tpl in rewrites.items():
-      if tpl is not None:
-        try:
-          rewritten[k] = tpl.format(**metadata)
-        except KeyError:
-          raise MetadataError(
-            "{}: a metadata field required by template '{}' is missing".format(
-              self.path, tpl
-            )
-          )
-    return rewritten
+    return bake_metadata(self.path, metadata, rewrites)
+
+  def probe(self, paths):
+    """ Return a dict of path -> ProbeResult (or None) for the audio files in
+        `paths`.  Empty if probing is disabled.  """
+    if not self.mconf['transcoding']['probe']:
+      return {}
+    if InputAlbum.probe_index is None:
+      InputAlbum.probe_index = ProbeIndex(load=False)
+    return InputAlbum.probe_index.probeAll(
+      [p for p in paths if p.suffix.lower().lstrip('.') in AUDIO_FORMATS],
+      threads=self.transcoding_threads, stat=self.snapshot.stat_path
+    )
+
+  def jobTimeout(self, job):
+    """ Return the seconds FFmpegWrapper `job` may run for before it is
+        killed, or None for no limit """
+    tconf = self.mconf['transcoding']['timeout']
+    if job.duration is None:
+      return tconf['unknown']
+    return tconf['base'] + tconf['per_second'] * job.duration * len(job)
 
   def _transcodeJobs(self):
     """ Return a list of FFmpegWrapper objects, one for each source file that
-        has work to do """
+        has work to do.  If every source's duration is known the costliest
+        jobs are put first.  Quarantined sources are skipped.  """
     ffmpeg_jobs = []
-    for potential in self.files():
+    candidates = self.files()
+    probes = self.probe(candidates)
+    for potential in candidates:
       # puts('potential: {}'.format(potential))
+      probe = probes.get(potential)
       ffmpeg = FFmpegWrapper(
         source_path=potential, metadata=self.metadata_rewrites,
-        binary=self.mconf['transcoding']['ffmpeg_path']
+        binary=self.mconf['transcoding']['ffmpeg_path'],
+        duration=probe.duration if probe else None,
+        priority=self.mconf.process_priority,
+        threads=self.mconf['transcoding']['ffmpeg_threads']
       )
       for oa in self.output_albums:
-        oa.incorporate(potential, ffmpeg)
-      if len(ffmpeg) > 0:  # outputs are expected
-        ffmpeg_jobs.append((oa, ffmpeg))
+        oa.incorporate(potential, ffmpeg, probe=probe)
+      if len(ffmpeg) == 0:  # no outputs are expected
+        continue
+      reason = self.quarantineReason(potential)
+      if reason is not None:
+        self.quarantined.append((potential, reason))
+        ffmpeg.abandon()
+        continue
+      ffmpeg.timeout = self.jobTimeout(ffmpeg)
+      ffmpeg_jobs.append(ffmpeg)
+    if all(j.duration is not None for j in ffmpeg_jobs):
+      ffmpeg_jobs.sort(reverse=True, key=lambda j: j.duration * len(j))
     return ffmpeg_jobs
 
-  def transcode(self, verbose=True):
-    """ Generate the desired output albums from this source """
+  def plan(self):
+    """ Return a list of FFmpegWrappers for the work pending on this album,
+        e.g. to export for another tool to run, split one per output if the
+        config always splits them.  Their outputs' signatures are left to
+        adopt().  """
+    with METRICS.phase('plan'):
+      jobs = self._transcodeJobs()
+    if self.split_outputs == 'always':
+      jobs = [s for j in jobs for s in j.split()]
+    return jobs
+
+  def adopt(self, since=None, verbose=True):
+    """ Sign the outputs of pending jobs that have been run by another tool,
+        e.g. from a plan written by plan(), and finalize the album.  Outputs
+        that are missing, or were last modified before timestamp `since`,
+        are left unsigned to be redone.  """
+    for job in self.plan():
+      for part in job.split():
+        targets = [part.destinations.get(p, p) for p in part.expected_outputs]
+        if all(
+          p.is_file() and (since is None or p.stat().st_mtime >= since)
+          for p in targets
+        ):
+          part.complete()
+        else:
+          if verbose:
+            puts(colored.yellow("Output of {} isn't in place; leaving it".format(
+              part.source_path.name
+            )))
+          part.abandon()
+    with METRICS.phase('finalize'):
+      for oa in self.output_albums:
+        if oa.dirty:
+          oa.prepare(verbose=False)   # in case nothing was written
+        oa.finalize(verbose=verbose)
+
+  def quarantineReason(self, path):
+    """ Return why source `path` is quarantined, or None if it isn't """
+    if InputAlbum.quarantine is None:
+      InputAlbum.quarantine = Quarantine(load=False)
+    return InputAlbum.quarantine.reason(path, self.snapshot.stat_path(path))
+
+  def fail(self, job, e, io=False):
+    """ Clean up after FFmpegWrapper `job` failed with exception `e`, raised
+        while moving or finishing its outputs if `io`.  Its outputs are
+        removed and left unsigned, so they're redone next run.  If ffmpeg
+        itself failed the source is quarantined until it changes; failures
+        writing to the output, e.g. a full or unplugged device, aren't the
+        source's fault.  """
+    reason = failure_reason(e)
+    quarantine = not io and is_source_failure(e, job.expected_outputs)
+    puts(colored.red("Failed to {} {}: {}".format(
+      'transcode' if quarantine else 'write output of',
+      job.source_path.name, reason
+    )))
+    # Final paths of staged outputs only hold this job's work if it got as
+    # far as moving them; otherwise they're still the last good copies
+    victims = list(job.expected_outputs)
+    if io:
+      victims += list(job.destinations.values())
+    for path in victims:
+      try:
+        path.unlink()
+      except OSError:   # perhaps the device has gone
+        pass
+    job.abandon()
+    for codec in job.output_codecs:
+      METRICS.inc('jobs_total', outcome='failed', codec=codec)
+    if quarantine:
+      InputAlbum.quarantine.add(job.source_path, reason)
+    self.failures.append((job.source_path, reason, quarantine))
+
+  def _prefetcher(self):
+    """ Return a Prefetcher configured from the manifest, or None if
+        prefetching is disabled """
+    pconf = self.mconf['transcoding']['prefetch']
+    if not pconf['jobs']:
+      return None
+    budget = pconf['disk'] if pconf['mode'] == 'copy' else pconf['memory']
+    return Prefetcher(
+      pconf['jobs'], mode=pconf['mode'], budget=parse_size(budget),
+      scratch_dir=pconf['scratch_dir']
+    )
+
+  def transcode(self, verbose=True, r128gain_batch=None, deadline=None):
+    """ Generate the desired output albums from this source.  r128gain may be
+        left to `r128gain_batch`, an R128gainBatch.  Given a Deadline, jobs
+        that won't finish before it are left for the next run; albums are
+        still finalized with whatever was done.  If none of them fit the
+        album is left alone entirely, without creating its output dirs.  """
+    started = []
     def do_job(j):
+      started.append(j)
       if verbose:
         puts("Transcoding {} ({})".format(
           j.source_path.name, '/'.join(j.output_codecs))
         )
         # puts("Args: {}".format(j.args))
       j.run()  # different process not connected to our stdout
-    jobs = self._transcodeJobs()
+      for codec in j.output_codecs:
+        METRICS.inc('jobs_total', outcome='ok', codec=codec)
+        if j.duration:
+          METRICS.inc('encoded_audio_seconds_total', j.duration, codec=codec)
+      if not j.destinations:
+        j.complete()
+    def unstage(j):
+      if verbose and j.destinations:
+        puts("Moving {} to output".format(j.source_path.name))
+      j.unstage()
+      j.complete()
+    with METRICS.phase('plan'):
+      jobs = self._transcodeJobs()
+    for path, reason in self.quarantined:
+      puts(colored.yellow("Skipping quarantined {} ({})".format(
+        path.name, reason
+      )))
+    if jobs and deadline is not None and not any(
+      deadline.allows(part) for j in jobs for part in j.split()
+    ):
+      deadline.missed = True
+      self.defer(jobs)
+      return
     if len(jobs):
       if verbose:
         puts("Transcoding new media...")
       with indent(2):
         for oa in self.output_albums:  # make dir before it gets used as output
           oa.prepare(verbose=verbose)
-        with ThreadPoolExecutor(max_workers=self.transcoding_threads) as pool:
-          futures = [pool.submit(do_job, ffmpeg) for oa, ffmpeg in jobs]
-          try:
-            pool.shutdown()
-          except KeyboardInterrupt as e:
-            for future in futures:
-              future.cancel()
-            # Re-raising the exception blows up threading.  Make new one.
-            raise TranscodingError("Keyboard interrupt; aborted transcoding")
+        prefetcher = self._prefetcher()
+        scheduler = JobScheduler(
+          self.transcoding_threads, split_outputs=self.split_outputs,
+          io_threads=self.mconf['transcoding']['io_threads'],
+          prefetcher=prefetcher, deadline=deadline,
+          retries=self.mconf['transcoding']['retries'],
+          backoff=self.mconf['transcoding']['retry_backoff']
+        )
+        for ffmpeg in jobs:
+          scheduler.add(ffmpeg)
+        staged = any(oa.staging_path for oa in self.output_albums)
+        try:
+          with METRICS.phase('encode'):
+            scheduler.run(do_job, io_func=unstage if staged else None)
+        except JobsInterrupted as e:
+          raise TranscodingError(str(e))
+        finally:
+          if prefetcher is not None:
+            prefetcher.shutdown()
+        for j, e, io in scheduler.failures:
+          self.fail(j, e, io=io)
+        if len(scheduler):
+          self.defer(scheduler.pending)
+        if not started:
+          return    # nothing was written, so nothing to finalize
     else:
       puts("Nothing new to transcode")
 
-    for oa in self.output_albums:
-      oa.finalize(verbose=verbose)
+    with METRICS.phase('finalize'):
+      for oa in self.output_albums:
+        oa.finalize(verbose=verbose, r128gain_batch=r128gain_batch)
+    METRICS.inc('albums_total', stage='transcoded')
+
+  def defer(self, jobs):
+    """ Leave FFmpegWrappers `jobs` unstarted and unsigned for the next run,
+        once we're out of time """
+    jobs = list(jobs)
+    puts(colored.yellow(
+      "Out of time; leaving {} jobs for the next run".format(len(jobs))
+    ))
+    for j in jobs:
+      j.abandon()
+      for codec in j.output_codecs:
+        METRICS.inc('jobs_total', outcome='deferred', codec=codec)
 
   def __str__(self):
     return "<{} {}>".format(self.__class__.__name__, self.path)
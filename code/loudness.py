@@ -0,0 +1,156 @@
+""" Loudness measurement of source files, cached between runs so that gain tags
+    for every output can be written without analysing any of them """
+
+import math
+import re
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import mutagen
+from mutagen.id3 import ID3, TXXX
+from mutagen.mp4 import MP4, MP4FreeForm
+from mutagen.oggopus import OggOpus
+
+from util.file import SourceFileCache
+from wrappers import LoudnessWrapper
+
+
+# Momentary loudness is binned to this many bins per LU
+HISTOGRAM_RESOLUTION = 10
+
+# EBU R128 gating thresholds
+ABSOLUTE_GATE = -70.0   # LUFS
+RELATIVE_GATE = -10.0   # LU below the absolutely-gated loudness
+
+# Reference loudness for replaygain tags, as used by r128gain
+REPLAYGAIN_REFERENCE = -18.0
+# Reference loudness for R128_*_GAIN tags in opus files (RFC 7845)
+OPUS_REFERENCE = -23.0
+
+RE_MOMENTARY = re.compile(r'\bM:\s*(-?[0-9.]+)')
+RE_PEAK = re.compile(r'^\s*Peak:\s*(-?[0-9.]+|-inf)\s*dBFS', re.MULTILINE)
+
+
+class TrackLoudness(namedtuple('TrackLoudness', ['histogram', 'peak'])):
+  """ Loudness of a single track.  `histogram` maps binned momentary loudness
+      to a count of the 400ms blocks at that level, which is all EBU R128
+      gating needs; histograms from several tracks can simply be added to get
+      album loudness.  `peak` is the linear sample peak.  """
+
+  __slots__ = ()
+
+  @property
+  def integrated(self):
+    """ Return the gated integrated loudness in LUFS, or None if silent """
+    return integrated_loudness([self])
+
+
+def mean_loudness(levels):
+  """ Return the loudness in LUFS of the mean energy of blocks in `levels`, a
+      list of (loudness, number of blocks) tuples """
+  blocks = sum(n for level, n in levels)
+  energy = sum(10 ** ((level + 0.691) / 10) * n for level, n in levels)
+  return -0.691 + 10 * math.log10(energy / blocks)
+
+
+def integrated_loudness(tracks):
+  """ Return the gated integrated loudness in LUFS of TrackLoudnesses `tracks`
+      taken together, or None if they are silent """
+  histogram = Counter()
+  for t in tracks:
+    histogram.update(t.histogram)
+  levels = [
+    (b / HISTOGRAM_RESOLUTION, n) for b, n in histogram.items()
+    if b / HISTOGRAM_RESOLUTION > ABSOLUTE_GATE
+  ]
+  if not levels:
+    return None
+  relative_gate = mean_loudness(levels) + RELATIVE_GATE
+  return mean_loudness([(l, n) for l, n in levels if l > relative_gate])
+
+
+def parse_ebur128(text):
+  """ Return a TrackLoudness parsed from the log of ffmpeg's ebur128 filter """
+  histogram = Counter(
+    int(round(float(m) * HISTOGRAM_RESOLUTION))
+    for m in RE_MOMENTARY.findall(text)
+  )
+  peaks = RE_PEAK.findall(text)
+  if not peaks or peaks[-1] == '-inf':
+    peak = 0.0
+  else:
+    peak = 10 ** (float(peaks[-1]) / 20)
+  return TrackLoudness(dict(histogram), peak)
+
+
+def write_gain_tags(path, track, album=None):
+  """ Write gain tags to the audio file at `path` from TrackLoudness `track`
+      and, optionally, `album`: a (loudness, peak) tuple for the whole album.
+      Opus files get R128_*_GAIN tags; everything else gets replaygain tags.
+      Returns False if the file's format isn't supported.  """
+  gains = [('TRACK', track.integrated, track.peak)]
+  if album is not None:
+    gains.append(('ALBUM', album[0], album[1]))
+  gains = [(kind, l, p) for kind, l, p in gains if l is not None]
+  f = mutagen.File(str(path))
+  if f is None:
+    return False
+  if isinstance(f, OggOpus):
+    for kind, loudness, peak in gains:
+      q78 = int(round((OPUS_REFERENCE - loudness) * 256))
+      f['R128_{}_GAIN'.format(kind)] = [str(max(-32768, min(32767, q78)))]
+    f.save()
+    return True
+  tags = {}
+  for kind, loudness, peak in gains:
+    tags['REPLAYGAIN_{}_GAIN'.format(kind)] = "{:.2f} dB".format(
+      REPLAYGAIN_REFERENCE - loudness
+    )
+    tags['REPLAYGAIN_{}_PEAK'.format(kind)] = "{:.6f}".format(peak)
+  if isinstance(f, MP4):
+    for k, v in tags.items():
+      f['----:com.apple.iTunes:' + k.lower()] = [MP4FreeForm(v.encode('utf8'))]
+  else:
+    if f.tags is None:
+      f.add_tags()
+    if isinstance(f.tags, ID3):
+      for k, v in tags.items():
+        f.tags.add(TXXX(encoding=3, desc=k, text=[v]))
+    else:   # vorbis comments, e.g. flac & ogg
+      for k, v in tags.items():
+        f[k] = [v]
+  f.save()
+  return True
+
+
+class LoudnessCache(SourceFileCache):
+  """ On-disk cache of the loudness of source files.  Sources are measured
+      once, however many outputs they feed, and only new or changed ones need
+      measuring on later runs.  """
+
+  CACHE_FILE_NAME = 'loudness.pickle'
+
+  def measure(self, source_path, ffmpeg_binary=None, priority=None):
+    """ Return the TrackLoudness of `source_path`, analysing it if need be
+        with ffmpeg run at ProcessPriority `priority` """
+    loudness = self.get(source_path)
+    if loudness is None:
+      fingerprint = self.fingerprint(source_path)   # before, in case it changes
+      loudness = parse_ebur128(
+        LoudnessWrapper(
+          source_path, binary=ffmpeg_binary, priority=priority
+        ).measure()
+      )
+      self.put(source_path, loudness, fingerprint)
+    return loudness
+
+  def measureAll(self, source_paths, threads=None, ffmpeg_binary=None,
+                 priority=None):
+    """ Return a list of TrackLoudnesses for `source_paths`, analysing any
+        we don't have over `threads` threads """
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+      return list(pool.map(
+        lambda p: self.measure(
+          p, ffmpeg_binary=ffmpeg_binary, priority=priority
+        ), source_paths
+      ))
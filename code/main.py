@@ -1,43 +1,349 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import datetime
 import sys
 from pathlib import Path
 import subprocess
 import os
 import shutil
-from itertools import chain
+import tempfile
 
 from clint.textui import puts, indent, colored
 
-from input import MediaSourceDir
-from output import OutputTree
-from manifest import Manifest
+from input import MediaSourceDir, InputAlbum
+from check import check_tree
+from plan import PLAN_EMITTERS
+from archive import OutputArchiver
+from autotune import Autotuner, library_sample, synthetic_sample, candidates, \
+  host_cpus, write_host_config
+from output import OutputTree, OutputTrash, OutputAlbum, R128gainBatch
+from loudness import LoudnessCache
+from probe import ProbeIndex
+from quarantine import Quarantine
+from manifest import Manifest, ManifestCache, ManifestError
+from scheduler import Deadline
+from shard import Shard
+from metrics import METRICS
+from profiling import PhaseProfiler
+from util.data import background_iter, parse_duration
 
 
 MIN_PYTHON_VERSION = (3,5,3)
 
+# Number of planned albums allowed to queue up waiting to be transcoded
+ALBUM_QUEUE_SIZE = 2
+
 
 
 def cmd_transcode(args):
   """ Find any outstanding transcoding jobs and action them """
+  tree_root = MediaSourceDir(
+    Path(args.source_tree_root[0]), debug=args.debug, output=args.output
+  )
+  output_names = [oconf['name'] for oconf in tree_root.manifest.outputs]
+  if args.output is not None and args.output not in output_names:
+    raise ValueError("No output named '{}'; choose from: {}".format(
+      args.output, ', '.join(output_names)
+    ))
+  # Given a dir below the root we only see part of the tree, so can't tell
+  # which output dirs are redundant
+  scoped = not tree_root.manifest['root']
+  if scoped:
+    puts("Transcoding only the subtree at {}".format(tree_root.path))
+  shard = run_shard(args)
+  # Only one shard cleans up the output trees, so no shard deletes albums
+  # another is still writing.  Other hosts may still be writing when it
+  # finishes, so permissions & archives are left to `bulklift permissions`
+  # and `bulklift archive` once every shard is done.
+  maintainer = shard is None or shard.index == args.clean_shard
+  if shard is not None:
+    puts("Transcoding shard {}{}".format(
+      shard, '; this shard cleans up' if maintainer else ''
+    ))
+  deadline = run_deadline(args)
+  if deadline is not None:
+    puts("Stopping work at {}".format(
+      datetime.datetime.fromtimestamp(deadline.at).strftime('%Y-%m-%d %H:%M')
+    ))
+  # Finish deleting anything trashed by a previous run while we work
+  trashes = {}
+  for oconf in tree_root.manifest.outputs:
+    if args.output is not None and oconf['name'] != args.output:
+      continue
+    if maintainer and oconf['trash']['enabled'] and Path(oconf['path']).is_dir():
+      trashes[oconf['name']] = OutputTrash(
+        oconf['path'], max_size=oconf['trash']['max_size']
+      )
+      trashes[oconf['name']].empty()
+  if args.retry_quarantined and InputAlbum.quarantine is not None:
+    InputAlbum.quarantine.release()
   puts("Walking media tree...")
-  tree_root = MediaSourceDir(Path(args.source_tree_root[0]), debug=args.debug)
-  input_albums = [msd.album() for msd in tree_root.walk() if msd.is_transcodable()]
-  for n, ia in enumerate(input_albums):
-    puts("{} ({} of {})".format(ia, n+1, len(input_albums)))
-    with indent(2):
-      ia.transcode()
-      puts()
-  if args.noclean:
+  # Albums are found & planned in the background while earlier ones encode.
+  # Only their output paths are kept, for cleanup, along with those of
+  # albums belonging to other shards.
+  expected_dirs = set()
+  failures = []
+  quarantined = 0
+  r128gain_batch = R128gainBatch()
+  # The walk must be finished with before its caches are saved
+  with contextlib.closing(background_iter(
+    tree_root.albums(shard=shard, elsewhere=expected_dirs),
+    maxsize=ALBUM_QUEUE_SIZE
+  )) as albums:
+    for n, ia in enumerate(albums, start=1):
+      if deadline is not None and deadline.passed:
+        deadline.missed = True    # this album at least is left over
+        break
+      puts("{} (album {})".format(ia, n))
+      METRICS.set(
+        'albums_pending', METRICS.get('albums_total', stage='planned') - n
+      )
+      with indent(2):
+        ia.transcode(r128gain_batch=r128gain_batch, deadline=deadline)
+        puts()
+      expected_dirs.update(str(oa.path) for oa in ia.output_albums)
+      failures += ia.failures
+      quarantined += len(ia.quarantined)
+  METRICS.set('albums_pending', 0)
+  if len(r128gain_batch):
+    with METRICS.phase('finalize'):
+      r128gain_batch.flush()
+  report_failures(failures, quarantined)
+  out_of_time = deadline is not None and deadline.missed
+  if out_of_time:
+    METRICS.set('deadline_reached', 1)
+    puts(colored.yellow(
+      "Out of time; the next run will continue with the remaining albums"
+    ))
+  if not maintainer:
+    puts("Skipping cleanup of output trees; left to another shard")
+    return
+  if out_of_time:
+    puts("Skipping cleanup of redundant targets; not every album was seen")
+  elif args.noclean:
     puts("Skipping cleanup of redundant targets")
+  elif scoped:
+    puts("Skipping cleanup of redundant targets; only a subtree was transcoded")
   else:
     for oconf in tree_root.manifest.outputs:
+      if args.output is not None and oconf['name'] != args.output:
+        continue
       puts("Cleaning up redundant dirs in output tree '{}'".format(oconf['name']))
-      otree = OutputTree(Path(oconf['path']))
-      with indent(2):
-        output_albums = list(chain.from_iterable([ia.output_albums for ia in input_albums]))
-        otree.cleanup(expected_dirs=[oa.path for oa in output_albums])
+      otree = OutputTree(Path(oconf['path']), trash=trashes.get(oconf['name']))
+      with indent(2), METRICS.phase('cleanup'):
+        otree.cleanup(expected_dirs=expected_dirs)
+  if shard is not None:
+    puts("Skipping permissions & archives; run `bulklift permissions` and "
+         "`bulklift archive` once every shard is done")
+    return
+  for oconf in tree_root.manifest.outputs:
+    if args.output is not None and oconf['name'] != args.output:
+      continue
+    if oconf.permissions_enabled and not oconf['permissions']['inline'] \
+       and not out_of_time and Path(oconf['path']).is_dir():
+      with METRICS.phase('cleanup'):
+        fix_output_permissions(oconf)
+    # Archive whatever was finished, even out of time; it can't hold
+    # anything a later cleanup would remove
+    if oconf.archive_path is not None and Path(oconf['path']).is_dir():
+      with METRICS.phase('archive'):
+        archive_output(oconf)
+
+
+def archive_output(oconf, full=False):
+  """ Write the changes to the output tree described by ManifestOutput
+      `oconf` to archives, or the whole tree if `full` """
+  puts("Archiving output tree '{}' to {}".format(
+    oconf['name'], oconf.archive_path
+  ))
+  with indent(2):
+    OutputArchiver(
+      oconf['path'], oconf.archive_path, oconf['name'],
+      max_size=oconf['archive']['max_size']
+    ).write(full=full)
+
+
+def report_failures(failures, quarantined):
+  """ Summarise the (source path, reason, quarantined) `failures` of a run,
+      and the number of sources skipped because they were `quarantined` by
+      earlier runs """
+  if InputAlbum.quarantine is not None:
+    METRICS.set('sources_quarantined', len(InputAlbum.quarantine))
+  for quarantine, heading in (
+    (True, "{} source files failed to transcode and were quarantined:"),
+    (False, "{} source files couldn't be written to their outputs; they'll be retried next run:")
+  ):
+    listed = [(p, r) for p, r, q in failures if q == quarantine]
+    if not listed:
+      continue
+    puts(colored.red(heading.format(len(listed))))
+    with indent(2):
+      for path, reason in listed:
+        puts("{}: {}".format(path, reason))
+  if quarantined:
+    puts(colored.yellow(
+      "Skipped {} quarantined source files; fix them or pass --retry-quarantined".format(
+        quarantined
+      )
+    ))
+
+
+def run_shard(args):
+  """ Return the Shard for a run given --shard, or None if it has none """
+  if args.shard is None:
+    return None
+  shard = Shard.fromSpec(args.shard)
+  if not 0 <= args.clean_shard <= shard.count:
+    raise ValueError("--clean-shard must be from 0 to {}".format(shard.count))
+  return shard
+
+
+def run_deadline(args):
+  """ Return the Deadline for a run given --max-duration and/or --until, or
+      None if it has none.  Given both the earlier wins.  """
+  deadlines = []
+  if args.max_duration is not None:
+    deadlines.append(Deadline.fromDuration(parse_duration(args.max_duration)))
+  if args.until is not None:
+    deadlines.append(Deadline.fromClock(args.until))
+  return min(deadlines, key=lambda d: d.at) if deadlines else None
+
+
+def fix_output_permissions(oconf):
+  """ Fix the permissions of the output tree described by ManifestOutput
+      `oconf` """
+  puts("Fixing permissions in output tree '{}'".format(oconf['name']))
+  with indent(2):
+    OutputTree(Path(oconf['path'])).permissions(
+      file_mode=oconf.permissions_file_mode,
+      dir_mode=oconf.permissions_dir_mode,
+      uid=oconf.permissions_uid, gid=oconf.permissions_gid
+    )
+
+
+def cmd_permissions(args):
+  """ Fix permissions across whole output trees, e.g. those that apply them
+      inline but have since been tampered with """
+  tree_root = MediaSourceDir(Path(args.source_tree_root[0]), debug=args.debug)
+  for oconf in tree_root.manifest.outputs:
+    if args.output is not None and oconf['name'] != args.output:
+      continue
+    if oconf.permissions_enabled and Path(oconf['path']).is_dir():
+      fix_output_permissions(oconf)
+
+
+def cmd_archive(args):
+  """ Write archives of output trees without transcoding anything """
+  tree_root = MediaSourceDir(Path(args.source_tree_root[0]), debug=args.debug)
+  for oconf in tree_root.manifest.outputs:
+    if args.output is not None and oconf['name'] != args.output:
+      continue
+    if oconf.archive_path is not None and Path(oconf['path']).is_dir():
+      archive_output(oconf, full=args.full)
+
+
+def cmd_plan(args):
+  """ Write the pending work as a build file for another tool to run """
+  tree_root = MediaSourceDir(
+    Path(args.source_tree_root[0]), debug=args.debug, output=args.output
+  )
+  finalize_command = [sys.executable, str(Path(__file__).resolve())]
+  if args.host_config:
+    finalize_command += ['--host-config', str(Path(args.host_config).resolve())]
+  if args.nocache:
+    finalize_command.append('--nocache')
+  finalize_command.append('finalize')
+  if args.output is not None:
+    finalize_command += ['--output', args.output]
+  stream = sys.stdout if args.file == '-' else open(args.file, 'w')
+  try:
+    emitter = PLAN_EMITTERS[args.emit](stream, finalize_command)
+    emitter.begin()
+    jobs_total = 0
+    for ia in tree_root.albums():
+      jobs = ia.plan()
+      if jobs:
+        emitter.album(ia, jobs)
+        jobs_total += len(jobs)
+    emitter.end()
+  finally:
+    if stream is not sys.stdout:
+      stream.close()
+  if stream is not sys.stdout:
+    puts("Wrote {} jobs for {} albums to {}".format(
+      jobs_total, len(emitter.albums), args.file
+    ))
+
+
+def cmd_finalize(args):
+  """ Sign, tag and tidy an album whose jobs were run from a plan """
+  msd = MediaSourceDir(Path(args.album_dir), debug=args.debug, output=args.output)
+  puts("Finalizing {}".format(msd.path))
+  with indent(2):
+    msd.album().adopt(since=args.since)
+
+
+def cmd_check(args):
+  """ Validate every manifest in the tree without transcoding anything """
+  puts("Checking manifests below {}...".format(args.source_tree_root[0]))
+  checked, problems = check_tree(args.source_tree_root[0], workers=args.workers)
+  for path in sorted(problems):
+    puts(colored.red(str(path)))
+    with indent(2):
+      for problem in problems[path]:
+        puts(problem)
+  puts("Checked {} manifests; {} with problems".format(checked, len(problems)))
+  if problems:
+    raise ManifestError("Problems found in {} manifests".format(len(problems)))
+
+
+def cmd_autotune(args):
+  """ Time transcoding a sample of audio with different numbers of parallel
+      jobs, ffmpeg threads and ways of splitting outputs, then save the
+      fastest to the host config """
+  tree_root = MediaSourceDir(Path(args.source_tree_root[0]), debug=args.debug)
+  mconf = tree_root.manifest['config']
+  oconfs = [
+    o for o in tree_root.manifest.outputs
+    if (args.output is None or o['name'] == args.output)
+    and o['formats'] and o['formats'][0] != 'copy'
+  ]
+  if not oconfs:
+    raise ManifestError("No outputs that transcode to benchmark")
+  priority = mconf.process_priority
+  with tempfile.TemporaryDirectory(prefix='bulklift-autotune-') as sample_dir:
+    sources = []
+    if not args.synthetic:
+      sources = library_sample(tree_root.path, files=args.sample)
+    if sources:
+      puts("Sampled {} lossless sources from the library".format(len(sources)))
+    else:
+      puts("Generating {} sources of {}s...".format(args.sample, args.duration))
+      sources = synthetic_sample(sample_dir, args.sample, args.duration)
+    tuner = Autotuner(
+      sources, oconfs, ffmpeg_binary=mconf['transcoding']['ffmpeg_path'],
+      priority=priority, repeat=args.repeat
+    )
+    settings = candidates(host_cpus(priority), outputs=len(oconfs))
+    puts("Timing {} combinations of settings for outputs {}...".format(
+      len(settings), ', '.join(o['name'] for o in oconfs)
+    ))
+    with indent(2):
+      results = tuner.run(settings)
+  seconds, (jobs, ffmpeg_threads, split_outputs) = results[0]
+  puts("Fastest: threads={} ffmpeg_threads={} split_outputs={} ({:.2f}s{})".format(
+    jobs, ffmpeg_threads or 'auto', split_outputs, seconds,
+    tuner.speedText(seconds)
+  ))
+  if args.dry_run:
+    puts("Not saving; --dry-run given")
+  else:
+    write_host_config(
+      Manifest.hostConfigPath(), jobs, ffmpeg_threads, split_outputs
+    )
+    puts("Saved to {}".format(Manifest.hostConfigPath()))
 
 
 def cmd_edit(args):
@@ -67,6 +373,18 @@ parser.set_defaults(func=lambda args: parser.print_help())
 
 parser.add_argument('--debug', action='store_true',
                     help="debugging output")
+parser.add_argument('--metrics-file', type=str, default=None,
+                    help="write Prometheus metrics for the run to this textfile, e.g. for node-exporter's textfile collector")
+parser.add_argument('--metrics-interval', type=float, default=60,
+                    help="seconds between updates of the metrics file during a run; default 60")
+parser.add_argument('--profile', type=str, default=None, metavar='DIR',
+                    help="profile each phase of the run, writing .pstats files and a summary to DIR")
+parser.add_argument('--profile-top', type=int, default=15, metavar='N',
+                    help="number of functions to list per phase in the profile summary; default 15")
+parser.add_argument('--host-config', type=str, default=None, metavar='PATH',
+                    help="config for this host, merged over the root manifest's; default ~/.config/bulklift/host.yaml")
+parser.add_argument('--nocache', action='store_true',
+                    help="don't use or update the caches of parsed manifests, source probes and loudness")
 
 subparsers = parser.add_subparsers(dest='subcommand')
 
@@ -76,8 +394,78 @@ sp_tc.add_argument('--noclean', action='store_true',
                   help="skip removal of redundant albums from output tree(s)")
 sp_tc.add_argument('--output', '-o', type=str, default=None,
                    help="single output to work with")
+sp_tc.add_argument('--retry-quarantined', action='store_true',
+                   help="retry source files quarantined after failing in earlier runs")
+sp_tc.add_argument('--shard', type=str, default=None, metavar='I/N',
+                   help="only transcode the albums in shard I of N, e.g. 2/4, so several hosts can share the work")
+sp_tc.add_argument('--clean-shard', type=int, default=1, metavar='I',
+                   help="with --shard, the shard that cleans up the output trees; 0 for none.  Default 1.")
+sp_tc.add_argument('--max-duration', type=str, default=None, metavar='DURATION',
+                   help="stop starting jobs that won't finish within DURATION, e.g. 5h or 4h30m; finished albums are finalized and the next run carries on")
+sp_tc.add_argument('--until', type=str, default=None, metavar='HH:MM',
+                   help="as --max-duration, but stop by the next occurrence of local time HH:MM")
 sp_tc.add_argument('source_tree_root', type=str, nargs=1, default='.',
-                   help="root path for your source tree; must contain a .bulklift.yaml with root=true.  Default is current dir.")
+                   help="root path for your source tree, containing a .bulklift.yaml with root=true, or a dir within it to transcode just that subtree.  Default is current dir.")
+
+sp_check = subparsers.add_parser('check', help="validate every manifest in the tree")
+sp_check.set_defaults(func=cmd_check)
+sp_check.add_argument('--workers', '-j', type=int, default=None,
+                      help="number of worker processes; default is one per core")
+sp_check.add_argument('source_tree_root', type=str, nargs=1, default='.',
+                      help="root path for your source tree, or a dir within it to check just that subtree")
+
+sp_plan = subparsers.add_parser('plan', help="write pending work as a build file for ninja, make or a shell")
+sp_plan.set_defaults(func=cmd_plan)
+sp_plan.add_argument('--emit', choices=sorted(PLAN_EMITTERS), default='ninja',
+                     help="format to write; default ninja")
+sp_plan.add_argument('--file', '-f', type=str, default='-',
+                     help="file to write to; default stdout")
+sp_plan.add_argument('--output', '-o', type=str, default=None,
+                     help="single output to work with")
+sp_plan.add_argument('source_tree_root', type=str, nargs=1, default='.',
+                     help="root path for your source tree, or a dir within it to plan just that subtree")
+
+sp_fin = subparsers.add_parser('finalize', help="sign and tag an album transcoded from a plan")
+sp_fin.set_defaults(func=cmd_finalize)
+sp_fin.add_argument('--output', '-o', type=str, default=None,
+                    help="single output to work with")
+sp_fin.add_argument('--since', type=float, default=None, metavar='TIMESTAMP',
+                    help="only trust outputs modified since this unix time, when the plan was written")
+sp_fin.add_argument('album_dir', type=str,
+                    help="source dir of the album")
+
+sp_perm = subparsers.add_parser('permissions', help="fix permissions on output tree(s)")
+sp_perm.set_defaults(func=cmd_permissions)
+sp_perm.add_argument('--output', '-o', type=str, default=None,
+                     help="single output to work with")
+sp_perm.add_argument('source_tree_root', type=str, nargs=1, default='.',
+                     help="root path for your source tree, containing a .bulklift.yaml with root=true")
+
+sp_arch = subparsers.add_parser('archive', help="write archives of output tree(s)")
+sp_arch.set_defaults(func=cmd_archive)
+sp_arch.add_argument('--output', '-o', type=str, default=None,
+                     help="single output to work with")
+sp_arch.add_argument('--full', action='store_true',
+                     help="archive every file rather than just those changed since the last archive")
+sp_arch.add_argument('source_tree_root', type=str, nargs=1, default='.',
+                     help="root path for your source tree, containing a .bulklift.yaml with root=true")
+
+sp_tune = subparsers.add_parser('autotune', help="find the fastest transcoding settings for this host")
+sp_tune.set_defaults(func=cmd_autotune)
+sp_tune.add_argument('--output', '-o', type=str, default=None,
+                     help="single output to benchmark; default is all of them")
+sp_tune.add_argument('--sample', type=int, default=8, metavar='N',
+                     help="number of source files to transcode for each combination; default 8")
+sp_tune.add_argument('--synthetic', action='store_true',
+                     help="benchmark with generated audio instead of a sample of the library")
+sp_tune.add_argument('--duration', type=float, default=60, metavar='SECONDS',
+                     help="length of each generated source; default 60")
+sp_tune.add_argument('--repeat', type=int, default=1, metavar='N',
+                     help="time each combination N times and keep the fastest; default 1")
+sp_tune.add_argument('--dry-run', action='store_true',
+                     help="report the fastest settings without saving them")
+sp_tune.add_argument('source_tree_root', type=str, nargs=1, default='.',
+                     help="root path for your source tree, containing a .bulklift.yaml with root=true")
 
 sp_edit = subparsers.add_parser('edit', help="create/edit a .bulklift.yml manifest")
 sp_edit.set_defaults(func=cmd_edit)
@@ -94,8 +482,40 @@ if __name__ == '__main__':
 
   args = parser.parse_args()
 
+  if args.host_config:
+    Manifest.host_config_path = Path(args.host_config)
+
+  if not args.nocache:
+    Manifest.cache = ManifestCache()
+    OutputAlbum.loudness_cache = LoudnessCache()
+    InputAlbum.probe_index = ProbeIndex()
+    InputAlbum.quarantine = Quarantine()
+
+  if args.metrics_file:
+    METRICS.startWriting(args.metrics_file, args.metrics_interval)
+
+  profiler = None
+  if args.profile:
+    profiler = PhaseProfiler(args.profile, top=args.profile_top)
+    METRICS.phase_hooks.append(profiler.profile)
+    profiler.start()
+
   try:
-    args.func(args)
+    try:
+      args.func(args)
+      METRICS.set('run_success', 1)
+    finally:
+      if args.metrics_file:
+        METRICS.stopWriting(args.metrics_file)
+      if Manifest.cache is not None:
+        Manifest.cache.save()
+      if not args.nocache:
+        OutputAlbum.loudness_cache.save()
+        InputAlbum.probe_index.save()
+        InputAlbum.quarantine.save()
+      if profiler is not None:
+        puts(profiler.finish())
+        puts("Profiles written to {}".format(args.profile))
   except Exception as e:
     if args.debug:
       raise
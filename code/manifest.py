@@ -1,13 +1,20 @@
 import yaml
 import functools
+import os
+import pickle
 from copy import deepcopy
 from pathlib import Path
 import pprint
+import re
+import tempfile
 
 from clint.textui import puts, colored
 
-from util.data import dict_deep_merge, available_cpu_count
-from util.file import is_audio_dir, expandvars
+from util.data import dict_deep_merge, available_cpu_count, yaml_load, \
+  yaml_dump
+from util.file import is_audio_dir, expandvars, user_cache_dir, \
+  compile_filters, lookup_uid, lookup_gid, user_config_dir
+from priority import ProcessPriority
 
 
 class ManifestError(Exception):
@@ -31,6 +38,32 @@ class ManifestConfig(dict):
     tc.setdefault('ffmpeg_path', None)
     tc['ffmpeg_path'] = expandvars(tc['ffmpeg_path'])
     tc.setdefault('threads', available_cpu_count())
+    tc.setdefault('ffmpeg_threads', None)
+    tc.setdefault('split_outputs', 'tail')
+    tc.setdefault('io_threads', 1)
+    tc.setdefault('probe', True)
+    tc.setdefault('retries', 1)
+    tc.setdefault('retry_backoff', 5)
+    tc.setdefault('timeout', {})
+    to = tc['timeout']
+    to.setdefault('base', 300)
+    to.setdefault('per_second', 1)
+    to.setdefault('unknown', 3600)
+    tc.setdefault('priority', {})
+    pr = tc['priority']
+    pr.setdefault('nice', None)
+    pr.setdefault('ionice_class', None)
+    pr.setdefault('ionice_level', None)
+    pr.setdefault('sched_policy', None)
+    pr.setdefault('cpus', None)
+    tc.setdefault('prefetch', {})
+    pf = tc['prefetch']
+    pf.setdefault('jobs', 0)
+    pf.setdefault('mode', 'fadvise')
+    pf.setdefault('memory', '512M')
+    pf.setdefault('disk', '2G')
+    pf.setdefault('scratch_dir', None)
+    pf['scratch_dir'] = expandvars(pf['scratch_dir'])
     tc.setdefault('rewrite_metadata', {})
     tc['rewrite_metadata'].setdefault('comment', '')
     self.setdefault('r128gain', {})
@@ -41,9 +74,27 @@ class ManifestConfig(dict):
     rg['ffmpeg_path'] = expandvars(rg['ffmpeg_path'])
     rg.setdefault('threads', None)
     rg.setdefault('type', 'album')
+    rg.setdefault('batch', 1)
+    rg.setdefault('mode', 'r128gain')
     self.setdefault('target', {})
     self['target'].setdefault('album_dir', self.DFL_ALBUM_DIR_TEMPLATE)
 
+  @property
+  def process_priority(self):
+    """ Return the ProcessPriority to run ffmpeg & r128gain with, or None to
+        leave them as inherited.  Validating it queries the OS, so it's only
+        done on first use.  """
+    try:
+      return self._process_priority
+    except AttributeError:
+      pass
+    try:
+      priority = ProcessPriority.fromConfig(self['transcoding']['priority'])
+    except (ValueError, TypeError) as e:
+      raise ManifestError("Invalid transcoding.priority: {}".format(e))
+    self._process_priority = priority
+    return priority
+
   def dump(self):
     """Dump human-readable config for debugging"""
     pp = pprint.PrettyPrinter(indent=2)
@@ -53,6 +104,9 @@ class ManifestConfig(dict):
 class ManifestOutput(dict):
   """ Dict-like representing an output, with sensible defaults """
 
+  # Where `staging: true` puts encodes; a tmpfs on most Linux systems
+  DFL_STAGING_DIR = '/dev/shm'
+
   def __init__(self, *args, **kwargs):
     # print("creating a ManifestOutput from: {}".format(args[0]))
     super(ManifestOutput, self).__init__(*args, **kwargs)
@@ -62,17 +116,68 @@ class ManifestOutput(dict):
     self.setdefault('enabled', False)
     self.setdefault('lame_vbr', 3)
     self.setdefault('opus_bitrate', '128k')
+    self.setdefault('aac_vbr', 3)
+    self.setdefault('staging', None)
+    self.setdefault('trash', {})
+    self['trash'].setdefault('enabled', False)
+    self['trash'].setdefault('max_size', '1G')
+    self.setdefault('archive', {})
+    self['archive'].setdefault('enabled', False)
+    self['archive'].setdefault('path', None)
+    self['archive'].setdefault('max_size', None)
     self.setdefault('permissions', {})
     self['permissions'].setdefault('dir_mode', None)
     self['permissions'].setdefault('file_mode', None)
     self['permissions'].setdefault('user', None)
     self['permissions'].setdefault('group', None)
+    self['permissions'].setdefault('inline', False)
     self.setdefault('filters', {})
     self['filters'].setdefault('include', [])
     self['filters'].setdefault('exclude', [])
     if not 'path' in self:
       raise ManifestError("output is missing a 'path' field")
     self['path'] = expandvars(self['path'])
+    try:    # compile filters now, so errors surface early
+      self.filters_include, self.filters_exclude
+    except re.error as e:
+      raise ManifestError("Invalid filter for output '{}': {}".format(
+        self['name'], e
+      ))
+
+  @property
+  def filters_include(self):
+    """ Return the compiled include filters, or None if there are none """
+    return compile_filters(tuple(self['filters']['include']))
+
+  @property
+  def filters_exclude(self):
+    """ Return the compiled exclude filters, or None if there are none """
+    return compile_filters(tuple(self['filters']['exclude']))
+
+  @property
+  def staging_path(self):
+    """ Return the dir to stage encodes in before they're moved to the
+        output, or None if staging is disabled """
+    staging = self['staging']
+    if staging in (None, False):
+      return None
+    elif staging is True:
+      staging = self.DFL_STAGING_DIR if Path(self.DFL_STAGING_DIR).is_dir() \
+                else tempfile.gettempdir()
+    return Path(expandvars(str(staging))) / 'bulklift-staging' / self['name']
+
+  @property
+  def archive_path(self):
+    """ Return the dir archives of this output are written to, or None if
+        archiving is disabled """
+    archive = self['archive']
+    if not archive['enabled']:
+      return None
+    elif archive['path'] is None:
+      raise ManifestError("Output '{}' has archive enabled but no path".format(
+        self['name']
+      ))
+    return Path(expandvars(str(archive['path'])))
 
   @property
   def permissions_dir_mode(self):
@@ -86,6 +191,33 @@ class ManifestOutput(dict):
     fm = self['permissions']['file_mode']
     return None if fm is None else int(fm, 8)
 
+  @property
+  def permissions_uid(self):
+    """ Return the uid of the user configured, if any """
+    try:
+      return lookup_uid(self['permissions']['user'])
+    except KeyError:
+      raise ManifestError("Output '{}' has unknown user '{}'".format(
+        self['name'], self['permissions']['user']
+      ))
+
+  @property
+  def permissions_gid(self):
+    """ Return the gid of the group configured, if any """
+    try:
+      return lookup_gid(self['permissions']['group'])
+    except KeyError:
+      raise ManifestError("Output '{}' has unknown group '{}'".format(
+        self['name'], self['permissions']['group']
+      ))
+
+  @property
+  def permissions_enabled(self):
+    """ Return True if any permissions are configured """
+    perms = self['permissions']
+    return any(perms[k] is not None
+               for k in ('dir_mode', 'file_mode', 'user', 'group'))
+
 
 class Manifest(dict):
   """ A dict-like object for loading, processing and testing Bulklift
@@ -97,6 +229,17 @@ class Manifest(dict):
   # Metadata must contain at least these fields
   METADATA_REQUIRED = ('artist', 'album', 'genre', 'year')
 
+  # A ManifestCache to consult in fromDir(), if any
+  cache = None
+
+  # Config for this host alone, e.g. as written by `bulklift autotune`.  Its
+  # `config` section is merged over the root manifest's.
+  HOST_CONFIG_FILE_NAME = 'host.yaml'
+
+  # Path of the host config, or None for HOST_CONFIG_FILE_NAME in the user's
+  # config dir
+  host_config_path = None
+
 
   def __init__(self, path, mapping={}, **kwargs):
     """ Create a manifest representing `path`.  Other args as for dict. """
@@ -132,22 +275,69 @@ class Manifest(dict):
     # puts("Loading {}".format(man_path))
     try:
       with man_path.open('r') as stream:
-        data = yaml.safe_load(stream)
+        data = yaml_load(stream)
     except FileNotFoundError:
       data = {}
-    except yaml.scanner.ScannerError as e:
+    except yaml.YAMLError as e:
       raise ManifestError("Error parsing {}:\n\n{}".format(man_path, e))
     data.setdefault('root', False)
     return data
 
+  @classmethod
+  def hostConfigPath(cls):
+    """ Return the Path of the host config file, which may not exist """
+    if cls.host_config_path is not None:
+      return Path(cls.host_config_path)
+    return user_config_dir() / cls.HOST_CONFIG_FILE_NAME
+
+  @classmethod
+  @functools.lru_cache(maxsize=None)
+  def loadHostConfig(cls, config_path):
+    """ Load the `config` section of the host config file at `config_path`,
+        or an empty dict if there isn't one """
+    try:
+      with config_path.open('r') as stream:
+        data = yaml_load(stream) or {}
+    except FileNotFoundError:
+      return {}
+    except yaml.YAMLError as e:
+      raise ManifestError("Error parsing {}:\n\n{}".format(config_path, e))
+    unknown = set(data) - {'config'}
+    if unknown:
+      raise ManifestError("{} may only contain a 'config' section, not: {}".format(
+        config_path, ', '.join(sorted(unknown))
+      ))
+    return data.get('config') or {}
+
   @classmethod
   def fromDir(cls, path, override={}, debug=False):
     """ Load the manifest from `path`, if present, and merge it with any parent
-        manifests up to the root """
+        manifests up to the root.  Served from `Manifest.cache` if possible. """
+    use_cache = cls.cache is not None and not override
+    if use_cache:
+      data = cls.cache.get(path)
+      if data is not None:
+        return Manifest(path, data)
+    root_path, data = cls.mergeFromDir(path, override, debug=debug)
+    if use_cache:
+      dirs = [path]
+      while dirs[-1] != root_path:
+        dirs.append(dirs[-1].parent)
+      cls.cache.put(path, dirs, data)
+    return Manifest(path, data)
+
+  @classmethod
+  def mergeFromDir(cls, path, override={}, debug=False):
+    """ Recursively merge the manifest data from `path`, if present, with
+        that of its parents.  Return a tuple of the root dir and merged data. """
     if debug:
       puts("Reading manifest from {}".format(path))
     data = deepcopy(cls.loadYaml(path))
     got_root = data.get('root', False)
+    if got_root:  # host config sits between the root and everything below it
+      dict_deep_merge(data, {
+        'config': deepcopy(cls.loadHostConfig(cls.hostConfigPath()))
+      })
     # dict_deep_merge() doesn't do lists, so we have to re-pack the outputs
     outputs_data = {o['name']: o for o in data.get('outputs', [])}
     outputs_override = {o['name']: o for o in override.pop('outputs', [])}
@@ -155,12 +345,12 @@ class Manifest(dict):
     data['outputs'] = list(outputs_data.values())
     dict_deep_merge(data, override)
     if got_root:   # must have merged in the root manifest
-      return Manifest(path, data)
+      return (path, data)
     if path == path.parent:       # Reached / without finding a root manifest
       raise ManifestError(
         "Root manifest could not be found; did you miss a 'root: true'?"
       )
-    return cls.fromDir(path.parent, data, debug=debug)
+    return cls.mergeFromDir(path.parent, data, debug=debug)
 
   def dumpTemplate(self):
     """ Try to infer the directory level we're on and produce an appropriate
@@ -171,7 +361,7 @@ class Manifest(dict):
       d = self.genTemplateForAlbum()
     else:
       d = self.genTemplateForArtist()
-    return yaml.safe_dump(d)
+    return yaml_dump(d)
 
   def genTemplateForArtist(self):
     """ Dump yaml suitable to be used as a template for an artist manifest """
@@ -209,3 +399,82 @@ class Manifest(dict):
   def outputs_enabled(self):
     """ Return a list of output specs, but only the ones that are enabled """
     return [o for o in self.outputs if o['enabled']]
+
+
+class ManifestCache(object):
+  """ On-disk cache of merged manifest data, so an unchanged source tree can be
+      loaded without parsing any yaml.  Each entry is keyed by the (path,
+      mtime, size) of the manifest in every dir from its own up to the root,
+      and of the host config; editing, adding or removing any of them
+      invalidates it.  Entries are
+      stored pickled, which is quick to load and gives every caller a fresh
+      copy.  """
+
+  CACHE_FILE_NAME = 'manifests.pickle'
+
+  # Bump this whenever the format of cached data changes
+  VERSION = 2
+
+  def __init__(self, path=None):
+    """ Initialize the cache, loading it from `path` if that exists """
+    super(ManifestCache, self).__init__()
+    self.path = Path(path) if path else user_cache_dir() / self.CACHE_FILE_NAME
+    self.entries = {}   # str(dir) -> (chain key, pickled data)
+    self.dirty = False
+    self.load()
+
+  @staticmethod
+  def chainKey(dirs):
+    """ Return a key representing the state of the manifests in `dirs`, plus
+        the host config merged over them """
+    key = []
+    paths = [Manifest.manifestFilePath(d) for d in dirs]
+    for man_path in map(str, paths + [Manifest.hostConfigPath()]):
+      try:
+        st = os.stat(man_path)
+        key.append((man_path, st.st_mtime_ns, st.st_size))
+      except FileNotFoundError:
+        key.append((man_path, None, None))
+    return tuple(key)
+
+  def get(self, path):
+    """ Return merged manifest data for dir `path`, or None if we don't have
+        it or the manifests it came from have changed """
+    try:
+      key, data = self.entries[str(path)]
+    except KeyError:
+      return None
+    dirs = [Path(man_path).parent for man_path, m, s in key[:-1]]
+    if self.chainKey(dirs) != key:
+      return None
+    return pickle.loads(data)
+
+  def put(self, path, dirs, data):
+    """ Store merged manifest `data` for `path`, which came from the manifests
+        in `dirs` """
+    self.entries[str(path)] = (
+      self.chainKey(dirs), pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    )
+    self.dirty = True
+
+  def load(self):
+    """ Load the cache from disk.  A missing or unreadable cache is treated as
+        empty; it will be rebuilt.  """
+    try:
+      with self.path.open('rb') as stream:
+        version, entries = pickle.load(stream)
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+      return
+    if version == self.VERSION:
+      self.entries = entries
+
+  def save(self):
+    """ Save the cache to disk, if it has changed """
+    if not self.dirty:
+      return
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = self.path.with_name(self.path.name + '.tmp')
+    with tmp_path.open('wb') as stream:
+      pickle.dump((self.VERSION, self.entries), stream, pickle.HIGHEST_PROTOCOL)
+    os.replace(str(tmp_path), str(self.path))
+    self.dirty = False
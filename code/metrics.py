@@ -0,0 +1,157 @@
+""" Metrics describing a run, exported as a Prometheus textfile for the
+    node-exporter textfile collector """
+
+import os
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+
+
+class Metrics(object):
+  """ A thread-safe registry of counters and gauges, each of which may have
+      labels.  Metrics must be described before use.  """
+
+  def __init__(self, prefix='bulklift'):
+    """ Initialize an empty registry """
+    super(Metrics, self).__init__()
+    self.prefix = prefix
+    self.lock = threading.Lock()
+    self.descriptions = {}  # name -> (type, help)
+    self.values = {}        # name -> {sorted label items: value}
+    self.writer = None
+    self.stopping = threading.Event()
+    self.phase_hooks = []   # functions returning a context manager for a phase
+    self.describe('timestamp_seconds', 'gauge',
+                  "Unix time these metrics were written at")
+
+  def describe(self, name, kind, help):
+    """ Register metric `name`, of `kind` 'counter' or 'gauge' """
+    self.descriptions[name] = (kind, help)
+    self.values.setdefault(name, {})
+
+  def inc(self, name, value=1, **labels):
+    """ Add `value` to metric `name` """
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      series = self.values[name]
+      series[key] = series.get(key, 0) + value
+
+  def set(self, name, value, **labels):
+    """ Set metric `name` to `value` """
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      self.values[name][key] = value
+
+  def get(self, name, **labels):
+    """ Return the current value of metric `name`, or 0 if it has none """
+    with self.lock:
+      return self.values[name].get(tuple(sorted(labels.items())), 0)
+
+  @contextmanager
+  def timer(self, name, **labels):
+    """ Context manager adding the seconds spent within it to metric `name` """
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.inc(name, time.monotonic() - start, **labels)
+
+  @contextmanager
+  def phase(self, name):
+    """ Context manager adding the time spent within it to phase `name`.  Each
+        of `phase_hooks` is called with the name and its context entered too,
+        e.g. to profile the phase.  """
+    with ExitStack() as stack:
+      for hook in self.phase_hooks:
+        stack.enter_context(hook(name))
+      with self.timer('phase_seconds_total', phase=name):
+        yield
+
+  @staticmethod
+  def escape(value):
+    """ Escape a label value for the exposition format """
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+                     .replace('\n', r'\n')
+
+  def render(self):
+    """ Return all metrics in the Prometheus text exposition format """
+    lines = []
+    with self.lock:
+      for name in sorted(self.descriptions):
+        kind, help = self.descriptions[name]
+        full_name = '{}_{}'.format(self.prefix, name)
+        lines.append('# HELP {} {}'.format(full_name, help))
+        lines.append('# TYPE {} {}'.format(full_name, kind))
+        for key, value in sorted(self.values[name].items()):
+          labels = ','.join(
+            '{}="{}"'.format(k, self.escape(v)) for k, v in key
+          )
+          lines.append('{}{} {}'.format(
+            full_name, '{' + labels + '}' if labels else '', value
+          ))
+    return '\n'.join(lines) + '\n'
+
+  def write(self, path):
+    """ Write the metrics to textfile `path`.  The file is replaced atomically
+        so the collector never reads a partial one.  """
+    path = Path(path)
+    self.set('timestamp_seconds', time.time())
+    tmp_path = path.with_name('.' + path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf8') as stream:
+      stream.write(self.render())
+    os.replace(str(tmp_path), str(path))
+
+  def startWriting(self, path, interval):
+    """ Write the metrics to `path` every `interval` seconds until
+        stopWriting() is called """
+    def writer():
+      while not self.stopping.wait(interval):
+        self.write(path)
+    self.stopping.clear()
+    self.writer = threading.Thread(target=writer, daemon=True)
+    self.writer.start()
+
+  def stopWriting(self, path):
+    """ Stop periodic writing and write the final metrics to `path` """
+    if self.writer is not None:
+      self.stopping.set()
+      self.writer.join()
+      self.writer = None
+    self.write(path)
+
+
+# The registry everything records into
+METRICS = Metrics()
+
+METRICS.describe('phase_seconds_total', 'counter',
+                 "Wall-clock seconds spent in each phase of the run")
+METRICS.describe('jobs_total', 'counter',
+                 "Outputs transcoded, by outcome and codec")
+METRICS.describe('jobs_retried_total', 'counter',
+                 "Retries of jobs that raised an error")
+METRICS.describe('sources_quarantined', 'gauge',
+                 "Source files quarantined after failing to transcode")
+METRICS.describe('encoded_audio_seconds_total', 'counter',
+                 "Seconds of source audio encoded, by codec")
+METRICS.describe('output_bytes_written_total', 'counter',
+                 "Bytes of media written, by output")
+METRICS.describe('archive_bytes_written_total', 'counter',
+                 "Bytes of media packed into archives, by output")
+METRICS.describe('r128gain_seconds_total', 'counter',
+                 "Wall-clock seconds spent adding gain tags")
+METRICS.describe('albums_total', 'counter',
+                 "Albums found by the walk, by stage reached")
+METRICS.describe('albums_pending', 'gauge',
+                 "Albums planned but not yet transcoded")
+METRICS.describe('worker_busy_seconds_total', 'counter',
+                 "Seconds transcoding workers spent running jobs")
+METRICS.describe('worker_capacity_seconds_total', 'counter',
+                 "Seconds transcoding workers were available for jobs")
+METRICS.describe('worker_utilisation_ratio', 'gauge',
+                 "Fraction of transcoding worker time spent running jobs")
+METRICS.describe('deadline_reached', 'gauge',
+                 "1 if the run stopped early, leaving work for the next run")
+METRICS.describe('run_success', 'gauge',
+                 "1 if the run completed without error, else 0")
+METRICS.set('run_success', 0)
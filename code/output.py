@@ -1,81 +1,297 @@
+import errno
+import os
+import subprocess
 import shutil
+import tempfile
+import threading
 from pathlib import Path
 
 from clint.textui import colored, puts, indent
 
-from util.file import filename_matches_globs, \
+from util.data import parse_size
+from util.file import DirSnapshot, dir_size, fix_permissions, \
   AUDIO_FORMATS, AUDIO_FORMATS_LOSSLESS, IMAGE_FORMATS
 from util.sanitize import FILENAME_SANITIZERS
 
 from manifest import MetadataError
-from wrappers import R128gainWrapper
+from wrappers import R128gainWrapper, ExternalCommandError
+from loudness import LoudnessCache, integrated_loudness, write_gain_tags
+from metrics import METRICS
 from signature import Signature
 from handlers import FORMAT_HANDLERS, OutputHandlerCopy
 
 
+def album_path(mconfig, oconfig, metadata):
+  """ Return the path within output `oconfig` for an album with `metadata` """
+  tconf = mconfig['target']
+  try:
+    album_dir = Path(tconf['album_dir'].format(**metadata))
+  except KeyError:
+    raise MetadataError("Failed to interpolate template '{}' with metadata: {}".format(
+      tconf['album_dir'], metadata
+    ))
+  sanitize = FILENAME_SANITIZERS[oconfig['sanitize_paths']]
+  return Path(oconfig['path']) / sanitize(album_dir)
+
+
+class OutputTrash(object):
+  """ A dir at the root of an output tree that redundant albums are moved
+      into, which is instant on the same filesystem, rather than deleted on
+      the spot.  Deleting thousands of files from a vfat or MTP device can
+      take a very long time; a low-priority background thread does it
+      instead, picking up whatever is left on the next run.  Victims that
+      would take the trash over `max_size` bytes are deleted immediately.
+      Sizes are only tracked given a `max_size`.  Whatever a previous run left
+      in the trash is measured by the background thread, not up front, so a
+      slow device doesn't hold up the start of a run.  """
+
+  DIR_NAME = '.bulklift-trash'
+
+  def __init__(self, root_path, max_size=None):
+    """ Initialize the trash for the output tree at `root_path` """
+    super(OutputTrash, self).__init__()
+    self.path = Path(root_path) / self.DIR_NAME
+    self.max_size = parse_size(max_size)
+    self.lock = threading.Lock()
+    self.size = 0         # bytes known to be in the trash
+    self.counted = set()  # names of holders whose size is in self.size
+    self.worker = None
+
+  def discard(self, victim):
+    """ Move dir `victim` into the trash.  It is deleted immediately if the
+        trash is full or on another filesystem.  """
+    size = dir_size(victim) if self.max_size is not None else 0
+    with self.lock:
+      full = self.max_size is not None and self.size + size > self.max_size
+      if not full:
+        self.size += size
+    if full:
+      shutil.rmtree(str(victim), ignore_errors=True)
+      return
+    self.path.mkdir(exist_ok=True)
+    holder = Path(tempfile.mkdtemp(dir=str(self.path)))  # names can clash
+    with self.lock:
+      self.counted.add(holder.name)
+    try:
+      os.rename(str(victim), str(holder / victim.name))
+    except OSError as e:
+      if e.errno != errno.EXDEV:
+        raise
+      with self.lock:
+        self.size -= size
+      shutil.rmtree(str(victim), ignore_errors=True)
+      holder.rmdir()
+
+  def empty(self):
+    """ Start deleting everything currently in the trash on a low-priority
+        background thread.  It dies with the program; anything left over is
+        deleted next time.  """
+    if not self.path.is_dir():
+      return
+    victims = list(self.path.iterdir())
+    def worker():
+      try:
+        os.nice(19)   # per-thread on Linux
+      except (AttributeError, OSError):
+        pass
+      sizes = {}
+      if self.max_size is not None:
+        for victim in victims:
+          sizes[victim] = dir_size(victim)
+        with self.lock:   # count what earlier runs left behind
+          self.size += sum(
+            s for v, s in sizes.items() if v.name not in self.counted
+          )
+          self.counted.update(v.name for v in victims)
+      for victim in victims:
+        shutil.rmtree(str(victim), ignore_errors=True)
+        with self.lock:
+          self.size -= sizes.get(victim, 0)
+          self.counted.discard(victim.name)
+    self.worker = threading.Thread(target=worker, daemon=True)
+    self.worker.start()
+
+  def wait(self):
+    """ Wait for any deletion started by empty() to finish """
+    if self.worker is not None:
+      self.worker.join()
+
+
 class OutputTree(object):
   """ Represent a whole Bulklift output tree with various functionality to
       garden it  """
 
-  def __init__(self, root_path):
-    """ Initialize TargetTree rooted at a specific path """
+  # Dirs within the tree that cleanup() must never touch
+  PROTECTED_NAMES = ('.stfolder', '.stignore', OutputTrash.DIR_NAME)
+
+  def __init__(self, root_path, trash=None):
+    """ Initialize TargetTree rooted at a specific path.  If an OutputTrash is
+        given redundant dirs are moved into it rather than deleted.  """
     super(OutputTree, self).__init__()
     self.root_path = root_path
+    self.trash = trash
 
   def cleanup(self, expected_dirs, verbose=True):
     """ Remove any dirs from the target tree that aren't a member of
         expected_dirs or their parent paths. Root of tree is left untouched.
         Stray files (not dirs) are handled earlier, after transcoding.
-        The string dir comparison here is far from clever, but it is fast. """
-    # Cache resolved paths as strings
-    expected_dirs_s = [d.resolve().as_posix() for d in expected_dirs]
+        `expected_dirs` may hold Paths or strings.  """
+    # Cache resolved paths, and all their parents, as strings
+    expected_dirs_s = set()
+    for d in expected_dirs:
+      d = Path(d).resolve()
+      expected_dirs_s.add(d.as_posix())
+      expected_dirs_s.update(p.as_posix() for p in d.parents)
     def clean(victim, root=False):
-      # Hack: don't delete Syncthing metadata
-      if victim.parts[-1] in ['.stfolder', '.stignore']:
-        puts(colored.red("Not cleaning up '{}'".format(victim)))
+      # Hack: don't delete Syncthing metadata, or our own trash
+      if victim.parts[-1] in self.PROTECTED_NAMES:
+        if verbose:
+          puts(colored.red("Not cleaning up '{}'".format(victim)))
         return
       for entry in victim.iterdir():
         if entry.is_dir():
           clean(entry)
       if not root:
-        victim_as_str = victim.resolve().as_posix()
-        if not any(map(lambda ed: ed.startswith(victim_as_str), expected_dirs_s)):
+        if victim.resolve().as_posix() not in expected_dirs_s:
           if verbose:
             puts(colored.red("Removing '{}'".format(victim)))
-          shutil.rmtree(str(victim), ignore_errors=True)
+          if self.trash is not None:
+            self.trash.discard(victim)
+          else:
+            shutil.rmtree(str(victim), ignore_errors=True)
     clean(self.root_path, root=False)
 
-  def permissions(self, file_mode, dir_mode, user, group):
-    """ Fix permissions on the target tree to match mode/user/group """
-    raise NotImplementedError()
+  def permissions(self, file_mode=None, dir_mode=None, uid=None, gid=None,
+                  verbose=True):
+    """ Fix permissions on the target tree to match mode/uid/gid, any of which
+        may be None to leave it alone.  This is a single scandir() pass that
+        only calls chmod()/chown() on entries that don't already match, so an
+        already-correct tree costs one lstat() per entry and no writes.  The
+        root of the tree is left alone, as are symlinks and our trash.
+        Returns the number of entries changed.  """
+    changed = 0
+    stack = [str(self.root_path)]
+    while stack:
+      with os.scandir(stack.pop()) as it:
+        for entry in it:
+          if entry.name == OutputTrash.DIR_NAME or entry.is_symlink():
+            continue
+          is_dir = entry.is_dir(follow_symlinks=False)
+          if fix_permissions(
+            entry.path, mode=dir_mode if is_dir else file_mode,
+            uid=uid, gid=gid, st=entry.stat(follow_symlinks=False)
+          ):
+            changed += 1
+          if is_dir:
+            stack.append(entry.path)
+    if verbose:
+      puts("Fixed permissions on {} files and dirs".format(changed))
+    return changed
+
+
+class R128gainBatch(object):
+  """ Collect finalized output albums so r128gain can process many of them in
+      one run, rather than paying its startup cost for every album.  r128gain
+      treats each dir as a separate album, so album gain is unaffected.  An
+      album's signature is only saved once its batch has succeeded.  If a
+      batch fails its albums are retried one at a time, so one bad album
+      costs no others their signatures.  """
+
+  # Errors from r128gain that cost only the albums it was run over
+  ERRORS = (subprocess.SubprocessError, ExternalCommandError, OSError)
+
+  def __init__(self, verbose=True):
+    """ Initialize an empty batch """
+    super(R128gainBatch, self).__init__()
+    self.verbose = verbose
+    self.pending = {}   # r128gain settings -> list of OutputAlbums
+    self.failures = []  # (OutputAlbum, exception) for albums left unsigned
+
+  def __len__(self):
+    """ Return the number of albums waiting for r128gain """
+    return sum(map(len, self.pending.values()))
+
+  def add(self, oa):
+    """ Queue OutputAlbum `oa` for r128gain, running the batch it joins once
+        that is full """
+    settings = tuple(sorted(oa.r128gainSettings().items()))
+    albums = self.pending.setdefault(settings, [])
+    albums.append(oa)
+    if len(albums) >= oa.r128gainBatchSize():
+      self.run(settings)
+
+  def run(self, settings):
+    """ Run r128gain over the batch of albums sharing `settings` then save
+        their signatures """
+    albums = self.pending.pop(settings)
+    if self.verbose:
+      puts("Running r128gain over a batch of {} albums...".format(len(albums)))
+    try:
+      self.runAlbums(albums, settings)
+    except self.ERRORS as e:
+      puts(colored.red("r128gain failed over the batch ({}); retrying each album".format(e)))
+      for oa in albums:
+        try:
+          self.runAlbums([oa], settings)
+        except self.ERRORS as e:
+          puts(colored.red("r128gain failed for {}; leaving it unsigned".format(oa.path)))
+          self.failures.append((oa, e))
+
+  def runAlbums(self, albums, settings):
+    """ Run r128gain with `settings` over `albums`, then save their
+        signatures """
+    r128 = R128gainWrapper(
+      target_dirs=[oa.path for oa in albums], **dict(settings)
+    )
+    with METRICS.timer('r128gain_seconds_total'):
+      r128.run(output=False)
+    with indent(2):
+      for oa in albums:
+        oa.signature.save(verbose=self.verbose)
+
+  def flush(self):
+    """ Run r128gain over all albums still waiting """
+    for settings in list(self.pending):
+      self.run(settings)
 
 
 class OutputAlbum(object):
   """ Represent a single output album """
 
-  def __init__(self, mconfig, oconfig, metadata):
+  # A LoudnessCache shared by all albums, for r128gain mode 'cache'
+  loudness_cache = None
+
+  def __init__(self, mconfig, oconfig, metadata, source_snapshot=None):
     """ Initialize an OutputAlbum.  `metadata` a dict of metadata replacements
-        to have ffmpeg do.  """
+        to have ffmpeg do.  `source_snapshot` is an optional DirSnapshot of
+        the source dir, shared between outputs.  """
     super(OutputAlbum, self).__init__()
     self.mconfig = mconfig     # config section
     self.oconfig = oconfig     # this specific output
     self.sanitize = FILENAME_SANITIZERS[oconfig['sanitize_paths']]
     self.path = self.albumPath(metadata)
+    self.staging_path = self.stagingPath()
     self.artwork = []
     self.dirty = False  # media has changed; need to re-run r128gain
-    self.signature = Signature(self.path, mconfig, oconfig, metadata)
+    self.snapshot = DirSnapshot(self.path)
+    self.signature = Signature(
+      self.path, mconfig, oconfig, metadata,
+      snapshot=self.snapshot, source_snapshot=source_snapshot
+    )
     self.contents = []  # all *filenames* this dir should contain
+    self.sources = {}   # audio output filename -> source path
 
   def albumPath(self, metadata):
     """ Return the output path for this album """
-    tconf = self.mconfig['target']
-    try:
-      album_dir = Path(tconf['album_dir'].format(**metadata))
-    except KeyError:
-      raise MetadataError("Failed to interpolate template '{}' with metadata: {}".format(
-        tconf['album_dir'], metadata
-      ))
-    return Path(self.oconfig['path']) / self.sanitize(album_dir)
+    return album_path(self.mconfig, self.oconfig, metadata)
+
+  def stagingPath(self):
+    """ Return the path encodes for this album are staged in, or None if the
+        output doesn't use staging """
+    staging_root = self.oconfig.staging_path
+    if staging_root is None:
+      return None
+    return staging_root / self.path.relative_to(self.oconfig['path'])
 
   @property
   def output_name(self):
@@ -84,33 +300,57 @@ class OutputAlbum(object):
   def isFilterAllowed(self, potential):
     """ Return True if potential is allowed by filters, False otherwise.
         Include filter takes priority.  """
-    f_include = self.oconfig['filters']['include']
-    if f_include and not filename_matches_globs(potential, f_include):
+    potential_s = potential.as_posix()
+    f_include = self.oconfig.filters_include
+    if f_include is not None and not f_include.search(potential_s):
       return False
-    f_exclude = self.oconfig['filters']['exclude']
-    if f_exclude and filename_matches_globs(potential, f_exclude):
+    f_exclude = self.oconfig.filters_exclude
+    if f_exclude is not None and f_exclude.search(potential_s):
       return False
     return True
 
   def prepare(self, verbose=True):
-    """ Prepare the output album for writing """
+    """ Prepare the output album for writing.  Any parent dirs created along
+        the way, e.g. for a new artist, get permissions too.  """
     if verbose:
       puts("Creating output dir {}".format(self.path))
+    root = Path(self.oconfig['path'])
+    created = [self.path] + [
+      p for p in self.path.parents if p != root and root in p.parents
+      and not p.exists()
+    ]
     self.path.mkdir(parents=True, exist_ok=True)
+    for p in created:
+      self.fixPermissions(p, is_dir=True)
+    if self.staging_path is not None:
+      self.staging_path.mkdir(parents=True, exist_ok=True)
 
-  def finalize(self, verbose=True):
+  def finalize(self, verbose=True, r128gain_batch=None):
     """ If we've made any changes to the output dir finalize the album by
-        adding artwork and signature + running r128gain """
+        adding artwork and signature + running r128gain.  If an R128gainBatch
+        is supplied, and batching is configured, r128gain and saving the
+        signature are left to it.  """
+    if self.dirty and not self.path.is_dir():
+      puts(colored.red("Output dir {} has gone; not finalizing it".format(
+        self.path
+      )))
+      self.dirty = False
     if self.dirty:
       if verbose:
         puts("Finalizing for output '{}' @ {}".format(self.output_name, self.path))
+      self.snapshot.refresh()   # ffmpeg has been busy
       with indent(2):
         self.copyArtwork(verbose=verbose)
         self.removeOrphans(verbose=verbose)
         self.signature.clean(verbose=verbose)
-        self.r128gain(verbose=verbose)
-        self.signature.save(verbose=verbose)
+        if r128gain_batch is not None and self.r128gainBatchSize() > 1:
+          r128gain_batch.add(self)
+        else:
+          self.r128gain(verbose=verbose)
+          self.signature.save(verbose=verbose)
         self.dirty = False
+    if self.staging_path is not None:
+      shutil.rmtree(str(self.staging_path), ignore_errors=True)
 
   def copyArtwork(self, verbose=True):
     """ Clone a file (typically artwork) into the album dir.  This is a simple
@@ -127,6 +367,8 @@ class OutputAlbum(object):
             puts("Copying '{}'".format(source_path.name))
           output_path = self.path / source_path.name
           shutil.copy(str(source_path), str(output_path))
+          self.written(output_path)
+          self.snapshot.add(output_path.name)
           self.signature.add(output_path.name, source_path, codec=None)
 
   def removeOrphans(self, verbose=True):
@@ -135,38 +377,109 @@ class OutputAlbum(object):
     if verbose:
       puts("Removing orphaned files from {}...".format(self.output_name))
     with indent(2):
-      for p in self.path.iterdir():
-        if p.is_file() and p.name != Signature.SIGNATURE_FILE_NAME:
-          if p.name not in self.contents:
-            if verbose:
-              puts(colored.red("Removing orphan '{}'".format(p)))
-            p.unlink()
+      for name in self.snapshot.files():
+        if name != Signature.SIGNATURE_FILE_NAME and name not in self.contents:
+          p = self.path / name
+          if verbose:
+            puts(colored.red("Removing orphan '{}'".format(p)))
+          p.unlink()
+          self.snapshot.discard(name)
+
+  def written(self, path):
+    """ Call when file `path` has been written to the output dir """
+    METRICS.inc(
+      'output_bytes_written_total', path.stat().st_size,
+      output=self.output_name
+    )
+    self.fixPermissions(path)
+
+  def fixPermissions(self, path, is_dir=False):
+    """ If the output wants permissions applied inline, as each file is
+        written, fix those of `path` """
+    oconf = self.oconfig
+    if not oconf['permissions']['inline']:
+      return
+    fix_permissions(
+      path,
+      mode=oconf.permissions_dir_mode if is_dir else oconf.permissions_file_mode,
+      uid=oconf.permissions_uid, gid=oconf.permissions_gid
+    )
+
+  def r128gainEnabled(self):
+    """ Return True if r128gain should be run over this album """
+    return self.mconfig['r128gain']['type'] not in (None, False, 'null')
+
+  def r128gainBatchSize(self):
+    """ Return the number of albums r128gain may process in one run, or 0 if
+        it is disabled """
+    if not self.r128gainEnabled():
+      return 0
+    elif self.mconfig['r128gain']['mode'] == 'cache':
+      return 1    # no r128gain process to share
+    return self.mconfig['r128gain']['batch']
+
+  def r128gainSettings(self):
+    """ Return a dict of the R128gainWrapper args we want, other than the
+        dir(s) to process """
+    rconf = self.mconfig['r128gain']
+    tconf = self.mconfig['transcoding']
+    return {
+      'album_gain': rconf['type'] == 'album',
+      'threads': rconf['threads'],
+      'ffmpeg_binary': rconf['ffmpeg_path'] or tconf['ffmpeg_path'],
+      'binary': rconf['r128gain_path'],
+      'priority': self.mconfig.process_priority
+    }
 
   def r128gain(self, verbose=True):
     """ Run r128gain over the output dir """
     rconf = self.mconfig['r128gain']
-    tconf = self.mconfig['transcoding']
-    if rconf['type'] in (None, False, 'null'):
+    if not self.r128gainEnabled():
       if verbose:
         puts("r128gain disabled for this album")
       return
-    r128 = R128gainWrapper(
-      target_dir=self.path,
-      album_gain=rconf['type'] == 'album',
-      threads=rconf['threads'],
-      ffmpeg_binary=rconf['ffmpeg_path'] or tconf['ffmpeg_path'],
-      binary=rconf['r128gain_path']
-    )
+    with METRICS.timer('r128gain_seconds_total'):
+      if rconf['mode'] == 'cache':
+        self.applyLoudness(verbose=verbose)
+        return
+      r128 = R128gainWrapper(target_dir=self.path, **self.r128gainSettings())
+      if verbose:
+        puts("Running r128gain for output {} ({} mode)...".format(
+          self.output_name, rconf['type'])
+        )
+      r128.run(output=False)
+
+  def applyLoudness(self, verbose=True):
+    """ Tag every audio file in the output dir with gains derived from the
+        loudness of its source, as measured by the shared LoudnessCache.  Only
+        sources it hasn't seen before are analysed.  """
+    rconf = self.mconfig['r128gain']
+    tconf = self.mconfig['transcoding']
+    if OutputAlbum.loudness_cache is None:
+      OutputAlbum.loudness_cache = LoudnessCache(load=False)
     if verbose:
-      puts("Running r128gain for output {} ({} mode)...".format(
+      puts("Applying cached loudness for output {} ({} mode)...".format(
         self.output_name, rconf['type'])
       )
-    r128.run(output=False)
+    names = sorted(self.sources)
+    tracks = OutputAlbum.loudness_cache.measureAll(
+      [self.sources[n] for n in names],
+      threads=rconf['threads'] or tconf['threads'],
+      ffmpeg_binary=rconf['ffmpeg_path'] or tconf['ffmpeg_path'],
+      priority=self.mconfig.process_priority
+    )
+    album = None
+    if rconf['type'] == 'album' and tracks:
+      album = (integrated_loudness(tracks), max(t.peak for t in tracks))
+    for name, track in zip(names, tracks):
+      write_gain_tags(self.path / name, track, album)
 
-  def incorporate(self, source_path, ffmpeg):
+  def incorporate(self, source_path, ffmpeg, probe=None):
     """ Given Path `source_path`, if it is wanted in our output add it to the
         encoding job wrapped by `ffmpeg`.  Metadata isn't required as `ffmpeg`
-        already has it.  """
+        already has it.  If the source has been probed, pass its ProbeResult
+        as `probe` so the decision to transcode can be based on its real codec
+        rather than its extension.  """
     sig = self.signature
     ext = source_path.suffix.lstrip('.').lower()
     if ext in IMAGE_FORMATS:            # clone artwork later
@@ -178,10 +491,14 @@ class OutputAlbum(object):
     if not self.isFilterAllowed(source_path):  # audio not wanted; quit early
       return
 
+    if probe is None:
+      lossless = ext in AUDIO_FORMATS_LOSSLESS
+    else:
+      lossless = probe.lossless   # e.g. alac in an .m4a
     desired = self.oconfig['formats'][0]
     if ext in self.oconfig['formats'] or desired == 'copy':
       handler_class = OutputHandlerCopy
-    elif ext in AUDIO_FORMATS_LOSSLESS:
+    elif lossless:
       try:
         handler_class = FORMAT_HANDLERS[desired]
       except KeyError:
@@ -190,14 +507,22 @@ class OutputAlbum(object):
       return  # unsupported format for this media; skip it
 
     # If we reach this point we know how to transcode the media
-    h = handler_class(source_path, self.path, self.oconfig, self.sanitize)
+    h = handler_class(
+      source_path, self.staging_path or self.path, self.oconfig, self.sanitize
+    )
     self.contents.append(h.output_name)
+    self.sources[h.output_name] = source_path
     if sig.is_valid(h.output_name, source_path, h.FILE_EXTENSION):
       pass # present and correct
     else:
       h.addToFFmpeg(ffmpeg)
-      # It is confusing to add to the signature before ffmpeg has created the
-      # output.  Refactor with queued operation objects so we can trigger it
-      # as part of a later finalize()
-      sig.add(h.output_name, source_path, h.FILE_EXTENSION)
+      final_path = self.path / h.output_name
+      if self.staging_path is not None:
+        ffmpeg.stage(h.output_path, final_path)
+      def complete():
+        self.written(final_path)
+        sig.add(h.output_name, source_path, h.FILE_EXTENSION)
+      # Signed only once written, so a failed job is redone next run
+      ffmpeg.onComplete(h.output_path, complete)
+      ffmpeg.onAbandon(h.output_path, lambda: sig.discard(h.output_name))
       self.dirty = True
@@ -0,0 +1,179 @@
+""" Export of the transcoding plan as a build file, so the work can be run by
+    ninja, make or any other executor instead of Bulklift's own scheduler """
+
+import re
+import shlex
+import time
+
+
+def job_command(job):
+  """ Return a shell command running FFmpegWrapper `job`: make its output
+      dirs, run ffmpeg and move any staged outputs into place """
+  dirs = sorted(set(
+    str(p.parent) for p in list(job.expected_outputs) + list(job.destinations.values())
+  ))
+  steps = [['mkdir', '-p'] + dirs, list(job.args)]
+  for output_path, destination in job.destinations.items():
+    steps.append(['mv', '-f', str(output_path), str(destination)])
+  return ' && '.join(' '.join(shlex.quote(a) for a in s) for s in steps)
+
+
+def job_targets(job):
+  """ Return the final paths of the files `job` writes """
+  return [job.destinations.get(p, p) for p in job.expected_outputs]
+
+
+class PlanEmitter(object):
+  """ Base for writers of a plan.  Each pending job becomes a step whose
+      targets are the files it writes and whose input is its source.  Each
+      album gets an aggregate step, run once all of its jobs are done, which
+      has Bulklift sign the new files, copy artwork and run r128gain.  """
+
+  def __init__(self, stream, finalize_command):
+    """ Initialize the emitter to write to `stream`.  `finalize_command` is
+        the argv to run `bulklift finalize`, minus the album dir.  """
+    super(PlanEmitter, self).__init__()
+    self.stream = stream
+    self.since = int(time.time())
+    self.finalize_command = list(finalize_command) + ['--since', str(self.since)]
+    self.albums = []      # names of aggregate steps written so far
+    self.finalizing = []  # their commands, for emitters that run them last
+
+  def write(self, text=''):
+    self.stream.write(text + '\n')
+
+  def begin(self):
+    """ Write anything needed before the first step """
+
+  def album(self, ia, jobs):
+    """ Write the steps for InputAlbum `ia`, whose pending work is the list
+        of FFmpegWrappers `jobs` """
+    targets = []
+    for job in jobs:
+      self.job(job)
+      targets += job_targets(job)
+    name = 'album-{:05d}'.format(len(self.albums) + 1)
+    self.albums.append(name)
+    self.finalize(name, self.finalize_command + [str(ia.path)], targets)
+
+  def job(self, job):
+    """ Write the step for FFmpegWrapper `job` """
+    raise NotImplementedError()
+
+  def finalize(self, name, argv, targets):
+    """ Write aggregate step `name`, running `argv` once `targets` exist """
+    raise NotImplementedError()
+
+  def end(self):
+    """ Write anything needed after the last step """
+
+
+class NinjaPlanEmitter(PlanEmitter):
+  """ Write the plan as a build.ninja """
+
+  @staticmethod
+  def escapePath(path):
+    return re.sub(r'([$ :\n])', r'$\1', str(path))
+
+  @staticmethod
+  def escape(text):
+    return text.replace('$', '$$')
+
+  def begin(self):
+    self.write("# Written by `bulklift plan`; run with `ninja -f FILE`")
+    self.write("rule ffmpeg")
+    self.write("  command = $cmd")
+    self.write("  description = ffmpeg $in")
+    self.write("rule finalize")
+    self.write("  command = $cmd")
+    self.write("  description = finalize $album")
+    self.write()
+
+  def job(self, job):
+    self.write("build {}: ffmpeg {}".format(
+      ' '.join(map(self.escapePath, job_targets(job))),
+      self.escapePath(job.source_path)
+    ))
+    self.write("  cmd = {}".format(self.escape(job_command(job))))
+
+  def finalize(self, name, argv, targets):
+    self.write("build {}: finalize {}".format(
+      name, ' '.join(map(self.escapePath, targets))
+    ))
+    self.write("  cmd = {}".format(
+      self.escape(' '.join(shlex.quote(a) for a in argv))
+    ))
+    self.write("  album = {}".format(self.escape(argv[-1])))
+    self.write()
+
+  def end(self):
+    if self.albums:
+      self.write("default {}".format(' '.join(self.albums)))
+
+
+class MakePlanEmitter(PlanEmitter):
+  """ Write the plan as a GNU Makefile.  Jobs with several outputs use
+      grouped targets, so need make 4.3 or later.  Outputs that already
+      exist, e.g. from before a change to the manifest, are redone whatever
+      their age.  """
+
+  @staticmethod
+  def escapePath(path):
+    return re.sub(r'([ :#%\\])', r'\\\1', str(path)).replace('$', '$$')
+
+  @staticmethod
+  def escape(text):
+    return text.replace('$', '$$')
+
+  def begin(self):
+    self.write("# Written by `bulklift plan`; run with `make -f FILE -j N`")
+    self.write(".DELETE_ON_ERROR:")
+    self.write(".PHONY: all FORCE")
+    self.write("all:")
+    self.write("FORCE:")
+    self.write()
+
+  def job(self, job):
+    targets = job_targets(job)
+    force = ' FORCE' if any(p.exists() for p in targets) else ''
+    self.write("{} {} {}{}".format(
+      ' '.join(map(self.escapePath, targets)),
+      '&:' if len(targets) > 1 else ':',
+      self.escapePath(job.source_path), force
+    ))
+    self.write("\t{}".format(self.escape(job_command(job))))
+
+  def finalize(self, name, argv, targets):
+    self.write(".PHONY: {}".format(name))
+    self.write("all: {}".format(name))
+    self.write("{}: {}".format(name, ' '.join(map(self.escapePath, targets))))
+    self.write("\t{}".format(self.escape(' '.join(shlex.quote(a) for a in argv))))
+    self.write()
+
+
+class ShellPlanEmitter(PlanEmitter):
+  """ Write the plan as a shell script that runs every job in turn, then
+      finalizes the albums.  The job lines may be fed to e.g. GNU parallel
+      instead.  """
+
+  def begin(self):
+    self.write("#!/bin/sh")
+    self.write("# Written by `bulklift plan`")
+    self.write("set -e")
+
+  def job(self, job):
+    self.write(job_command(job))
+
+  def finalize(self, name, argv, targets):
+    self.finalizing.append(' '.join(shlex.quote(a) for a in argv))
+
+  def end(self):
+    for line in self.finalizing:
+      self.write(line)
+
+
+PLAN_EMITTERS = {
+  'ninja': NinjaPlanEmitter,
+  'make': MakePlanEmitter,
+  'shell': ShellPlanEmitter
+}
@@ -0,0 +1,138 @@
+""" Read-ahead of source files for upcoming transcoding jobs """
+
+import os
+import shutil
+import tempfile
+import threading
+from hashlib import sha256
+from itertools import islice
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher(object):
+  """ Warm up the sources of queued jobs while earlier ones are encoding.
+      Prefetches run one file at a time on a single background thread so a
+      networked or spinning disk sees large sequential reads, not the
+      interleaved random ones of many ffmpegs.  There are two modes:
+
+      - `fadvise` asks the kernel to read the whole file into its page cache
+      - `copy` copies the file to a local scratch dir and points ffmpeg at it
+
+      A file is only prefetched if it fits within `budget` bytes alongside the
+      others in flight.  Its share is given back once every job using the
+      source has finished.  """
+
+  MODES = ('fadvise', 'copy')
+
+  READ_CHUNK_SIZE = 1024 * 1024
+
+  def __init__(self, depth, mode='fadvise', budget=None, scratch_dir=None):
+    """ Initialize a Prefetcher to look `depth` jobs ahead """
+    super(Prefetcher, self).__init__()
+    if mode not in self.MODES:
+      raise ValueError("Unknown prefetch mode '{}'".format(mode))
+    self.depth = depth
+    self.mode = mode
+    self.budget = budget
+    if scratch_dir is None:
+      scratch_dir = Path(tempfile.gettempdir()) / 'bulklift-prefetch'
+    self.scratch_dir = Path(scratch_dir)
+    self.lock = threading.Lock()
+    self.reserved = 0     # bytes promised to prefetches in flight
+    self.fetches = {}     # source path -> (size, Future for the prefetch)
+    self.users = {}       # source path -> number of jobs running from it
+    self.pool = ThreadPoolExecutor(max_workers=1)
+
+  def prefetch(self, jobs):
+    """ Start prefetching sources for the first `depth` of `jobs`, which are
+        the next ones due to run.  Stops at the first that won't fit the
+        budget so prefetches stay in queue order. """
+    with self.lock:
+      for job in islice(jobs, self.depth):
+        source = job.source_path
+        if source in self.fetches:
+          continue
+        try:
+          size = source.stat().st_size
+        except OSError:
+          continue    # ffmpeg can report on it later
+        if self.budget is not None and self.reserved + size > self.budget:
+          break
+        self.reserved += size
+        self.fetches[source] = (size, self.pool.submit(self._fetch, source))
+
+  def _fetch(self, source):
+    """ Prefetch a single source.  Returns the path of a local copy if one
+        was made, or None.  """
+    if self.mode == 'copy':
+      self.scratch_dir.mkdir(parents=True, exist_ok=True)
+      local = self.scratch_dir / (
+        sha256(bytes(str(source), encoding='utf8')).hexdigest()[:16]
+        + source.suffix
+      )
+      shutil.copyfile(str(source), str(local))
+      return local
+    with source.open('rb') as stream:
+      if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(stream.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+      else:   # no fadvise on this platform; read it to warm the cache
+        while stream.read(self.READ_CHUNK_SIZE):
+          pass
+    return None
+
+  def claim(self, job):
+    """ Call when `job` is about to run.  If its source has been copied
+        locally the job is pointed at the copy, waiting for the copy to
+        complete if it is still in progress.  """
+    with self.lock:
+      try:
+        size, future = self.fetches[job.source_path]
+      except KeyError:
+        return
+      self.users[job.source_path] = self.users.get(job.source_path, 0) + 1
+    try:
+      local = future.result()
+    except OSError:
+      return    # fall back to reading the original
+    if local is not None:
+      job.retarget(local)
+
+  def release(self, job, pending):
+    """ Call when `job` has finished.  Frees whatever was prefetched for its
+        source unless another running job or one of `pending` still needs
+        it.  """
+    source = job.source_path
+    with self.lock:
+      if source not in self.fetches:
+        return
+      users = self.users.get(source, 1) - 1
+      self.users[source] = users
+      if users > 0 or any(j.source_path == source for j in pending):
+        return
+      del self.users[source]
+      size, future = self.fetches.pop(source)
+      self.reserved -= size
+    self._discard(future)
+
+  def _discard(self, future):
+    """ Remove any local copy made by the prefetch in `future` """
+    try:
+      local = future.result()
+    except OSError:
+      return
+    if local is not None:
+      try:
+        local.unlink()
+      except FileNotFoundError:
+        pass
+
+  def shutdown(self):
+    """ Wait for outstanding prefetches and remove any copies left over """
+    self.pool.shutdown()
+    with self.lock:
+      for size, future in self.fetches.values():
+        self._discard(future)
+      self.fetches.clear()
+      self.users.clear()
+      self.reserved = 0
@@ -0,0 +1,176 @@
+""" CPU & IO scheduling of the external processes we start, so a run can use
+    every core without hurting the latency of other services on the host """
+
+import ctypes
+import os
+import platform
+from collections import namedtuple
+
+try:
+  import resource
+except ImportError:   # not on Windows
+  resource = None
+
+
+# ioprio_set() has no wrapper in libc or the os module, so call it by number
+IOPRIO_SET_SYSCALLS = {
+  'x86_64': 251,
+  'i386': 289,
+  'i686': 289,
+  'aarch64': 30,
+  'armv7l': 314,
+  'armv6l': 314,
+  'ppc64le': 273,
+  'riscv64': 30
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+SCHED_POLICIES = {
+  'other': getattr(os, 'SCHED_OTHER', None),
+  'batch': getattr(os, 'SCHED_BATCH', None),
+  'idle': getattr(os, 'SCHED_IDLE', None)
+}
+
+
+def parse_cpu_list(spec):
+  """ Return a frozenset of the cpus in `spec`, either a list of numbers or a
+      string in the style of taskset -c, e.g. '0,2-5' """
+  if isinstance(spec, int):
+    return frozenset([spec])
+  elif not isinstance(spec, str):
+    return frozenset(int(c) for c in spec)
+  cpus = set()
+  for part in spec.split(','):
+    first, sep, last = part.strip().partition('-')
+    if sep:
+      cpus.update(range(int(first), int(last) + 1))
+    else:
+      cpus.add(int(first))
+  return frozenset(cpus)
+
+
+def lowest_nice():
+  """ Return the lowest niceness this process may give its children.  Without
+      root that is the current niceness, or lower if RLIMIT_NICE allows.  """
+  if os.geteuid() == 0:
+    return -20
+  current = os.getpriority(os.PRIO_PROCESS, 0)
+  try:
+    limit = resource.getrlimit(resource.RLIMIT_NICE)[0]
+  except (AttributeError, ValueError, OSError):
+    return current
+  if limit == resource.RLIM_INFINITY:
+    return -20
+  return min(current, 20 - limit)
+
+
+def _ioprio_set_func():
+  """ Return a function that sets the IO priority of the calling thread, or
+      None if we don't know the syscall number for this platform """
+  number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+  if number is None:
+    return None
+  syscall = ctypes.CDLL(None, use_errno=True).syscall
+  def ioprio_set(ioclass, level):
+    prio = (ioclass << IOPRIO_CLASS_SHIFT) | level
+    if syscall(number, IOPRIO_WHO_PROCESS, 0, prio) != 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno))
+  return ioprio_set
+
+# Looked up now; apply() runs between fork & exec, where loading is unsafe
+ioprio_set = _ioprio_set_func() if platform.system() == 'Linux' else None
+
+
+class ProcessPriority(namedtuple('ProcessPriority', [
+    'nice', 'ionice_class', 'ionice_level', 'sched_policy', 'cpus'])):
+  """ Scheduling settings for a child process.  `ionice_class` and
+      `sched_policy` are names from IOPRIO_CLASSES and SCHED_POLICIES; `cpus`
+      is a frozenset of cpus to pin the process to.  Any may be None to leave
+      that setting as inherited.  Hashable, so it can form part of the
+      settings r128gain jobs are batched by.  """
+
+  __slots__ = ()
+
+  @classmethod
+  def fromConfig(cls, pconf):
+    """ Return a ProcessPriority for the `priority` section of a transcoding
+        config, or None if it sets nothing.  Raises ValueError for settings
+        this host can't apply.  """
+    if all(v is None for v in pconf.values()):
+      return None
+    priority = cls(
+      nice=pconf['nice'],
+      ionice_class=pconf['ionice_class'],
+      ionice_level=pconf['ionice_level'],
+      sched_policy=pconf['sched_policy'],
+      cpus=None if pconf['cpus'] is None else parse_cpu_list(pconf['cpus'])
+    )
+    priority.validate()
+    return priority
+
+  def validate(self):
+    """ Raise ValueError if any of our settings are invalid """
+    if self.nice is not None and not -20 <= self.nice <= 19:
+      raise ValueError("nice must be between -20 and 19, not {}".format(
+        self.nice
+      ))
+    if self.nice is not None and self.nice < lowest_nice():
+      raise ValueError(
+        "nice {} is lower than this process may set; use {} or higher".format(
+          self.nice, lowest_nice()
+        )
+      )
+    if self.ionice_class is not None or self.ionice_level is not None:
+      if self.ionice_class not in IOPRIO_CLASSES:
+        raise ValueError("ionice_class must be one of {}, not '{}'".format(
+          ', '.join(IOPRIO_CLASSES), self.ionice_class
+        ))
+      if self.ionice_level not in (None,) + tuple(range(0, 8)):
+        raise ValueError("ionice_level must be 0-7, not '{}'".format(
+          self.ionice_level
+        ))
+      if self.ionice_class == 'realtime' and os.geteuid() != 0:
+        raise ValueError("ionice_class realtime needs root")
+      if ioprio_set is None:
+        raise ValueError("ionice isn't supported on {} {}".format(
+          platform.system(), platform.machine()
+        ))
+    if self.sched_policy is not None \
+       and SCHED_POLICIES.get(self.sched_policy) is None:
+      raise ValueError("sched_policy '{}' isn't supported; choose from {}".format(
+        self.sched_policy,
+        ', '.join(k for k, v in SCHED_POLICIES.items() if v is not None)
+      ))
+    if self.cpus is not None:
+      if not hasattr(os, 'sched_setaffinity'):
+        raise ValueError("cpus can't be set on {}".format(platform.system()))
+      unknown = self.cpus - os.sched_getaffinity(0)
+      if not self.cpus or unknown:
+        raise ValueError("cpus {} aren't available to this process".format(
+          ','.join(map(str, sorted(unknown))) or '(none)'
+        ))
+
+  def apply(self):
+    """ Apply our settings to the current process.  Passed to subprocess as
+        `preexec_fn`, so runs in the child between fork & exec, before ffmpeg
+        starts any threads of its own to inherit them.  Python documents
+        `preexec_fn` as unsafe when threads are running, and we run commands
+        from ThreadPoolExecutor workers: only the forking thread exists in the
+        child, so a lock another thread held at fork stays held.  Hence keep
+        it to plain syscalls that take no locks; ioprio_set is looked up in
+        advance for that reason.  Anything that could fail here, e.g. EPERM,
+        must be caught by validate() first, or every command fails.  """
+    if self.cpus is not None:
+      os.sched_setaffinity(0, self.cpus)
+    if self.sched_policy is not None:
+      os.sched_setscheduler(
+        0, SCHED_POLICIES[self.sched_policy], os.sched_param(0)
+      )
+    if self.nice is not None:
+      os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+    if self.ionice_class is not None:
+      level = 0 if self.ionice_level is None else self.ionice_level
+      ioprio_set(IOPRIO_CLASSES[self.ionice_class], level)
@@ -0,0 +1,95 @@
+""" Probing of source media for its real stream properties, cached between runs
+    so a library need only be probed once """
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import mutagen
+
+from util.file import SourceFileCache
+
+
+# Codec names we report for each mutagen file type, other than MP4
+MUTAGEN_CODECS = {
+  'FLAC': 'flac',
+  'OggFLAC': 'flac',
+  'MP3': 'mp3',
+  'EasyMP3': 'mp3',
+  'OggOpus': 'opus',
+  'OggVorbis': 'vorbis',
+  'WAVE': 'pcm',
+  'AIFF': 'pcm',
+  'MonkeysAudio': 'ape',
+  'WavPack': 'wavpack',
+  'TrueAudio': 'tta',
+  'ASF': 'wma'
+}
+
+LOSSLESS_CODECS = frozenset(['flac', 'alac', 'pcm', 'ape', 'wavpack', 'tta'])
+
+
+class ProbeResult(namedtuple('ProbeResult', [
+    'codec', 'duration', 'sample_rate', 'channels', 'bits'])):
+  """ Stream properties of a single audio file.  `duration` is in seconds;
+      `bits` is the bit depth, or None for lossy codecs.  """
+
+  __slots__ = ()
+
+  @property
+  def lossless(self):
+    return self.codec in LOSSLESS_CODECS
+
+
+# Stored for files mutagen can't read, so we don't retry them every run
+UNKNOWN = ProbeResult(None, None, None, None, None)
+
+
+def probe_file(path):
+  """ Return a ProbeResult for the audio file at `path`, or UNKNOWN if it
+      can't be read """
+  try:
+    f = mutagen.File(str(path))
+  except (mutagen.MutagenError, OSError):
+    return UNKNOWN
+  if f is None:
+    return UNKNOWN
+  info = f.info
+  kind = type(f).__name__
+  if kind in ('MP4', 'EasyMP4'):
+    codec = getattr(info, 'codec', '')
+    codec = 'aac' if codec.startswith('mp4a') else codec
+  else:
+    codec = MUTAGEN_CODECS.get(kind, kind.lower())
+  return ProbeResult(
+    codec=codec,
+    duration=getattr(info, 'length', None),
+    sample_rate=getattr(info, 'sample_rate', None),
+    channels=getattr(info, 'channels', None),
+    bits=getattr(info, 'bits_per_sample', None) or None
+  )
+
+
+class ProbeIndex(SourceFileCache):
+  """ On-disk index of the stream properties of source files.  Files are
+      probed in parallel, and only when new or changed.  """
+
+  CACHE_FILE_NAME = 'probes.pickle'
+
+  def probe(self, path, st=None):
+    """ Return the ProbeResult for `path`, probing it if need be, or None if
+        it can't be read """
+    result = self.get(path, st)
+    if result is None:
+      fingerprint = self.fingerprint(path, st)
+      result = probe_file(path)
+      self.put(path, result, fingerprint)
+    return None if result.codec is None else result
+
+  def probeAll(self, paths, threads=None, stat=None):
+    """ Return a dict of path -> ProbeResult (or None) for `paths`, probing any
+        we don't know over `threads` threads.  `stat` is an optional function
+        returning the stat() result for a path, e.g. DirSnapshot.stat_path.  """
+    def probe(path):
+      return self.probe(path, None if stat is None else stat(path))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+      return dict(zip(paths, pool.map(probe, paths)))
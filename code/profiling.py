@@ -0,0 +1,95 @@
+""" Profiling of the Python side of a run, phase by phase """
+
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class PhaseProfiler(object):
+  """ Collect cProfile stats and the tracemalloc peak separately for each phase
+      of a run, as marked out by METRICS.phase().  cProfile only sees the
+      thread it was enabled in, so every thread entering a phase gets its own
+      profile; they are merged when written.  Memory peaks are attributed to
+      whichever phase ends next, so are approximate while phases overlap in
+      different threads.  """
+
+  def __init__(self, out_dir, top=15):
+    """ Initialize the profiler to write its results to `out_dir` """
+    super(PhaseProfiler, self).__init__()
+    self.out_dir = Path(out_dir)
+    self.top = top
+    self.lock = threading.Lock()
+    self.profiles = {}      # (phase, thread id) -> cProfile.Profile
+    self.memory_peaks = {}  # phase -> peak bytes traced
+
+  def start(self):
+    """ Start tracing memory allocations """
+    tracemalloc.start()
+
+  @contextmanager
+  def profile(self, phase):
+    """ Context manager profiling the code within it as part of `phase` """
+    key = (phase, threading.get_ident())
+    with self.lock:
+      prof = self.profiles.setdefault(key, cProfile.Profile())
+    try:
+      prof.enable()
+    except ValueError:    # another profiler is active in this thread
+      prof = None
+    try:
+      yield
+    finally:
+      if prof is not None:
+        prof.disable()
+      current, peak = tracemalloc.get_traced_memory()
+      tracemalloc.reset_peak()
+      with self.lock:
+        self.memory_peaks[phase] = max(self.memory_peaks.get(phase, 0), peak)
+
+  def stats(self, phase):
+    """ Return a pstats.Stats merging every thread's profile of `phase` """
+    stats = None
+    for (p, ident), prof in self.profiles.items():
+      if p != phase:
+        continue
+      if stats is None:
+        stats = pstats.Stats(prof)
+      else:
+        stats.add(prof)
+    return stats
+
+  def summary(self, phase, stats):
+    """ Return lines summarising the `top` functions of `phase` by their
+        internal time """
+    lines = ["{}: {:.3f}s profiled, peak traced memory {:.1f} MiB".format(
+      phase, stats.total_tt, self.memory_peaks.get(phase, 0) / 1024**2
+    )]
+    lines.append("  {:>10} {:>10} {:>10}  {}".format(
+      'ncalls', 'tottime', 'cumtime', 'function'
+    ))
+    rows = sorted(stats.stats.items(), key=lambda i: i[1][2], reverse=True)
+    for (filename, line, func), (cc, nc, tt, ct, callers) in rows[:self.top]:
+      lines.append("  {:>10} {:>10.3f} {:>10.3f}  {}:{}({})".format(
+        nc, tt, ct, Path(filename).name, line, func
+      ))
+    return lines
+
+  def finish(self):
+    """ Stop tracing, write a .pstats file per phase plus a summary of them
+        all, and return the summary text """
+    tracemalloc.stop()
+    self.out_dir.mkdir(parents=True, exist_ok=True)
+    lines = []
+    with self.lock:
+      phases = sorted(set(phase for phase, ident in self.profiles))
+      for phase in phases:
+        stats = self.stats(phase)
+        stats.dump_stats(str(self.out_dir / '{}.pstats'.format(phase)))
+        lines += self.summary(phase, stats) + ['']
+    text = '\n'.join(lines)
+    with (self.out_dir / 'summary.txt').open('w', encoding='utf8') as stream:
+      stream.write(text)
+    return text
@@ -0,0 +1,97 @@
+""" Quarantine of source files whose transcoding failed, so a bad file isn't
+    retried every run until it changes """
+
+import os
+import subprocess as sp
+
+from util.file import SourceFileCache
+from wrappers import ExternalCommandError
+
+
+def failure_reason(e):
+  """ Return a one-line description of exception `e` from a failed job """
+  if isinstance(e, sp.TimeoutExpired):
+    return "timed out after {:.0f}s".format(e.timeout)
+  elif isinstance(e, sp.CalledProcessError):
+    stderr = (e.stderr or b'').decode('utf8', 'replace').strip().splitlines()
+    return "exited with status {}{}".format(
+      e.returncode, ': ' + stderr[-1] if stderr else ''
+    )
+  return "{}: {}".format(type(e).__name__, e)
+
+
+# Messages from ffmpeg meaning it couldn't write, rather than read
+OUTPUT_ERRORS = (
+  'Error opening output', 'No space left on device', 'Read-only file system'
+)
+
+# Free space below which a failure is blamed on a full output device
+OUTPUT_MIN_FREE = 1024 * 1024
+
+
+def output_failed(output_paths):
+  """ Return True if any of the dirs `output_paths` are written to is
+      missing, unwritable or full """
+  for d in set(p.parent for p in output_paths):
+    if not os.access(str(d), os.W_OK):
+      return True
+    try:
+      st = os.statvfs(str(d))
+    except (AttributeError, OSError):
+      continue
+    if st.f_bavail * st.f_frsize < OUTPUT_MIN_FREE:
+      return True
+  return False
+
+
+def is_source_failure(e, output_paths=()):
+  """ Return True if exception `e` means the transcoder failed on its source,
+      rather than e.g. the device it was writing `output_paths` to being full
+      or unplugged """
+  if not isinstance(
+    e, (sp.TimeoutExpired, sp.CalledProcessError, ExternalCommandError)
+  ):
+    return False
+  if isinstance(e, sp.CalledProcessError):
+    stderr = (e.stderr or b'').decode('utf8', 'replace')
+    if any(m in stderr for m in OUTPUT_ERRORS):
+      return False
+  return not output_failed(output_paths)
+
+
+class Quarantine(SourceFileCache):
+  """ On-disk record of source files that failed to transcode, with the
+      reason.  A file stays quarantined until it changes or is released.  """
+
+  CACHE_FILE_NAME = 'quarantine.pickle'
+
+  def add(self, source_path, reason):
+    """ Quarantine `source_path` for `reason` """
+    try:
+      self.put(source_path, reason)
+    except FileNotFoundError:
+      pass    # it went away; nothing to remember
+
+  def reason(self, source_path, st=None):
+    """ Return why `source_path` is quarantined, or None if it isn't """
+    try:
+      return self.get(source_path, st)
+    except FileNotFoundError:
+      return None
+
+  def release(self, source_path=None):
+    """ Release `source_path` from quarantine, or every file if None """
+    with self.lock:
+      if source_path is None:
+        self.dirty = self.dirty or bool(self.entries)
+        self.entries.clear()
+      elif self.entries.pop(str(source_path), None) is not None:
+        self.dirty = True
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __iter__(self):
+    """ Yield (source path, reason) for every quarantined file """
+    for path, (fingerprint, reason) in sorted(self.entries.items()):
+      yield (path, reason)
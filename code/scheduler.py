@@ -0,0 +1,243 @@
+""" Scheduling of transcoding jobs over a pool of worker threads """
+
+import datetime
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+
+class JobsInterrupted(Exception):
+  "Running jobs were interrupted by the user"
+
+
+class Deadline(object):
+  """ A time by which a run must stop starting jobs.  The cost of a job is
+      estimated from those already run: from the seconds of audio encoded per
+      second of a worker's time if the job's duration is known, otherwise from
+      the mean time taken per output.  Until a job has been timed any job is
+      allowed.  Shared by the schedulers of every album in a run.  """
+
+  def __init__(self, at):
+    """ Initialize the deadline to fall at Unix time `at` """
+    super(Deadline, self).__init__()
+    self.at = at
+    self.lock = threading.Lock()
+    self.missed = False       # set once work has been left for the next run
+    self.timed_seconds = 0    # worker seconds spent on jobs observed
+    self.timed_outputs = 0    # outputs written by them
+    self.audio_seconds = 0    # audio output by jobs of known duration
+    self.audio_worker_seconds = 0   # time taken by those
+
+  @classmethod
+  def fromDuration(cls, seconds):
+    """ Return a Deadline `seconds` from now """
+    return cls(time.time() + seconds)
+
+  @classmethod
+  def fromClock(cls, clock, now=None):
+    """ Return a Deadline at the next local time `clock`, e.g. '06:00' """
+    try:
+      hour, minute = map(int, clock.split(':'))
+      wanted = datetime.time(hour, minute)
+    except ValueError:
+      raise ValueError("Invalid time '{}'; use HH:MM".format(clock))
+    now = now or datetime.datetime.now()
+    at = datetime.datetime.combine(now.date(), wanted)
+    if at <= now:
+      at += datetime.timedelta(days=1)
+    return cls(at.timestamp())
+
+  def remaining(self):
+    """ Return the seconds until the deadline; negative once it has passed """
+    return self.at - time.time()
+
+  @property
+  def passed(self):
+    """ True once the deadline has passed """
+    return self.remaining() <= 0
+
+  def observe(self, job, seconds):
+    """ Record that `job` took a worker `seconds` to run """
+    with self.lock:
+      self.timed_seconds += seconds
+      self.timed_outputs += len(job)
+      duration = getattr(job, 'duration', None)
+      if duration:
+        self.audio_seconds += duration * len(job)
+        self.audio_worker_seconds += seconds
+
+  def estimate(self, job):
+    """ Return the estimated seconds `job` will take, or 0 if we can't tell """
+    with self.lock:
+      duration = getattr(job, 'duration', None)
+      if duration and self.audio_seconds:
+        return duration * len(job) * self.audio_worker_seconds \
+               / self.audio_seconds
+      elif self.timed_outputs:
+        return len(job) * self.timed_seconds / self.timed_outputs
+      return 0
+
+  def allows(self, job):
+    """ Return True if `job` is expected to finish before the deadline """
+    remaining = self.remaining()
+    return remaining > 0 and self.estimate(job) < remaining
+
+
+class JobScheduler(object):
+  """ Run a queue of jobs over a fixed number of worker threads.  Workers pull
+      from a shared queue, which lets us make decisions against its live depth.
+      Jobs with several outputs are kept whole while the queue is deep, saving
+      us from decoding a source more than once, but are split into one process
+      per output once fewer jobs are pending than there are workers.
+
+      Jobs writing to slow devices can hand their output over to a separate,
+      narrower pool of IO workers so the CPU workers move straight on.  An
+      optional Prefetcher reads ahead the sources of jobs near the front of the
+      queue.
+
+      Given a Deadline, jobs are only started while they're expected to finish
+      before it.  Jobs still queued when no more will fit are left in
+      `pending`.  """
+
+  SPLIT_MODES = ('tail', 'always', 'never')
+
+  def __init__(self, threads, split_outputs='tail', io_threads=1,
+               prefetcher=None, deadline=None, retries=0, backoff=0):
+    """ Initialize the scheduler to run with `threads` workers, plus
+        `io_threads` workers for any IO that follows a job.  A job that raises
+        is retried up to `retries` times, waiting `backoff` seconds before the
+        first retry and twice as long before each one after.  """
+    super(JobScheduler, self).__init__()
+    if split_outputs not in self.SPLIT_MODES:
+      raise ValueError("Unknown split_outputs mode '{}'".format(split_outputs))
+    self.threads = threads
+    self.io_threads = io_threads
+    self.prefetcher = prefetcher
+    self.deadline = deadline
+    self.retries = retries
+    self.backoff = backoff
+    self.split_outputs = split_outputs
+    self.pending = deque()
+    self.lock = threading.Lock()
+    self.failures = []  # (job, exception, in IO pool) for every job that raised
+
+  def __len__(self):
+    """ Return the number of jobs yet to be started """
+    return len(self.pending)
+
+  def add(self, job):
+    """ Queue `job`, which must support len() and split() """
+    self.pending.append(job)
+
+  def shouldSplit(self, job, depth):
+    """ Return True if `job` should be split into one job per output, given
+        `depth` jobs were pending when it was taken from the queue """
+    if len(job) < 2 or self.split_outputs == 'never':
+      return False
+    elif self.split_outputs == 'always':
+      return True
+    return depth < self.threads
+
+  def next(self):
+    """ Take the next job to run from the queue, splitting it if appropriate.
+        Any split-off jobs go to the front of the queue for idle workers to
+        pick up.  With a deadline, the first job expected to finish before it
+        is taken; if none will the deadline is marked as missed.  Return None
+        when there is nothing left to do, or time for.  """
+    with self.lock:
+      depth = len(self.pending)
+      if depth == 0:
+        return None
+      job = self.pending.popleft()
+      if self.shouldSplit(job, depth):
+        job, *rest = job.split()
+        self.pending.extendleft(reversed(rest))
+      if self.deadline is not None and not self.deadline.allows(job):
+        self.pending.appendleft(job)
+        for n, job in enumerate(self.pending):   # a shorter one may fit
+          if self.deadline.allows(job):
+            del self.pending[n]
+            break
+        else:
+          self.deadline.missed = True
+          return None
+      if self.prefetcher is not None:
+        self.prefetcher.prefetch(self.pending)
+      return job
+
+  def claim(self, job):
+    """ Prepare `job` to be run by a worker """
+    if self.prefetcher is not None:
+      self.prefetcher.claim(job)
+
+  def release(self, job):
+    """ Tidy up after `job` has been run by a worker """
+    if self.prefetcher is not None:
+      with self.lock:
+        pending = list(self.pending)
+      self.prefetcher.release(job, pending)
+
+  def cancel(self):
+    """ Drop any jobs that haven't been started yet """
+    with self.lock:
+      self.pending.clear()
+
+  def run(self, func, io_func=None):
+    """ Call `func` on every queued job, spread over our worker threads.  If
+        `io_func` is given it is called for each job that succeeded, in the IO
+        pool.  A job whose last retry raises is recorded in `self.failures`
+        along with the exception and whether it was raised by `io_func`,
+        rather than stopping its worker.  Worker
+        utilisation is recorded in METRICS.  """
+    def attempt(f, job):
+      for n in range(self.retries + 1):
+        try:
+          f(job)
+          return True
+        except Exception as e:
+          if n == self.retries:
+            self.failures.append((job, e, f is io_func))
+            return False
+        METRICS.inc('jobs_retried_total')
+        time.sleep(self.backoff * 2 ** n)
+    def worker():
+      job = self.next()
+      while job is not None:
+        self.claim(job)
+        began = time.monotonic()
+        try:
+          if attempt(func, job) and io_func is not None:
+            io_pool.submit(attempt, io_func, job)
+        finally:
+          busy = time.monotonic() - began
+          METRICS.inc('worker_busy_seconds_total', busy)
+          if self.deadline is not None:
+            self.deadline.observe(job, busy)
+          self.release(job)
+        job = self.next()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=self.io_threads) as io_pool, \
+         ThreadPoolExecutor(max_workers=self.threads) as pool:
+      for n in range(self.threads):
+        pool.submit(worker)
+      try:
+        pool.shutdown()
+        io_pool.shutdown()
+      except KeyboardInterrupt:
+        self.cancel()
+        # Re-raising the exception blows up threading.  Make new one.
+        raise JobsInterrupted("Keyboard interrupt; aborted transcoding")
+      finally:
+        METRICS.inc(
+          'worker_capacity_seconds_total',
+          (time.monotonic() - start) * self.threads
+        )
+        capacity = METRICS.get('worker_capacity_seconds_total')
+        if capacity > 0:
+          METRICS.set(
+            'worker_utilisation_ratio',
+            METRICS.get('worker_busy_seconds_total') / capacity
+          )
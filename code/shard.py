@@ -0,0 +1,45 @@
+""" Deterministic division of a source tree's albums between several hosts,
+    so they can share a run without talking to each other """
+
+import hashlib
+from collections import namedtuple
+from pathlib import PurePath
+
+
+class Shard(namedtuple('Shard', ['index', 'count'])):
+  """ Shard `index` of `count`, counting from 1.  Albums are assigned by a
+      hash of their path relative to the root of the walk, so every host
+      given the same tree agrees which albums are whose, whatever the tree is
+      mounted as.  """
+
+  __slots__ = ()
+
+  @classmethod
+  def fromSpec(cls, spec):
+    """ Return a Shard for a spec like '2/4'.  Raises ValueError if it isn't
+        valid.  """
+    index, sep, count = str(spec).partition('/')
+    try:
+      shard = cls(int(index), int(count))
+    except ValueError:
+      shard = None
+    if not sep or shard is None or not 1 <= shard.index <= shard.count:
+      raise ValueError(
+        "Invalid shard '{}'; use i/n, with i from 1 to n".format(spec)
+      )
+    return shard
+
+  @staticmethod
+  def of(rel_path, count):
+    """ Return the shard, from 1 to `count`, that the album at `rel_path`
+        belongs to.  Unlike hash() this is stable between processes.  """
+    key = PurePath(rel_path).as_posix().encode('utf8', 'surrogateescape')
+    digest = hashlib.sha1(key).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+  def contains(self, rel_path):
+    """ Return True if the album at `rel_path` belongs to this shard """
+    return self.of(rel_path, self.count) == self.index
+
+  def __str__(self):
+    return "{}/{}".format(self.index, self.count)
@@ -1,9 +1,11 @@
-import yaml
 from hashlib import sha256
 import functools
 
 from clint.textui import puts, colored, indent
 
+from util.file import DirSnapshot
+from util.data import yaml_load, yaml_dump
+
 
 class Signature(object):
   """ Create & manage Bulklift output signatures.  These cover all files within
@@ -12,12 +14,17 @@ class Signature(object):
 
   SIGNATURE_FILE_NAME = '.bulklift.sig'
 
-  def __init__(self, album_path, mconf, oconf, metadata_rewrites={}):
-    """ Initialize signatures fpr path `album_path` """
+  def __init__(self, album_path, mconf, oconf, metadata_rewrites={},
+               snapshot=None, source_snapshot=None):
+    """ Initialize signatures fpr path `album_path`.  If DirSnapshots of the
+        album dir and its source dir are supplied they're used instead of
+        querying the filesystem; the owner must keep them up to date.  """
     self.path = album_path
     self.mconf = mconf
     self.oconf = oconf
     self.metadata_rewrites = metadata_rewrites
+    self.snapshot = snapshot
+    self.source_snapshot = source_snapshot
     self.tree = {
       'files': {}  # dict of output filename -> data
     }
@@ -45,8 +52,12 @@ class Signature(object):
         be any normal file, not just audio.  `codec` is used to enable the
         inclusion of codec-specific params like lame_vbr; pass None if it isn't
         an audio file.  """
+    if self.source_snapshot is None:
+      source_stat = source_path.stat()
+    else:
+      source_stat = self.source_snapshot.stat_path(source_path)
     components = [    # things we always want
-      int(source_path.stat().st_mtime),
+      int(source_stat.st_mtime),
       '|'.join(["{}:{}" for k, v in self.metadata_rewrites.items()])
     ]
     components.append(self.mconf['r128gain']['type'])
@@ -67,6 +78,12 @@ class Signature(object):
     self.tree['files'][name] = self.signature(source_path, codec)
     self.dirty = True
 
+  def discard(self, name):
+    """ Forget the signature for `name`, if any, so the file is treated as out
+        of date """
+    if self.tree['files'].pop(name, None) is not None:
+      self.dirty = True
+
   def has(self, name, source_path, codec):
     """ Return True if the file specified by `path` is present in the signature
         and matches the expected data.  Does not check the filesystem. """
@@ -81,16 +98,18 @@ class Signature(object):
         expected output actually exists on the filesystem """
     if self.tree['files'].get(name, '') != self.signature(source_path, codec):
       return False
-    elif not self.path.joinpath(name).exists():
-      return False
+    elif self.snapshot is not None:
+      return name in self.snapshot
     else:
-      return True
+      return self.path.joinpath(name).exists()
 
   def clean(self, verbose=True):
     """ Remove from the signature any files not present in the output dir.
         This can happen after their removal from the source is propagated by
         OutputAlbum's cleanup() method.  """
-    expected = dict.fromkeys([p.name for p in self.path.iterdir()])
+    expected = self.snapshot
+    if expected is None:
+      expected = DirSnapshot(self.path)
     if verbose:
       puts("Cleaning orphaned sig entries (sig:{}, dir:{})".format(
         len(self), len(expected))
@@ -105,7 +124,7 @@ class Signature(object):
   def load(self):
     """ Attempt to load existing signature data """
     with self.signature_file.open('r', encoding='utf8') as stream:
-      self.tree = yaml.safe_load(stream)
+      self.tree = yaml_load(stream)
     self.tree.setdefault('files', {})   # ensure it exists
 
   def save(self, verbose=True):
@@ -114,5 +133,5 @@ class Signature(object):
       if verbose:
         puts("Saving {}".format(self.SIGNATURE_FILE_NAME))
       with self.signature_file.open('wb') as stream:
-        stream.write(yaml.safe_dump(self.tree, encoding='utf8'))
+        stream.write(yaml_dump(self.tree, encoding='utf8'))
     self.dirty = False
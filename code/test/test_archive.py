@@ -0,0 +1,79 @@
+import unittest
+from pathlib import Path
+import tarfile
+import tempfile
+
+from archive import OutputArchiver
+from metrics import METRICS
+from signature import Signature
+
+
+class TestOutputArchiver(unittest.TestCase):
+
+  def setUp(self):
+    """ Create an output tree with a couple of albums """
+    self.TEMPDIR = tempfile.TemporaryDirectory('bulklift_tests')
+    self.TEMPPATH = Path(self.TEMPDIR.name)
+    self.OUTPUT_PATH = self.TEMPPATH / 'output'
+    self.ARCHIVE_PATH = self.TEMPPATH / 'archives'
+    for album in ('A/One', 'A/Two'):
+      album_path = self.OUTPUT_PATH / album
+      album_path.mkdir(parents=True)
+      for n in range(3):
+        (album_path / '{}.opus'.format(n)).write_bytes(b'x' * 2000)
+      (album_path / Signature.SIGNATURE_FILE_NAME).write_text('files: {}\n')
+
+  def tearDown(self):
+    self.TEMPDIR.cleanup()
+
+  def members(self, paths):
+    """ Return the names in the archives at `paths` """
+    names = []
+    for path in paths:
+      with tarfile.open(str(path)) as tar:
+        names += tar.getnames()
+    return names
+
+  def test_full_then_delta(self):
+    "OutputArchiver writes a full archive then only what has changed"
+    archiver = OutputArchiver(self.OUTPUT_PATH, self.ARCHIVE_PATH, 'phone')
+    before = METRICS.get('output_bytes_written_total', output='phone')
+    archived = METRICS.get('archive_bytes_written_total', output='phone')
+    written = archiver.write(verbose=False)
+    self.assertEqual(len(written), 1)
+    self.assertEqual(
+      METRICS.get('archive_bytes_written_total', output='phone') - archived,
+      6 * 2000
+    )
+    self.assertEqual(
+      METRICS.get('output_bytes_written_total', output='phone'), before
+    )
+    self.assertIn('-full-', written[0].name)
+    self.assertEqual(len(self.members(written)), 6)   # no signatures
+    self.assertEqual(archiver.write(verbose=False), [])
+
+    (self.OUTPUT_PATH / 'A/One/0.opus').write_bytes(b'y' * 100)
+    (self.OUTPUT_PATH / 'A/Two/1.opus').unlink()
+    written = archiver.write(verbose=False)
+    self.assertIn('-delta-', written[0].name)
+    self.assertEqual(
+      sorted(self.members(written)),
+      [OutputArchiver.DELETED_NAME, 'A/One/0.opus']
+    )
+    with tarfile.open(str(written[0])) as tar:
+      deleted = tar.extractfile(OutputArchiver.DELETED_NAME).read()
+    self.assertEqual(deleted, b'A/Two/1.opus\n')
+    self.assertEqual(list(self.ARCHIVE_PATH.glob('.*.tmp')), [])
+
+  def test_chunks(self):
+    "OutputArchiver splits archives into chunks no bigger than max_size"
+    archiver = OutputArchiver(
+      self.OUTPUT_PATH, self.ARCHIVE_PATH, 'phone', max_size='10K'
+    )
+    written = archiver.write(verbose=False)
+    self.assertGreater(len(written), 1)
+    for path in written:
+      self.assertLessEqual(path.stat().st_size, 10240)
+    self.assertEqual(len(self.members(written)), 6)
+    full = archiver.write(full=True, verbose=False)
+    self.assertEqual(len(self.members(full)), 6)
@@ -0,0 +1,75 @@
+import unittest
+from pathlib import Path
+import tempfile
+
+from autotune import Autotuner, library_sample, synthetic_sample, candidates, \
+  write_host_config
+from manifest import ManifestOutput
+from util.data import yaml_load
+
+
+class TestAutotune(unittest.TestCase):
+
+  def setUp(self):
+    self.TEMPDIR = tempfile.TemporaryDirectory('bulklift_tests')
+    self.TEMPPATH = Path(self.TEMPDIR.name)
+
+  def tearDown(self):
+    self.TEMPDIR.cleanup()
+
+  def test_candidates(self):
+    "candidates() covers jobs and ffmpeg threads without oversubscribing"
+    combos = candidates(4, outputs=1)
+    self.assertIn((4, 1, 'tail'), combos)
+    self.assertIn((1, 4, 'tail'), combos)
+    self.assertIn((2, None, 'tail'), combos)
+    self.assertTrue(all(j * (t or 1) <= 4 for j, t, m in combos))
+    self.assertEqual(
+      set(m for j, t, m in candidates(2, outputs=2)),
+      set(['tail', 'always', 'never'])
+    )
+
+  def test_autotune(self):
+    "Autotuner times settings over a sample and ranks them"
+    sample = synthetic_sample(self.TEMPPATH, files=2, duration=2)
+    picked = library_sample(self.TEMPPATH, files=1)
+    self.assertEqual(len(picked), 1)
+    self.assertIn(picked[0], sample)
+    self.assertEqual(sorted(library_sample(self.TEMPPATH, files=5)), sample)
+    oconfs = [
+      ManifestOutput({'name': 'a', 'path': '/nonexistent', 'formats': ['opus']}),
+      ManifestOutput({'name': 'b', 'path': '/nonexistent', 'formats': ['mp3']})
+    ]
+    tuner = Autotuner(sample, oconfs)
+    self.assertAlmostEqual(tuner.audio_seconds, 8, places=1)
+    results = tuner.run([(1, 1, 'never'), (2, None, 'always')], verbose=False)
+    self.assertEqual(len(results), 2)
+    self.assertLessEqual(results[0][0], results[1][0])
+
+  def test_jobs_distinct_outputs(self):
+    "Autotuner gives sources sharing a name from different albums their own outputs"
+    sources = []
+    for album in ('A', 'B'):
+      (self.TEMPPATH / album).mkdir()
+      sources += synthetic_sample(self.TEMPPATH / album, files=1, duration=1)
+    self.assertEqual(sources[0].name, sources[1].name)
+    oconfs = [
+      ManifestOutput({'name': 'a', 'path': '/nonexistent', 'formats': ['opus']})
+    ]
+    out_dir = self.TEMPPATH / 'out'
+    out_dir.mkdir()
+    jobs = Autotuner(sources, oconfs).jobs(out_dir, None)
+    outputs = [p for j in jobs for p in j.expected_outputs]
+    self.assertEqual(len(set(outputs)), 2)
+
+  def test_write_host_config(self):
+    "write_host_config() saves settings, keeping the rest of the file"
+    path = self.TEMPPATH / 'bulklift' / 'host.yaml'
+    path.parent.mkdir()
+    path.write_text("config: {transcoding: {ffmpeg_path: /opt/ffmpeg}}\n")
+    write_host_config(path, 4, None, 'tail')
+    data = yaml_load(path.read_text())
+    self.assertEqual(data['config']['transcoding'], {
+      'ffmpeg_path': '/opt/ffmpeg', 'threads': 4, 'ffmpeg_threads': None,
+      'split_outputs': 'tail'
+    })
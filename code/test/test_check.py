@@ -0,0 +1,62 @@
+import unittest
+from pathlib import Path
+import tempfile
+
+from check import check_tree, check_output
+from manifest import Manifest, ManifestOutput
+
+
+class TestCheck(unittest.TestCase):
+
+  ROOT_MANIFEST = """
+root: true
+metadata: {genre: Silencecore, artist: DJ Bulklift}
+outputs:
+  - {name: phone, path: /nonexistent/phone, formats: [opus]}
+"""
+
+  def setUp(self):
+    """ Create a source tree with a good album and some bad ones """
+    self.TEMPDIR = tempfile.TemporaryDirectory('bulklift_tests')
+    self.ROOT_PATH = Path(self.TEMPDIR.name) / 'source'
+    self.ROOT_PATH.mkdir()
+    Manifest.manifestFilePath(self.ROOT_PATH).write_text(self.ROOT_MANIFEST)
+    self.albums = {}
+    for name, manifest in [
+      ('good', "metadata: {album: Good, year: 2019}"),
+      ('no_year', "metadata: {album: No Year}"),
+      ('clash_a', "metadata: {album: Clash, year: 2019}"),
+      ('clash_b', "metadata: {album: Clash, year: 2019}"),
+      ('bad_yaml', "metadata: {album: [oops"),
+      ('disabled', "metadata: {album: Off}")
+    ]:
+      path = self.ROOT_PATH / name
+      path.mkdir()
+      enabled = 'false' if name == 'disabled' else 'true'
+      Manifest.manifestFilePath(path).write_text(
+        manifest + "\noutputs:\n  - {name: phone, enabled: " + enabled + "}\n"
+      )
+      self.albums[name] = path
+
+  def tearDown(self):
+    self.TEMPDIR.cleanup()
+
+  def test_check_tree(self):
+    "check_tree finds bad metadata, yaml and output collisions"
+    checked, problems = check_tree(self.ROOT_PATH, workers=2)
+    self.assertEqual(checked, 7)
+    self.assertEqual(
+      sorted(p.name for p in problems),
+      ['bad_yaml', 'clash_a', 'clash_b', 'no_year']
+    )
+    self.assertIn('year', problems[self.albums['no_year']][0])
+    self.assertIn('shared with', problems[self.albums['clash_a']][0])
+
+  def test_check_output(self):
+    "check_output validates formats and bitrates"
+    oconf = ManifestOutput({'path': '/x', 'formats': ['opus', 'mp3']})
+    self.assertEqual(check_output(oconf), [])
+    oconf = ManifestOutput({
+      'path': '/x', 'formats': ['wma'], 'opus_bitrate': '1M', 'lame_vbr': 11
+    })
+    self.assertEqual(len(check_output(oconf)), 3)
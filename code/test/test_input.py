@@ -1,5 +1,8 @@
 import unittest
+from unittest import mock
+import subprocess
 import tempfile
+import time
 from copy import deepcopy
 from pathlib import Path
 
@@ -7,13 +10,87 @@ from test.fakesourcetree import FakeSourceTreeAlbum
 
 from util.file import find_in_path
 
-from manifest import ManifestConfig, ManifestOutput, MetadataError
-from input import InputAlbum
+from manifest import Manifest, ManifestConfig, ManifestOutput, MetadataError
+from input import InputAlbum, MediaSourceDir
+from output import OutputAlbum
+from scheduler import Deadline
+from shard import Shard
+from quarantine import Quarantine
+from wrappers import FFmpegWrapper
 
 
 BIN_FFMPEG = find_in_path('ffmpeg')
 
 
+class TestMediaSourceDir(unittest.TestCase):
+  """ Test walking a source tree """
+
+  ROOT_MANIFEST = """
+root: true
+outputs:
+  - {name: phone, path: %(out)s/phone, formats: [opus]}
+  - {name: car, path: %(out)s/car, formats: [mp3]}
+"""
+
+  ALBUM_MANIFEST = """
+metadata: {artist: DJ Bulklift, album: Greatest Hits, genre: Silencecore, year: 2019}
+outputs:
+  - {name: phone, enabled: true}
+  - {name: car, enabled: %(car)s}
+"""
+
+  @classmethod
+  def setUpClass(cls):
+    """ Create a source tree with two albums, only one going to 'car' """
+    cls.TEMPDIR = tempfile.TemporaryDirectory('bulklift_tests')
+    cls.TEMPPATH = Path(cls.TEMPDIR.name)
+    cls.INPUT_PATH = cls.TEMPPATH / 'source'
+    cls.INPUT_PATH.mkdir()
+    Manifest.manifestFilePath(cls.INPUT_PATH).write_text(
+      cls.ROOT_MANIFEST % {'out': cls.TEMPPATH}
+    )
+    cls.ALBUM_BOTH = FakeSourceTreeAlbum(cls.INPUT_PATH, name='both', n_tracks=1)
+    Manifest.manifestFilePath(cls.ALBUM_BOTH.path).write_text(
+      cls.ALBUM_MANIFEST % {'car': 'true'}
+    )
+    cls.ALBUM_PHONE = FakeSourceTreeAlbum(cls.INPUT_PATH, name='phone', n_tracks=1)
+    Manifest.manifestFilePath(cls.ALBUM_PHONE.path).write_text(
+      cls.ALBUM_MANIFEST % {'car': 'false'}
+    )
+
+  @classmethod
+  def tearDownClass(cls):
+    """ Remove temp dir """
+    cls.TEMPDIR.cleanup()
+
+  def test_walk(self):
+    "MediaSourceDir walks the tree to find transcodable albums"
+    msds = list(MediaSourceDir(self.INPUT_PATH).walk())
+    self.assertEqual(
+      sorted(msd.path.name for msd in msds), ['both', 'phone']
+    )
+
+  def test_walk_output(self):
+    "MediaSourceDir limited to one output only finds albums enabled for it"
+    msds = list(MediaSourceDir(self.INPUT_PATH, output='car').walk())
+    self.assertEqual([msd.path.name for msd in msds], ['both'])
+    ia = msds[0].album()
+    self.assertEqual([oa.output_name for oa in ia.output_albums], ['car'])
+
+  def test_albums_shard(self):
+    "MediaSourceDir with a shard only plans its own albums but knows the rest"
+    msd = MediaSourceDir(self.INPUT_PATH)
+    every = {str(p) for m in msd.walk() for p in m.albumPaths()}
+    names = []
+    for i in (1, 2):
+      elsewhere = set()
+      albums = list(msd.albums(shard=Shard(i, 2), elsewhere=elsewhere))
+      names += [ia.path.name for ia in albums]
+      mine = {str(oa.path) for ia in albums for oa in ia.output_albums}
+      self.assertEqual(mine | elsewhere, every)
+    self.assertEqual(sorted(names), ['both', 'phone'])
+
+
 class TestInputAlbum(unittest.TestCase):
   """ Test the input album representation """
 
@@ -47,6 +124,9 @@ class TestInputAlbum(unittest.TestCase):
     cls.OUTPUTA_PATH.mkdir()
     cls.OUTPUTB_PATH = cls.TEMPPATH / 'outputB'
     cls.OUTPUTB_PATH.mkdir()
+    cls.OUTPUTC_PATH = cls.TEMPPATH / 'outputC'
+    cls.OUTPUTC_PATH.mkdir()
+    cls.STAGING_PATH = cls.TEMPPATH / 'staging'
 
   @classmethod
   def tearDownClass(cls):
@@ -110,3 +190,174 @@ class TestInputAlbum(unittest.TestCase):
     for t in self.FAKE_ALBUM.tracks.values():
       self.assertTrue((output_mp3.path / t.name).with_suffix('.mp3').is_file())
       self.assertTrue((output_opus.path / t.name).with_suffix('.opus').is_file())
+
+  def test_transcode_staged(self):
+    "InputAlbum transcodes via a staging dir"
+    out_c = {
+      'name': 'staged', 'path': self.OUTPUTC_PATH, 'formats':['mp3'],
+      'enabled':True, 'staging': str(self.STAGING_PATH)
+    }
+    ia = InputAlbum(
+      self.FAKE_ALBUM.path,
+      ManifestConfig(self.BASIC_CONFIG),
+      [ManifestOutput(out_c)],
+      metadata=self.METADATA
+    )
+    output_mp3, = ia.output_albums
+    self.assertTrue(
+      str(output_mp3.staging_path).startswith(str(self.STAGING_PATH))
+    )
+    ia.transcode(verbose=False)
+    for t in self.FAKE_ALBUM.tracks.values():
+      self.assertTrue((output_mp3.path / t.name).with_suffix('.mp3').is_file())
+    self.assertFalse(output_mp3.staging_path.exists())
+
+  def test_transcode_deadline(self):
+    "InputAlbum leaves jobs that won't fit before a deadline unsigned"
+    out_e = {'path': self.TEMPPATH / 'outputE', 'formats':['opus'], 'enabled':True}
+    ia = InputAlbum(
+      self.FAKE_ALBUM.path, ManifestConfig(self.BASIC_CONFIG),
+      [ManifestOutput(out_e)], metadata=self.METADATA
+    )
+    deadline = Deadline(time.time() - 1)
+    ia.transcode(verbose=False, deadline=deadline)
+    self.assertTrue(deadline.missed)
+    output_opus, = ia.output_albums
+    self.assertFalse(output_opus.path.exists())   # nothing prepared
+    for t in self.FAKE_ALBUM.tracks.values():
+      name = t.with_suffix('.opus').name
+      self.assertNotIn(name, output_opus.signature)
+      self.assertFalse((output_opus.path / name).exists())
+
+  def test_transcode_failure(self):
+    "InputAlbum quarantines a source that fails to transcode and leaves it unsigned"
+    broken = FakeSourceTreeAlbum(self.INPUT_PATH, name='broken', n_tracks=2)
+    broken.tracks[1].write_bytes(b'fLaC not really')
+    config = deepcopy(self.BASIC_CONFIG)
+    config['transcoding'].update({'retries': 1, 'retry_backoff': 0})
+    out_f = {'path': self.TEMPPATH / 'outputF', 'formats':['opus'], 'enabled':True}
+    InputAlbum.quarantine = Quarantine(self.TEMPPATH / 'quarantine', load=False)
+    try:
+      ia = InputAlbum(
+        broken.path, ManifestConfig(config), [ManifestOutput(out_f)],
+        metadata=self.METADATA
+      )
+      ia.transcode(verbose=False)
+      self.assertEqual([(p, q) for p, r, q in ia.failures], [(broken.tracks[1], True)])
+      self.assertIn('exited with status', ia.failures[0][1])
+      output_opus, = ia.output_albums
+      bad, good = [t.with_suffix('.opus').name for t in broken.tracks.values()]
+      self.assertNotIn(bad, output_opus.signature)
+      self.assertFalse((output_opus.path / bad).exists())
+      self.assertIn(good, output_opus.signature)
+      # The next run skips it
+      ia = InputAlbum(
+        broken.path, ManifestConfig(config), [ManifestOutput(out_f)],
+        metadata=self.METADATA
+      )
+      ia.transcode(verbose=False)
+      self.assertEqual(ia.failures, [])
+      self.assertEqual([p for p, r in ia.quarantined], [broken.tracks[1]])
+    finally:
+      InputAlbum.quarantine = None
+
+  def test_fail_output(self):
+    "InputAlbum doesn't quarantine a source when writing its output failed"
+    ia = InputAlbum(
+      self.FAKE_ALBUM.path, ManifestConfig(self.BASIC_CONFIG), [],
+      metadata=self.METADATA
+    )
+    InputAlbum.quarantine = Quarantine(self.TEMPPATH / 'quarantine', load=False)
+    try:
+      gone = self.TEMPPATH / 'gone'
+      opening = subprocess.CalledProcessError(
+        254, 'ffmpeg', stderr=b'Error opening output files: No such file or directory\n'
+      )
+      for n, e, io, out_dir in (
+        (1, OSError(28, "No space left on device"), True, gone),
+        (2, OSError(5, "Input/output error"), False, gone),
+        (3, subprocess.CalledProcessError(1, 'ffmpeg'), False, gone),
+        (4, opening, False, self.TEMPPATH),
+        (5, subprocess.CalledProcessError(1, 'ffmpeg'), False, self.TEMPPATH)
+      ):
+        job = FFmpegWrapper(self.FAKE_ALBUM.tracks[n])
+        job.appendOutputOpus(out_dir / 'fail.opus')
+        ia.fail(job, e, io=io)
+      self.assertEqual(
+        [q for p, r, q in ia.failures], [False, False, False, False, True]
+      )
+      self.assertEqual(len(InputAlbum.quarantine), 1)
+    finally:
+      InputAlbum.quarantine = None
+
+  def test_fail_keeps_destination(self):
+    "InputAlbum keeps the existing copy of a staged output whose encode failed"
+    ia = InputAlbum(
+      self.FAKE_ALBUM.path, ManifestConfig(self.BASIC_CONFIG), [],
+      metadata=self.METADATA
+    )
+    InputAlbum.quarantine = Quarantine(self.TEMPPATH / 'quarantine', load=False)
+    try:
+      staged = self.TEMPPATH / 'staged.opus'
+      final = self.TEMPPATH / 'final.opus'
+      for io in (False, True):
+        staged.write_bytes(b'partial')
+        final.write_bytes(b'good')
+        job = FFmpegWrapper(self.FAKE_ALBUM.tracks[1])
+        job.appendOutputOpus(staged)
+        job.stage(staged, final)
+        ia.fail(job, OSError(5, "Input/output error"), io=io)
+        self.assertFalse(staged.exists())
+        self.assertEqual(final.exists(), not io)
+    finally:
+      InputAlbum.quarantine = None
+
+  def test_transcode_output_gone(self):
+    "InputAlbum survives an output dir vanishing, without quarantining sources"
+    config = deepcopy(self.BASIC_CONFIG)
+    config['transcoding'].update({'retries': 0})
+    out_g = {'path': self.TEMPPATH / 'outputG', 'formats':['opus'], 'enabled':True}
+    InputAlbum.quarantine = Quarantine(self.TEMPPATH / 'quarantine', load=False)
+    try:
+      ia = InputAlbum(
+        self.FAKE_ALBUM.path, ManifestConfig(config), [ManifestOutput(out_g)],
+        metadata=self.METADATA
+      )
+      with mock.patch.object(OutputAlbum, 'prepare'):   # dir never made
+        ia.transcode(verbose=False)
+      self.assertEqual(len(ia.failures), len(self.FAKE_ALBUM.tracks))
+      self.assertFalse(any(q for p, r, q in ia.failures))
+      self.assertEqual(len(InputAlbum.quarantine), 0)
+    finally:
+      InputAlbum.quarantine = None
+
+  def test_job_timeout(self):
+    "InputAlbum scales job timeouts by source duration"
+    config = deepcopy(self.BASIC_CONFIG)
+    config['transcoding']['timeout'] = {'base': 10, 'per_second': 2, 'unknown': None}
+    ia = InputAlbum(
+      self.FAKE_ALBUM.path, ManifestConfig(config), [], metadata=self.METADATA
+    )
+    job = FFmpegWrapper(self.FAKE_ALBUM.tracks[1], duration=30)
+    job.appendOutputOpus(self.TEMPPATH / 'timeout.opus')
+    job.appendOutputLame(self.TEMPPATH / 'timeout.mp3')
+    self.assertEqual(ia.jobTimeout(job), 10 + 2 * 30 * 2)
+    job.duration = None
+    self.assertIsNone(ia.jobTimeout(job))
+
+  def test_transcode_prefetch(self):
+    "InputAlbum transcodes from prefetched copies of its sources"
+    config = deepcopy(self.BASIC_CONFIG)
+    config['transcoding']['prefetch'] = {
+      'jobs': 3, 'mode': 'copy', 'scratch_dir': str(self.TEMPPATH / 'scratch')
+    }
+    out_d = {'path': self.TEMPPATH / 'outputD', 'formats':['opus'], 'enabled':True}
+    ia = InputAlbum(
+      self.FAKE_ALBUM.path, ManifestConfig(config), [ManifestOutput(out_d)],
+      metadata=self.METADATA
+    )
+    ia.transcode(verbose=False)
+    output_opus, = ia.output_albums
+    for t in self.FAKE_ALBUM.tracks.values():
+      self.assertTrue((output_opus.path / t.name).with_suffix('.opus').is_file())
+    self.assertEqual(list((self.TEMPPATH / 'scratch').iterdir()), [])
@@ -0,0 +1,83 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+import mutagen
+
+from loudness import LoudnessCache, TrackLoudness, integrated_loudness, \
+                     parse_ebur128, write_gain_tags
+from wrappers import FFmpegWrapper, SoxWrapper
+
+
+class TestLoudness(unittest.TestCase):
+
+  def test_parse_ebur128(self):
+    "parse_ebur128 bins momentary loudness and reads the peak"
+    text = "\n".join([
+      "[Parsed_ebur128_0 @ 0x1] t: 0.1  TARGET:-23 LUFS    M:-120.7 S:-120.7",
+      "[Parsed_ebur128_0 @ 0x1] t: 0.4  TARGET:-23 LUFS    M: -20.04 S:-120.7",
+      "[Parsed_ebur128_0 @ 0x1] t: 0.5  TARGET:-23 LUFS    M: -20.0 S:-120.7",
+      "  Sample peak:",
+      "    Peak:       -6.0 dBFS"
+    ])
+    t = parse_ebur128(text)
+    self.assertEqual(t.histogram, {-1207: 1, -200: 2})
+    self.assertAlmostEqual(t.peak, 0.501, places=3)
+    self.assertAlmostEqual(t.integrated, -20.0)
+
+  def test_integrated_loudness(self):
+    "integrated_loudness gates quiet blocks and combines tracks"
+    loud = TrackLoudness({-100: 10}, 1.0)
+    quiet = TrackLoudness({-300: 10}, 0.1)    # below the relative gate
+    silent = TrackLoudness({-1000: 10}, 0.0)  # below the absolute gate
+    self.assertAlmostEqual(integrated_loudness([loud, quiet]), -10.0)
+    self.assertAlmostEqual(integrated_loudness([loud, silent]), -10.0)
+    self.assertIsNone(integrated_loudness([silent]))
+    louder = TrackLoudness({-70: 10}, 1.0)
+    self.assertTrue(-10.0 < integrated_loudness([loud, louder]) < -7.0)
+
+
+class TestLoudnessCache(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    """ Create a temp dir with a test tone in it """
+    cls.TEMPDIR = tempfile.TemporaryDirectory('bulklift_tests')
+    cls.TEMPPATH = Path(cls.TEMPDIR.name)
+    cls.INPUT_FLAC = cls.TEMPPATH / 'test.flac'
+    SoxWrapper(output_path=cls.INPUT_FLAC, duration=2).run()
+
+  @classmethod
+  def tearDownClass(cls):
+    """ Remove temp dir """
+    cls.TEMPDIR.cleanup()
+
+  def test_measure(self):
+    "LoudnessCache measures a source once and persists the result"
+    cache_path = self.TEMPPATH / 'loudness.pickle'
+    cache = LoudnessCache(path=cache_path)
+    self.assertIsNone(cache.get(self.INPUT_FLAC))
+    t = cache.measure(self.INPUT_FLAC)
+    self.assertIsNotNone(t.integrated)
+    self.assertGreater(t.peak, 0)
+    self.assertEqual(cache.get(self.INPUT_FLAC), t)
+    cache.save()
+    self.assertEqual(LoudnessCache(path=cache_path).get(self.INPUT_FLAC), t)
+
+  def test_write_gain_tags(self):
+    "write_gain_tags tags opus and mp3 files"
+    t = TrackLoudness({-200: 10}, 0.5)
+    ffmpeg = FFmpegWrapper(self.INPUT_FLAC)
+    output_opus = self.TEMPPATH / 'test.opus'
+    output_mp3 = self.TEMPPATH / 'test.mp3'
+    ffmpeg.appendOutputOpus(output_opus)
+    ffmpeg.appendOutputLame(output_mp3)
+    ffmpeg.run()
+    self.assertTrue(write_gain_tags(output_opus, t, album=(-21.0, 0.5)))
+    f = mutagen.File(str(output_opus))
+    self.assertEqual(f['R128_TRACK_GAIN'], ['-768'])
+    self.assertEqual(f['R128_ALBUM_GAIN'], ['-512'])
+    self.assertTrue(write_gain_tags(output_mp3, t))
+    f = mutagen.File(str(output_mp3))
+    self.assertEqual(f.tags['TXXX:REPLAYGAIN_TRACK_GAIN'].text, ['2.00 dB'])
+    self.assertNotIn('TXXX:REPLAYGAIN_ALBUM_GAIN', f.tags)
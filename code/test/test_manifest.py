@@ -2,7 +2,7 @@ import unittest
 from pathlib import Path
 import tempfile
 
-from manifest import Manifest, ManifestError
+from manifest import Manifest, ManifestError, ManifestCache, ManifestOutput
 
 
 class TestManifest(unittest.TestCase):
@@ -28,3 +28,106 @@ class TestManifest(unittest.TestCase):
       no_yaml_dir.mkdir()
       m = Manifest(no_yaml_dir)
       self.assertFalse(m.exists())
+
+
+class TestManifestCache(unittest.TestCase):
+
+  def setUp(self):
+    """ Create a small source tree with root and album manifests """
+    self.TEMPDIR = tempfile.TemporaryDirectory('bulklift_tests')
+    self.TEMPPATH = Path(self.TEMPDIR.name)
+    self.ROOT_PATH = self.TEMPPATH / 'source'
+    self.ALBUM_PATH = self.ROOT_PATH / 'Artist' / 'Album'
+    self.ALBUM_PATH.mkdir(parents=True)
+    Manifest.manifestFilePath(self.ROOT_PATH).write_text(
+      "root: true\nmetadata: {genre: Silencecore}\n"
+    )
+    Manifest.manifestFilePath(self.ALBUM_PATH).write_text(
+      "metadata: {album: Greatest Hits}\n"
+    )
+    self.CACHE_PATH = self.TEMPPATH / 'cache' / ManifestCache.CACHE_FILE_NAME
+
+  def tearDown(self):
+    Manifest.cache = None
+    Manifest.host_config_path = None
+    Manifest.loadYaml.cache_clear()
+    self.TEMPDIR.cleanup()
+
+  def test_fromDir_path(self):
+    "Manifest.fromDir() is for the dir asked for, whether or not it has a manifest of its own"
+    for cache in (None, ManifestCache(self.CACHE_PATH)):
+      Manifest.cache = cache
+      for _ in range(2):    # the second time from the cache, if any
+        m = Manifest.fromDir(self.ALBUM_PATH)
+        self.assertEqual(m.path, self.ALBUM_PATH)
+        self.assertTrue(m.exists())
+        self.assertEqual(m['metadata']['album'], 'Greatest Hits')
+        m = Manifest.fromDir(self.ALBUM_PATH.parent)
+        self.assertEqual(m.path, self.ALBUM_PATH.parent)
+        self.assertFalse(m.exists())    # not the ancestor's
+        self.assertEqual(m['metadata']['genre'], 'Silencecore')
+        self.assertNotIn('album', m['metadata'])
+
+  def test_cache(self):
+    "ManifestCache serves merged manifests until one in the chain changes"
+    Manifest.cache = ManifestCache(self.CACHE_PATH)
+    m = Manifest.fromDir(self.ALBUM_PATH)
+    self.assertEqual(m.path, self.ALBUM_PATH)
+    self.assertEqual(m['metadata']['genre'], 'Silencecore')
+    Manifest.cache.save()
+    self.assertTrue(self.CACHE_PATH.is_file())
+
+    cache = ManifestCache(self.CACHE_PATH)
+    data = cache.get(self.ALBUM_PATH)
+    self.assertEqual(data['metadata'], {'genre': 'Silencecore', 'album': 'Greatest Hits'})
+    self.assertIsNone(cache.get(self.ROOT_PATH / 'Artist'))
+
+    # A new manifest between album and root invalidates the entry
+    Manifest.manifestFilePath(self.ROOT_PATH / 'Artist').write_text(
+      "metadata: {artist: DJ Bulklift}\n"
+    )
+    self.assertIsNone(cache.get(self.ALBUM_PATH))
+
+  def test_cache_root_changed(self):
+    "ManifestCache notices a change to the root manifest"
+    cache = ManifestCache(self.CACHE_PATH)
+    cache.put(self.ALBUM_PATH, [self.ALBUM_PATH, self.ALBUM_PATH.parent, self.ROOT_PATH], {'a': 1})
+    self.assertEqual(cache.get(self.ALBUM_PATH), {'a': 1})
+    Manifest.manifestFilePath(self.ROOT_PATH).write_text(
+      "root: true\nmetadata: {genre: Noisecore}\n"
+    )
+    self.assertIsNone(cache.get(self.ALBUM_PATH))
+
+  def test_host_config(self):
+    "Host config is merged over the root manifest but under those below it"
+    Manifest.host_config_path = self.TEMPPATH / 'host.yaml'
+    Manifest.host_config_path.write_text(
+      "config: {transcoding: {threads: 3, ffmpeg_threads: 2}}\n"
+    )
+    Manifest.manifestFilePath(self.ROOT_PATH).write_text(
+      "root: true\nconfig: {transcoding: {threads: 8, io_threads: 2}}\n"
+    )
+    Manifest.manifestFilePath(self.ALBUM_PATH).write_text(
+      "config: {transcoding: {ffmpeg_threads: 1}}\n"
+    )
+    tc = Manifest.fromDir(self.ALBUM_PATH)['config']['transcoding']
+    self.assertEqual(tc['threads'], 3)
+    self.assertEqual(tc['io_threads'], 2)
+    self.assertEqual(tc['ffmpeg_threads'], 1)
+
+  def test_cache_host_config_changed(self):
+    "ManifestCache notices a change to the host config"
+    Manifest.host_config_path = self.TEMPPATH / 'host.yaml'
+    cache = ManifestCache(self.CACHE_PATH)
+    cache.put(self.ALBUM_PATH, [self.ALBUM_PATH, self.ALBUM_PATH.parent, self.ROOT_PATH], {'a': 1})
+    self.assertEqual(cache.get(self.ALBUM_PATH), {'a': 1})
+    Manifest.host_config_path.write_text("config: {}\n")
+    self.assertIsNone(cache.get(self.ALBUM_PATH))
+
+
+class TestManifestOutput(unittest.TestCase):
+
+  def test_bad_filter(self):
+    "ManifestOutput rejects an invalid filter regex"
+    with self.assertRaises(ManifestError):
+      ManifestOutput({'path': '/tmp', 'filters': {'include': ['re:(unclosed']}})
@@ -0,0 +1,48 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+from metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+  def _makeMetrics(self):
+    m = Metrics(prefix='test')
+    m.describe('jobs_total', 'counter', "Jobs run")
+    m.describe('phase_seconds_total', 'counter', "Time in each phase")
+    return m
+
+  def test_render(self):
+    "Metrics renders counters with labels in exposition format"
+    m = self._makeMetrics()
+    m.inc('jobs_total', codec='opus', outcome='ok')
+    m.inc('jobs_total', 2, codec='opus', outcome='ok')
+    m.inc('jobs_total', codec='my "mp3"', outcome='failed')
+    self.assertEqual(m.get('jobs_total', outcome='ok', codec='opus'), 3)
+    text = m.render()
+    self.assertIn('# TYPE test_jobs_total counter\n', text)
+    self.assertIn('test_jobs_total{codec="opus",outcome="ok"} 3\n', text)
+    self.assertIn(r'test_jobs_total{codec="my \"mp3\"",outcome="failed"} 1', text)
+
+  def test_phase(self):
+    "Metrics times phases"
+    m = self._makeMetrics()
+    with m.phase('walk'):
+      pass
+    with self.assertRaises(ValueError):
+      with m.phase('walk'):
+        raise ValueError()
+    self.assertGreater(m.get('phase_seconds_total', phase='walk'), 0)
+
+  def test_write(self):
+    "Metrics writes a textfile, periodically and on stopping"
+    m = self._makeMetrics()
+    with tempfile.TemporaryDirectory('bulklift_tests') as t:
+      path = Path(t) / 'bulklift.prom'
+      m.startWriting(path, 0.01)
+      m.inc('jobs_total', codec='opus', outcome='ok')
+      m.stopWriting(path)
+      self.assertIn('test_jobs_total{codec="opus",outcome="ok"} 1', path.read_text())
+      self.assertIn('test_timestamp_seconds ', path.read_text())
+      self.assertEqual([p.name for p in Path(t).iterdir()], ['bulklift.prom'])
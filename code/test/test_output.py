@@ -2,12 +2,20 @@ import unittest
 import tempfile
 from pathlib import Path
 import shutil
+import os
+
+import mutagen
 
 from test.fakesourcetree import FakeSourceTreeAlbum
-from output import OutputTree, OutputAlbum
+from output import OutputTree, OutputTrash, OutputAlbum, R128gainBatch
 from manifest import ManifestConfig, ManifestOutput
 from wrappers import FFmpegWrapper
 from signature import Signature
+from probe import ProbeResult
+from util.file import find_in_path
+
+
+BIN_FALSE = find_in_path('false')
 
 
 class TestOutputTree(unittest.TestCase):
@@ -35,10 +43,84 @@ class TestOutputTree(unittest.TestCase):
     self.assertFalse(bad_dir.exists())
     self.assertTrue(self.TEMPPATH.is_dir()) # don't delete the root
 
-  @unittest.skip("not written yet")
+  def test_clean_nested(self):
+    "OutputTree keeps parents of expected dirs but not their namesakes"
+    otree = OutputTree(self.TEMPPATH)
+    good_dir = self.TEMPPATH / 'genre' / 'artist' / 'album'
+    good_dir.mkdir(parents=True)
+    bad_dir = self.TEMPPATH / 'genre' / 'art'   # a prefix of 'artist'
+    bad_dir.mkdir()
+    otree.cleanup(expected_dirs=[str(good_dir)], verbose=False)
+    self.assertTrue(good_dir.exists())
+    self.assertFalse(bad_dir.exists())
+
+  def test_clean_trash(self):
+    "OutputTree moves redundant dirs into its trash"
+    otree = OutputTree(self.TEMPPATH, trash=OutputTrash(self.TEMPPATH))
+    good_dir = self.TEMPPATH / 'used_dir_8831'
+    good_dir.mkdir()
+    bad_dir = self.TEMPPATH / 'unused_dir_8832'
+    bad_dir.mkdir()
+    (bad_dir / 'track.opus').write_bytes(b'X' * 100)
+    otree.cleanup(expected_dirs=[good_dir], verbose=False)
+    self.assertFalse(bad_dir.exists())
+    trashed = list(otree.trash.path.glob('*/' + bad_dir.name))
+    self.assertEqual(len(trashed), 1)
+    self.assertEqual(otree.trash.size, 0)   # unbounded; not tracked
+    otree.cleanup(expected_dirs=[good_dir], verbose=False)
+    self.assertTrue(trashed[0].exists())    # trash survives cleanup
+    otree.trash.empty()
+    otree.trash.wait()
+    self.assertEqual(list(otree.trash.path.iterdir()), [])
+
+  def test_clean_trash_full(self):
+    "OutputTrash deletes victims that would overfill it"
+    trash = OutputTrash(self.TEMPPATH, max_size=150)
+    victims = []
+    for n in range(2):
+      victim = self.TEMPPATH / 'unused_dir_{}'.format(n)
+      victim.mkdir()
+      (victim / 'track.opus').write_bytes(b'X' * 100)
+      trash.discard(victim)
+      self.assertFalse(victim.exists())
+      victims.append(victim)
+    self.assertEqual(len(list(trash.path.glob('*/' + victims[0].name))), 1)
+    self.assertEqual(len(list(trash.path.glob('*/' + victims[1].name))), 0)
+    self.assertEqual(trash.size, 100)
+    trash.empty()
+    trash.wait()
+    self.assertEqual(trash.size, 0)
+
+  def test_trash_left_over(self):
+    "OutputTrash measures what earlier runs left in it in the background"
+    victim = self.TEMPPATH / 'left_over'
+    victim.mkdir()
+    (victim / 'track.opus').write_bytes(b'X' * 100)
+    OutputTrash(self.TEMPPATH, max_size=1000).discard(victim)
+    trash = OutputTrash(self.TEMPPATH, max_size=1000)
+    self.assertEqual(trash.size, 0)   # not measured up front
+    trash.empty()
+    trash.wait()
+    self.assertEqual(trash.size, 0)
+    self.assertEqual(list(trash.path.iterdir()), [])
+
   def test_permissions(self):
     "OutputTree recursively changes ownership & permissions"
-    assert False
+    otree = OutputTree(self.TEMPPATH)
+    album_dir = self.TEMPPATH / 'perms' / 'album'
+    album_dir.mkdir(parents=True)
+    track = album_dir / 'track.opus'
+    track.touch()
+    track.chmod(0o600)
+    album_dir.chmod(0o700)
+    otree.permissions(file_mode=0o644, dir_mode=0o755, verbose=False)
+    self.assertEqual(track.stat().st_mode & 0o7777, 0o644)
+    self.assertEqual(album_dir.stat().st_mode & 0o7777, 0o755)
+    self.assertEqual(
+      otree.permissions(file_mode=0o644, dir_mode=0o755, verbose=False), 0
+    )
+    uid, gid = os.getuid(), os.getgid()   # chown to ourselves is allowed
+    self.assertEqual(otree.permissions(uid=uid, gid=gid, verbose=False), 0)
 
 
 class TestOutputAlbum(unittest.TestCase):
@@ -126,6 +208,18 @@ class TestOutputAlbum(unittest.TestCase):
     self.assertEqual(ffmpeg.expected_outputs[1].name, source_t.with_suffix('.mp3').name)
     self.assertEqual(ffmpeg.expected_outputs[2].name, source_t.with_suffix('.flac').name)
 
+  def test_incorporate_probed(self):
+    "OutputAlbum transcodes sources whose probe says they're lossless"
+    mconfig, oconfig, metadata, oa = self._makeOutputAlbum("album 1a")
+    source_t = self.TEMPPATH / 'alac.m4a'
+    source_t.touch()
+    ffmpeg = FFmpegWrapper(source_path=source_t)
+    oa.incorporate(source_t, ffmpeg)    # assumed to be lossy aac
+    self.assertEqual(len(ffmpeg), 0)
+    alac = ProbeResult('alac', 180.0, 44100, 2, 16)
+    oa.incorporate(source_t, ffmpeg, probe=alac)
+    self.assertEqual(ffmpeg.output_codecs, ['opus'])
+
   def test_filter(self):
     "OutputAlbum correctly filters input tracks"
     mconfig, oconfig, metadata, oa = self._makeOutputAlbum("album 1")
@@ -140,6 +234,14 @@ class TestOutputAlbum(unittest.TestCase):
     self.assertFalse(oa.isFilterAllowed(self.FAKE_ALBUM.tracks[7]))
     self.assertTrue(oa.isFilterAllowed(self.FAKE_ALBUM.tracks[3]))
 
+  def test_filter_paths(self):
+    "OutputAlbum filters on paths and regexes"
+    mconfig, oconfig, metadata, oa = self._makeOutputAlbum("album 1")
+    oconfig['filters'] = {'include': ['disc 2/*'], 'exclude': ['re:[Bb]onus']}
+    self.assertTrue(oa.isFilterAllowed(Path('/music/album/disc 2/01.flac')))
+    self.assertFalse(oa.isFilterAllowed(Path('/music/album/disc 1/01.flac')))
+    self.assertFalse(oa.isFilterAllowed(Path('/music/album/disc 2/02 Bonus.flac')))
+
   def test_finalize(self):
     "OutputAlbum finalize()"
     mconfig, oconfig, metadata, oa = self._makeOutputAlbum("album 2")
@@ -165,12 +267,101 @@ class TestOutputAlbum(unittest.TestCase):
     ffmpeg = FFmpegWrapper(source_path=source9)
     oa.incorporate(source9, ffmpeg)
     ffmpeg.run()
+    ffmpeg.complete()
     sig_file = oa.path / Signature.SIGNATURE_FILE_NAME
     self.assertFalse(sig_file.is_file())
     oa.finalize(verbose=False)
     self.assertEqual(len(oa.signature), 1)
     self.assertTrue(sig_file.is_file())
 
+  def test_permissions_inline(self):
+    "OutputAlbum applies permissions as files are written"
+    mconfig, oconfig, metadata, oa = self._makeOutputAlbum("album 3e")
+    oconfig['permissions'].update({'file_mode': '0640', 'inline': True})
+    source9 = self.FAKE_ALBUM.tracks[9]
+    ffmpeg = FFmpegWrapper(source_path=source9)
+    oa.incorporate(source9, ffmpeg)
+    ffmpeg.run()
+    output_path = ffmpeg.expected_outputs[0]
+    self.assertNotEqual(output_path.stat().st_mode & 0o7777, 0o640)
+    ffmpeg.complete()
+    self.assertEqual(output_path.stat().st_mode & 0o7777, 0o640)
+
+  def test_permissions_inline_parents(self):
+    "OutputAlbum applies permissions to every dir it creates"
+    mconfig = ManifestConfig()
+    root = self.OUTPUT_PATH / 'inline perms'
+    oconfig = ManifestOutput({
+      'path': root, 'formats': ['opus'],
+      'permissions': {'dir_mode': '0750', 'inline': True}
+    })
+    root.mkdir()
+    root.chmod(0o755)
+    oa = OutputAlbum(mconfig, oconfig, self.METADATA.copy())
+    oa.prepare(verbose=False)
+    for p in [oa.path] + [p for p in oa.path.parents if root in p.parents]:
+      self.assertEqual(p.stat().st_mode & 0o7777, 0o750, p)
+    self.assertEqual(root.stat().st_mode & 0o7777, 0o755)
+
+  def test_r128gain_batch(self):
+    "OutputAlbum defers r128gain and signature to a batch"
+    batch = R128gainBatch(verbose=False)
+    albums = []
+    for name in ("album 3a", "album 3b", "album 3c"):
+      mconfig, oconfig, metadata, oa = self._makeOutputAlbum(name)
+      mconfig['r128gain']['batch'] = 2
+      source9 = self.FAKE_ALBUM.tracks[9]
+      ffmpeg = FFmpegWrapper(source_path=source9)
+      oa.incorporate(source9, ffmpeg)
+      ffmpeg.run()
+      ffmpeg.complete()
+      oa.finalize(verbose=False, r128gain_batch=batch)
+      albums.append(oa)
+    sig_files = [oa.path / Signature.SIGNATURE_FILE_NAME for oa in albums]
+    self.assertTrue(sig_files[0].is_file())   # first batch was full
+    self.assertTrue(sig_files[1].is_file())
+    self.assertFalse(sig_files[2].is_file())  # still waiting
+    self.assertEqual(len(batch), 1)
+    batch.flush()
+    self.assertTrue(sig_files[2].is_file())
+    self.assertEqual(len(batch), 0)
+
+  def test_r128gain_batch_failure(self):
+    "R128gainBatch leaves albums unsigned when r128gain fails, without raising"
+    batch = R128gainBatch(verbose=False)
+    albums = []
+    for name in ("album 3f", "album 3g"):
+      mconfig, oconfig, metadata, oa = self._makeOutputAlbum(name)
+      mconfig['r128gain'].update({'batch': 5, 'r128gain_path': BIN_FALSE})
+      source9 = self.FAKE_ALBUM.tracks[9]
+      ffmpeg = FFmpegWrapper(source_path=source9)
+      oa.incorporate(source9, ffmpeg)
+      ffmpeg.run()
+      ffmpeg.complete()
+      oa.finalize(verbose=False, r128gain_batch=batch)
+      albums.append(oa)
+    batch.flush()
+    self.assertEqual([oa for oa, e in batch.failures], albums)
+    for oa in albums:
+      self.assertFalse((oa.path / Signature.SIGNATURE_FILE_NAME).is_file())
+    self.assertEqual(len(batch), 0)
+
+  def test_loudness_cache(self):
+    "OutputAlbum tags gains from the loudness cache"
+    mconfig, oconfig, metadata, oa = self._makeOutputAlbum("album 3d")
+    mconfig['r128gain']['mode'] = 'cache'
+    source9 = self.FAKE_ALBUM.tracks[9]
+    ffmpeg = FFmpegWrapper(source_path=source9)
+    oa.incorporate(source9, ffmpeg)
+    ffmpeg.run()
+    ffmpeg.complete()
+    oa.finalize(verbose=False)
+    self.assertIsNotNone(OutputAlbum.loudness_cache.get(source9))
+    output_opus = oa.path / source9.with_suffix('.opus').name
+    tags = mutagen.File(str(output_opus))
+    self.assertIn('R128_TRACK_GAIN', tags)
+    self.assertIn('R128_ALBUM_GAIN', tags)
+
   def test_regenerate_no(self):
     "OutputAlbum leaves existing target unmolested if source doesn't change"
     mconfig, oconfig, metadata, oa = self._makeOutputAlbum("album 4")
@@ -179,6 +370,7 @@ class TestOutputAlbum(unittest.TestCase):
       ffmpeg = FFmpegWrapper(source_path=source_t)
       oa.incorporate(source_t, ffmpeg)
       ffmpeg.run()
+      ffmpeg.complete()
     self.assertTrue(oa.dirty)
     oa.finalize(verbose=False)
     mconfig, oconfig, metadata, oa = self._makeOutputAlbum("album 4")
@@ -200,6 +392,7 @@ class TestOutputAlbum(unittest.TestCase):
       ffmpeg = FFmpegWrapper(source_path=source_t)
       oa.incorporate(source_t, ffmpeg)
       ffmpeg.run()
+      ffmpeg.complete()
     self.assertTrue(oa.dirty)
     oa.finalize(verbose=False)
 
@@ -217,6 +410,7 @@ class TestOutputAlbum(unittest.TestCase):
       oa.incorporate(source_t, ffmpeg)
       self.assertEqual(len(ffmpeg), 1)
       ffmpeg.run()
+      ffmpeg.complete()
     self.assertTrue(oa.dirty)
     files_in_dir = list(oa.path.iterdir())
     self.assertEqual(len(files_in_dir) - 1, len(fake_album.tracks) * 2)
@@ -238,6 +432,7 @@ class TestOutputAlbum(unittest.TestCase):
       ffmpeg = FFmpegWrapper(source_path=source_t)
       oa.incorporate(source_t, ffmpeg)
       ffmpeg.run()
+      ffmpeg.complete()
     oa.finalize(verbose=False)
     self.assertEqual(len(oa.signature), len(fake_album.tracks))
 
@@ -254,6 +449,7 @@ class TestOutputAlbum(unittest.TestCase):
       if source_t.name.startswith('07'):
         self.assertEqual(len(ffmpeg), 1)
         ffmpeg.run()
+        ffmpeg.complete()
       else:
         self.assertEqual(len(ffmpeg), 0)
     self.assertTrue(oa.dirty)
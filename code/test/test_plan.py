@@ -0,0 +1,90 @@
+import unittest
+import subprocess
+import tempfile
+from io import StringIO
+from pathlib import Path
+
+from test.fakesourcetree import FakeSourceTreeAlbum
+
+from util.file import find_in_path
+
+from manifest import ManifestConfig, ManifestOutput
+from input import InputAlbum
+from signature import Signature
+from plan import PLAN_EMITTERS, job_command, job_targets
+
+
+BIN_FFMPEG = find_in_path('ffmpeg')
+
+
+class TestPlan(unittest.TestCase):
+  """ Test exporting the transcoding plan """
+
+  METADATA = {
+    'artist': "DJ Bulklift",
+    'album': "Greatest Hits",
+    'year': 2019,
+    'genre': "Silencecore"
+  }
+
+  CONFIG = {'transcoding': {'ffmpeg_path': BIN_FFMPEG}, 'r128gain': {'type': None}}
+
+  def setUp(self):
+    self.TEMPDIR = tempfile.TemporaryDirectory('bulklift_tests')
+    self.TEMPPATH = Path(self.TEMPDIR.name)
+    self.FAKE_ALBUM = FakeSourceTreeAlbum(self.TEMPPATH / 'source', n_tracks=2)
+    self.OCONFS = [
+      ManifestOutput({'name': 'a', 'path': self.TEMPPATH / 'out a', 'formats': ['opus'], 'enabled': True}),
+      ManifestOutput({
+        'name': 'b', 'path': self.TEMPPATH / 'out:b', 'formats': ['mp3'], 'enabled': True,
+        'staging': str(self.TEMPPATH / 'staging')
+      })
+    ]
+
+  def tearDown(self):
+    self.TEMPDIR.cleanup()
+
+  def album(self):
+    return InputAlbum(
+      self.FAKE_ALBUM.path, ManifestConfig(self.CONFIG), self.OCONFS,
+      metadata=self.METADATA
+    )
+
+  def test_run_and_adopt(self):
+    "Jobs from a plan can be run by the shell and adopted by Bulklift"
+    plan = self.album().plan()
+    self.assertEqual(len(plan), 2)
+    since = int(plan[0].source_path.stat().st_mtime)
+    for job in plan:
+      subprocess.run(job_command(job), shell=True, check=True)
+      self.assertTrue(all(p.is_file() for p in job_targets(job)))
+    self.album().adopt(since=since, verbose=False)
+    for oconf in self.OCONFS:
+      album_dir, = Path(oconf['path']).glob('*/*/*')
+      self.assertTrue((album_dir / Signature.SIGNATURE_FILE_NAME).is_file())
+    self.assertEqual(self.album().plan(), [])
+
+  def test_adopt_missing(self):
+    "Outputs that weren't written by the plan are left to be redone"
+    self.album().adopt(verbose=False)
+    self.assertEqual(len(self.album().plan()), 2)
+
+  def test_emit(self):
+    "Every emitter writes a step for each job and album"
+    ia = self.album()
+    jobs = ia.plan()
+    for name, emitter_class in PLAN_EMITTERS.items():
+      stream = StringIO()
+      emitter = emitter_class(stream, ['bulklift', 'finalize'])
+      emitter.begin()
+      emitter.album(ia, jobs)
+      emitter.end()
+      text = stream.getvalue()
+      self.assertEqual(text.count(BIN_FFMPEG), len(jobs), name)
+      self.assertEqual(text.count('bulklift finalize --since'), 1, name)
+
+  def test_escape(self):
+    "Paths are escaped for ninja and make"
+    ninja, make = PLAN_EMITTERS['ninja'], PLAN_EMITTERS['make']
+    self.assertEqual(ninja.escapePath('/out:b/a $1.mp3'), '/out$:b/a$ $$1.mp3')
+    self.assertEqual(make.escapePath('/out:b/a $1#.mp3'), '/out\\:b/a\\ $$1\\#.mp3')
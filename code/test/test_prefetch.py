@@ -0,0 +1,77 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+from prefetch import Prefetcher
+
+
+class FakeJob(object):
+  """ Stand-in for an FFmpegWrapper reading from `source_path` """
+
+  def __init__(self, source_path):
+    self.source_path = source_path
+    self.input_path = source_path
+
+  def retarget(self, input_path):
+    self.input_path = input_path
+
+
+class TestPrefetcher(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    """ Create a temp dir with a few source files """
+    cls.TEMPDIR = tempfile.TemporaryDirectory('bulklift_tests')
+    cls.TEMPPATH = Path(cls.TEMPDIR.name)
+    cls.SCRATCH_PATH = cls.TEMPPATH / 'scratch'
+    cls.SOURCES = []
+    for n in range(4):
+      source = cls.TEMPPATH / '{:02d} - Track.flac'.format(n)
+      source.write_bytes(b'X' * 1000)
+      cls.SOURCES.append(source)
+
+  @classmethod
+  def tearDownClass(cls):
+    """ Remove temp dir """
+    cls.TEMPDIR.cleanup()
+
+  def test_copy(self):
+    "Prefetcher copies sources locally within its budget"
+    p = Prefetcher(3, mode='copy', budget=2500, scratch_dir=self.SCRATCH_PATH)
+    jobs = [FakeJob(s) for s in self.SOURCES]
+    p.prefetch(jobs)
+    self.assertEqual(len(p.fetches), 2)   # third wouldn't fit the budget
+    job = jobs[0]
+    p.claim(job)
+    self.assertNotEqual(job.input_path, job.source_path)
+    self.assertTrue(job.input_path.is_file())
+    self.assertEqual(job.input_path.parent, self.SCRATCH_PATH)
+    p.release(job, pending=jobs[1:])
+    self.assertFalse(job.input_path.exists())
+    self.assertEqual(p.reserved, 1000)
+    p.shutdown()
+    self.assertEqual(list(self.SCRATCH_PATH.iterdir()), [])
+
+  def test_shared_source(self):
+    "Prefetcher keeps a source while other jobs still need it"
+    p = Prefetcher(2, mode='copy', scratch_dir=self.SCRATCH_PATH)
+    job_a, job_b = FakeJob(self.SOURCES[0]), FakeJob(self.SOURCES[0])
+    p.prefetch([job_a, job_b])
+    p.claim(job_a)
+    p.release(job_a, pending=[job_b])
+    self.assertTrue(job_a.input_path.is_file())
+    p.claim(job_b)
+    p.release(job_b, pending=[])
+    self.assertFalse(job_a.input_path.exists())
+    p.shutdown()
+
+  def test_fadvise(self):
+    "Prefetcher in fadvise mode leaves jobs reading their source"
+    p = Prefetcher(2)
+    job = FakeJob(self.SOURCES[1])
+    p.prefetch([job])
+    p.claim(job)
+    self.assertEqual(job.input_path, job.source_path)
+    p.release(job, pending=[])
+    self.assertEqual(p.reserved, 0)
+    p.shutdown()
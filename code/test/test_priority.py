@@ -0,0 +1,75 @@
+import unittest
+import os
+from unittest import mock
+
+from priority import ProcessPriority, parse_cpu_list, ioprio_set
+from manifest import ManifestConfig, ManifestError
+from wrappers import ExternalCommandWrapper
+from util.file import find_in_path
+
+
+BIN_CAT = find_in_path('cat')
+
+
+class TestProcessPriority(unittest.TestCase):
+
+  def test_parse_cpu_list(self):
+    "parse_cpu_list() understands taskset-style lists"
+    self.assertEqual(parse_cpu_list('0,2-4'), frozenset([0, 2, 3, 4]))
+    self.assertEqual(parse_cpu_list([1, 3]), frozenset([1, 3]))
+    self.assertEqual(parse_cpu_list(2), frozenset([2]))
+
+  def test_from_config(self):
+    "ManifestConfig builds a ProcessPriority only when one is configured"
+    self.assertIsNone(ManifestConfig().process_priority)
+    mconf = ManifestConfig({'transcoding': {'priority': {'nice': 10}}})
+    self.assertEqual(mconf.process_priority.nice, 10)
+    hash(mconf.process_priority)  # used in r128gain batch keys
+    for bad in ({'nice': 40}, {'ionice_class': 'sometimes'},
+                {'sched_policy': 'fifo'}, {'cpus': '4096'}):
+      with self.assertRaises(ManifestError):
+        ManifestConfig({'transcoding': {'priority': bad}}).process_priority
+
+  def test_from_config_once(self):
+    "ManifestConfig validates its ProcessPriority only once"
+    mconf = ManifestConfig({'transcoding': {'priority': {'nice': 10}}})
+    with mock.patch.object(
+      ProcessPriority, 'validate', autospec=True
+    ) as validate:
+      for _ in range(3):
+        self.assertEqual(mconf.process_priority.nice, 10)
+    self.assertEqual(validate.call_count, 1)
+
+  def test_unprivileged(self):
+    "ProcessPriority refuses settings an unprivileged process can't apply"
+    current = os.getpriority(os.PRIO_PROCESS, 0)
+    with mock.patch('priority.os.geteuid', return_value=1000), \
+         mock.patch('priority.resource.getrlimit', return_value=(0, 0)):
+      ProcessPriority(min(current + 1, 19), None, None, None, None).validate()
+      if current > -20:
+        with self.assertRaises(ValueError):
+          ProcessPriority(current - 1, None, None, None, None).validate()
+      with self.assertRaises(ValueError):
+        ProcessPriority(None, 'realtime', 0, None, None).validate()
+
+  def test_apply(self):
+    "Commands run with a ProcessPriority get its settings"
+    if not hasattr(os, 'sched_setaffinity'):
+      self.skipTest("no cpu affinity on this platform")
+    cpu = min(os.sched_getaffinity(0))
+    priority = ProcessPriority(
+      nice=min(os.getpriority(os.PRIO_PROCESS, 0) + 5, 19),
+      ionice_class='best-effort' if ioprio_set else None,
+      ionice_level=7 if ioprio_set else None,
+      sched_policy='batch', cpus=frozenset([cpu])
+    )
+    ecw = ExternalCommandWrapper(
+      binary=BIN_CAT, args=['/proc/self/stat', '/proc/self/status'],
+      priority=priority
+    )
+    out = ecw.run().stdout.decode()
+    stat, status = out.split('\n', 1)
+    fields = stat.rsplit(')', 1)[1].split()
+    self.assertEqual(int(fields[16]), priority.nice)        # nice
+    self.assertEqual(int(fields[38]), os.SCHED_BATCH)      # policy
+    self.assertIn("Cpus_allowed_list:\t{}\n".format(cpu), status)
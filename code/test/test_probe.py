@@ -0,0 +1,53 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+from probe import ProbeIndex, ProbeResult, probe_file
+from wrappers import FFmpegWrapper, SoxWrapper
+
+
+class TestProbe(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    """ Create a temp dir with a test tone in a few formats """
+    cls.TEMPDIR = tempfile.TemporaryDirectory('bulklift_tests')
+    cls.TEMPPATH = Path(cls.TEMPDIR.name)
+    cls.INPUT_FLAC = cls.TEMPPATH / 'test.flac'
+    SoxWrapper(output_path=cls.INPUT_FLAC, duration=2).run()
+    cls.INPUT_OPUS = cls.TEMPPATH / 'test.opus'
+    ffmpeg = FFmpegWrapper(cls.INPUT_FLAC)
+    ffmpeg.appendOutputOpus(cls.INPUT_OPUS)
+    ffmpeg.run()
+
+  @classmethod
+  def tearDownClass(cls):
+    """ Remove temp dir """
+    cls.TEMPDIR.cleanup()
+
+  def test_probe_file(self):
+    "probe_file reports stream properties"
+    flac = probe_file(self.INPUT_FLAC)
+    self.assertEqual(flac.codec, 'flac')
+    self.assertAlmostEqual(flac.duration, 2.0, places=1)
+    self.assertEqual(flac.sample_rate, 48000)
+    self.assertTrue(flac.lossless)
+    opus = probe_file(self.INPUT_OPUS)
+    self.assertEqual(opus.codec, 'opus')
+    self.assertFalse(opus.lossless)
+    self.assertIsNone(probe_file(self.TEMPPATH).codec)   # not a file
+
+  def test_probe_index(self):
+    "ProbeIndex probes in bulk and persists results"
+    index_path = self.TEMPPATH / 'probes.pickle'
+    junk = self.TEMPPATH / 'junk.mp3'
+    junk.write_bytes(b'not audio')
+    index = ProbeIndex(path=index_path)
+    results = index.probeAll([self.INPUT_FLAC, self.INPUT_OPUS, junk])
+    self.assertEqual(results[self.INPUT_FLAC].codec, 'flac')
+    self.assertEqual(results[self.INPUT_OPUS].codec, 'opus')
+    self.assertIsNone(results[junk])
+    index.save()
+    index = ProbeIndex(path=index_path)
+    self.assertIsInstance(index.get(self.INPUT_FLAC), ProbeResult)
+    self.assertIsNotNone(index.get(junk))   # remembered as unreadable
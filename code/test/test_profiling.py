@@ -0,0 +1,43 @@
+import unittest
+import tempfile
+import threading
+import pstats
+from pathlib import Path
+
+from metrics import Metrics
+from profiling import PhaseProfiler
+
+
+def busy_function_6613():
+  return sorted(str(n) for n in range(20000))
+
+
+class TestPhaseProfiler(unittest.TestCase):
+
+  def test_profile_phases(self):
+    "PhaseProfiler writes stats and a summary for each phase"
+    m = Metrics(prefix='test')
+    m.describe('phase_seconds_total', 'counter', "Time in each phase")
+    with tempfile.TemporaryDirectory('bulklift_tests') as t:
+      profiler = PhaseProfiler(t, top=5)
+      m.phase_hooks.append(profiler.profile)
+      profiler.start()
+      with m.phase('plan'):
+        busy_function_6613()
+      def walk():
+        with m.phase('walk'):
+          busy_function_6613()
+      thread = threading.Thread(target=walk)
+      thread.start()
+      thread.join()
+      summary = profiler.finish()
+      self.assertEqual(
+        sorted(p.name for p in Path(t).iterdir()),
+        ['plan.pstats', 'summary.txt', 'walk.pstats']
+      )
+      stats = pstats.Stats(str(Path(t) / 'walk.pstats'))
+      self.assertIn(
+        'busy_function_6613', [func for f, l, func in stats.stats]
+      )
+      self.assertIn('plan: ', summary)
+      self.assertIn('peak traced memory', summary)
@@ -0,0 +1,154 @@
+import unittest
+import datetime
+import time
+
+from scheduler import JobScheduler, Deadline
+
+
+class FakeJob(object):
+  """ Stand-in for an FFmpegWrapper with a number of named outputs """
+
+  def __init__(self, *outputs, duration=None):
+    self.outputs = list(outputs)
+    self.duration = duration
+
+  def __len__(self):
+    return len(self.outputs)
+
+  def split(self):
+    return [FakeJob(o, duration=self.duration) for o in self.outputs]
+
+
+class TestJobScheduler(unittest.TestCase):
+
+  def test_keep_whole_when_deep(self):
+    "JobScheduler keeps multi-output jobs whole while the queue is deep"
+    s = JobScheduler(threads=2)
+    for n in range(4):
+      s.add(FakeJob('opus', 'mp3'))
+    self.assertEqual(len(s.next()), 2)
+    self.assertEqual(len(s.next()), 2)
+    self.assertEqual(len(s), 2)
+
+  def test_split_at_tail(self):
+    "JobScheduler splits multi-output jobs once fewer are pending than workers"
+    s = JobScheduler(threads=4)
+    s.add(FakeJob('opus', 'mp3', 'flac'))
+    s.add(FakeJob('opus', 'mp3'))
+    job = s.next()
+    self.assertEqual(job.outputs, ['opus'])
+    self.assertEqual(len(s), 3)           # the split-offs queue up first
+    self.assertEqual(s.next().outputs, ['mp3'])
+    self.assertEqual(s.next().outputs, ['flac'])
+
+  def test_split_modes(self):
+    "JobScheduler honours 'always' and 'never' split modes"
+    s = JobScheduler(threads=8, split_outputs='never')
+    s.add(FakeJob('opus', 'mp3'))
+    self.assertEqual(len(s.next()), 2)
+    s = JobScheduler(threads=1, split_outputs='always')
+    s.add(FakeJob('opus', 'mp3'))
+    s.add(FakeJob('opus', 'mp3'))
+    self.assertEqual(len(s.next()), 1)
+    with self.assertRaises(ValueError):
+      JobScheduler(threads=1, split_outputs='sometimes')
+
+  def test_run(self):
+    "JobScheduler runs every job and records failures"
+    done = []
+    def func(job):
+      if job.outputs == ['bad']:
+        raise RuntimeError("broken job")
+      done.extend(job.outputs)
+    s = JobScheduler(threads=3)
+    s.add(FakeJob('opus', 'mp3'))
+    s.add(FakeJob('bad'))
+    s.add(FakeJob('flac'))
+    s.run(func)
+    self.assertEqual(sorted(done), ['flac', 'mp3', 'opus'])
+    self.assertEqual(len(s.failures), 1)
+    self.assertEqual(len(s), 0)
+
+  def test_run_io_failure(self):
+    "JobScheduler records failures in the IO pool as such"
+    def io_func(job):
+      if job.outputs == ['bad']:
+        raise OSError("No space left on device")
+    s = JobScheduler(threads=2)
+    s.add(FakeJob('bad'))
+    s.add(FakeJob('flac'))
+    s.run(lambda job: None, io_func=io_func)
+    (job, e, io), = s.failures
+    self.assertEqual(job.outputs, ['bad'])
+    self.assertTrue(io)
+
+  def test_retries(self):
+    "JobScheduler retries failing jobs before recording them as failures"
+    attempts = []
+    def func(job):
+      attempts.append(job.outputs[0])
+      if job.outputs == ['bad'] or attempts.count('flaky') < 2:
+        raise RuntimeError("broken job")
+    s = JobScheduler(threads=1, retries=2)
+    s.add(FakeJob('flaky'))
+    s.add(FakeJob('bad'))
+    s.run(func)
+    self.assertEqual(attempts.count('flaky'), 2)
+    self.assertEqual(attempts.count('bad'), 3)
+    self.assertEqual([j.outputs for j, e, io in s.failures], [['bad']])
+
+
+class TestDeadline(unittest.TestCase):
+
+  def test_from_clock(self):
+    "Deadline.fromClock() picks the next occurrence of a time of day"
+    now = datetime.datetime(2020, 1, 1, 12, 0)
+    self.assertEqual(
+      Deadline.fromClock('13:30', now=now).at,
+      datetime.datetime(2020, 1, 1, 13, 30).timestamp()
+    )
+    self.assertEqual(
+      Deadline.fromClock('06:00', now=now).at,
+      datetime.datetime(2020, 1, 2, 6, 0).timestamp()
+    )
+    with self.assertRaises(ValueError):
+      Deadline.fromClock('teatime')
+
+  def test_estimate(self):
+    "Deadline estimates jobs from the speed of those already run"
+    d = Deadline.fromDuration(100)
+    self.assertEqual(d.estimate(FakeJob('opus', duration=300)), 0)
+    d.observe(FakeJob('opus', 'mp3', duration=300), 20)   # 30x realtime
+    self.assertAlmostEqual(d.estimate(FakeJob('opus', duration=600)), 20)
+    self.assertAlmostEqual(d.estimate(FakeJob('opus')), 10)
+    self.assertTrue(d.allows(FakeJob('opus', duration=600)))
+    self.assertFalse(d.allows(FakeJob('opus', duration=6000)))
+    self.assertFalse(d.missed)   # a shorter job may yet fit
+
+  def test_scheduler_deadline(self):
+    "JobScheduler only starts jobs expected to finish before its deadline"
+    d = Deadline.fromDuration(100)
+    d.observe(FakeJob('opus', duration=100), 10)    # 10x realtime
+    s = JobScheduler(threads=1, deadline=d)
+    s.add(FakeJob('opus', duration=3000))           # ~300s; won't fit
+    s.add(FakeJob('opus', duration=300))            # ~30s
+    s.add(FakeJob('opus', duration=3000))
+    self.assertEqual(s.next().duration, 300)
+    self.assertFalse(d.missed)
+    self.assertIsNone(s.next())
+    self.assertEqual(len(s), 2)
+    self.assertTrue(d.missed)
+    self.assertFalse(d.passed)
+    # The next album's jobs are judged on their own cost
+    s = JobScheduler(threads=1, deadline=d)
+    s.add(FakeJob('opus', duration=300))
+    self.assertEqual(s.next().duration, 300)
+
+  def test_deadline_passed(self):
+    "JobScheduler starts nothing once its deadline has passed"
+    done = []
+    s = JobScheduler(threads=2, deadline=Deadline(time.time() - 1))
+    s.add(FakeJob('opus'))
+    s.run(lambda j: done.append(j))
+    self.assertEqual(done, [])
+    self.assertEqual(len(s), 1)
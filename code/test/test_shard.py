@@ -0,0 +1,24 @@
+import unittest
+
+from shard import Shard
+
+
+class TestShard(unittest.TestCase):
+
+  def test_from_spec(self):
+    "Shard.fromSpec() parses i/n and rejects anything else"
+    self.assertEqual(Shard.fromSpec('2/4'), Shard(2, 4))
+    self.assertEqual(str(Shard.fromSpec('1/1')), '1/1')
+    for bad in ('0/4', '5/4', '2', '2/', 'a/b', '-1/4', '1/0'):
+      with self.assertRaises(ValueError):
+        Shard.fromSpec(bad)
+
+  def test_contains(self):
+    "Every album belongs to exactly one shard, the same one every time"
+    paths = ['Artist {}/Album {}'.format(a, b) for a in range(20) for b in range(5)]
+    shards = [Shard(i, 4) for i in range(1, 5)]
+    for p in paths:
+      self.assertEqual(sum(s.contains(p) for s in shards), 1)
+    self.assertEqual(Shard.of('Artist 1/Album 1', 4), 2)   # stable hash
+    counts = [sum(s.contains(p) for p in paths) for s in shards]
+    self.assertTrue(all(c > 10 for c in counts), counts)
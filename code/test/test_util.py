@@ -1,11 +1,15 @@
 import unittest
 from pathlib import Path
 import tempfile
+import time
 
 from test.fakesourcetree import FakeSourceTreeAlbum
-from util.file import is_audio_dir
-from util.sanitize import dummy_sanitize, vfat_sanitize
-from util.data import dict_not_nulls, available_cpu_count
+from util.file import is_audio_dir, DirSnapshot, compile_filters
+from util.sanitize import dummy_sanitize, vfat_sanitize, exfat_sanitize, \
+  ntfs_sanitize, mtp_sanitize, ascii_transliterate_sanitize, \
+  FILENAME_SANITIZERS
+from util.data import dict_not_nulls, available_cpu_count, parse_size, \
+  parse_duration, background_iter
 
 
 class TestDictNotNulls(unittest.TestCase):
@@ -42,6 +46,59 @@ class TestVfatSanitize(unittest.TestCase):
     )
 
 
+class TestSanitizers(unittest.TestCase):
+
+  def test_exfat_sanitize(self):
+    "Sanitize filenames for exfat"
+    self.assertEqual(
+      exfat_sanitize(Path('/AC:DC/Who?/Ça va.  ')), Path('/ACDC/Who/Ça va')
+    )
+    self.assertEqual(exfat_sanitize('a*b', replace='_'), Path('a_b'))
+
+  def test_ntfs_sanitize(self):
+    "Sanitize filenames for ntfs, escaping reserved names"
+    self.assertEqual(ntfs_sanitize(Path('Aux/con.mp3')), Path('_Aux/_con.mp3'))
+    self.assertEqual(ntfs_sanitize(Path('Console/x.mp3')), Path('Console/x.mp3'))
+
+  def test_ascii_transliterate_sanitize(self):
+    "Sanitize filenames by transliterating them to ascii"
+    self.assertEqual(
+      ascii_transliterate_sanitize(Path('Motörhead/Straße/Björk’s “Hits”')),
+      Path('Motorhead/Strasse/Bjork\'s Hits')
+    )
+
+  def test_empty_component(self):
+    "Sanitizers keep components with nothing left of them as '_'"
+    self.assertEqual(exfat_sanitize(Path('Artist/.../01.opus')), Path('Artist/_/01.opus'))
+    self.assertEqual(mtp_sanitize(Path('Artist/ . /01.opus')), Path('Artist/_/01.opus'))
+    self.assertEqual(
+      ascii_transliterate_sanitize(Path('Artist/。/01.opus')), Path('Artist/_/01.opus')
+    )
+    self.assertEqual(vfat_sanitize(Path('Artist/???/01.mp3')), Path('Artist/_/01.mp3'))
+
+  def test_length_limits(self):
+    "Sanitizers truncate long components, keeping the extension"
+    name = 'é' * 200 + '.opus'
+    sanitized = mtp_sanitize(Path('album') / name)
+    self.assertEqual(sanitized.parent, Path('album'))
+    self.assertLessEqual(len(sanitized.name.encode('utf8')), 255)
+    self.assertTrue(sanitized.name.endswith('é.opus'))
+    self.assertEqual(len(exfat_sanitize('é' * 300 + '.opus').name), 255)
+    self.assertEqual(len(vfat_sanitize('x' * 300 + '.mp3').name), 255)
+
+  def test_memoized(self):
+    "Sanitizers memoize path components"
+    hits = vfat_sanitize.sanitizeComponent.cache_info().hits
+    vfat_sanitize(Path('memo/ized'))
+    vfat_sanitize(Path('memo/ized'))
+    self.assertEqual(vfat_sanitize.sanitizeComponent.cache_info().hits, hits + 2)
+
+  def test_registry(self):
+    "Sanitizers are published by name"
+    for name in ('vfat', 'exfat', 'ntfs', 'mtp', 'ascii-transliterate'):
+      self.assertIn(name, FILENAME_SANITIZERS)
+
+
 class TestIsAudioDir(unittest.TestCase):
 
   @classmethod
@@ -67,3 +124,135 @@ class TestIsAudioDir(unittest.TestCase):
     self.assertTrue(is_audio_dir(self.FAKE_ALBUM.path))
     self.assertFalse(is_audio_dir(self.EMPTY_ALBUM_PATH))
 
+
+
+class TestParseSize(unittest.TestCase):
+
+  def test_parse_size(self):
+    "parse_size() understands ints and suffixed strings"
+    self.assertEqual(parse_size(None), None)
+    self.assertEqual(parse_size(4096), 4096)
+    self.assertEqual(parse_size('100'), 100)
+    self.assertEqual(parse_size('512k'), 512 * 1024)
+    self.assertEqual(parse_size('2G'), 2 * 1024**3)
+    self.assertEqual(parse_size('1.5MB'), int(1.5 * 1024**2))
+    with self.assertRaises(ValueError):
+      parse_size('lots')
+
+  def test_parse_duration(self):
+    "parse_duration() understands numbers and suffixed strings"
+    self.assertEqual(parse_duration(None), None)
+    self.assertEqual(parse_duration(90), 90)
+    self.assertEqual(parse_duration('90'), 90)
+    self.assertEqual(parse_duration('5h'), 5 * 3600)
+    self.assertEqual(parse_duration('4h30m'), 4.5 * 3600)
+    for bad in ('', 'soon', '4x', 'h'):
+      with self.assertRaises(ValueError):
+        parse_duration(bad)
+
+
+class TestDirSnapshot(unittest.TestCase):
+
+  def test_dir_snapshot(self):
+    "DirSnapshot lists a dir once and tracks our own changes"
+    with tempfile.TemporaryDirectory('bulklift_tests') as tmpdir:
+      path = Path(tmpdir)
+      path.joinpath('track.opus').write_bytes(b'X' * 10)
+      path.joinpath('subdir').mkdir()
+      snap = DirSnapshot(path)
+      self.assertEqual(sorted(snap), ['subdir', 'track.opus'])
+      self.assertEqual(snap.files(), ['track.opus'])
+      self.assertEqual(snap.stat('track.opus').st_size, 10)
+      self.assertEqual(snap.stat_path(path / 'track.opus').st_size, 10)
+      path.joinpath('cover.gif').touch()
+      self.assertNotIn('cover.gif', snap)     # not until we're told
+      snap.add('cover.gif')
+      self.assertTrue(snap.is_file('cover.gif'))
+      snap.discard('track.opus')
+      self.assertEqual(sorted(snap.files()), ['cover.gif'])
+      snap.refresh()
+      self.assertEqual(len(snap), 3)
+      self.assertEqual(len(DirSnapshot(path / 'nonexistent')), 0)
+
+
+class TestBackgroundIter(unittest.TestCase):
+
+  def test_background_iter(self):
+    "background_iter() yields everything in order"
+    self.assertEqual(list(background_iter(range(50), maxsize=2)), list(range(50)))
+
+  def test_background_iter_error(self):
+    "background_iter() re-raises exceptions from the producer"
+    def broken():
+      yield 1
+      raise ValueError("broken")
+    it = background_iter(broken())
+    self.assertEqual(next(it), 1)
+    with self.assertRaises(ValueError):
+      next(it)
+
+  def test_background_iter_close(self):
+    "background_iter() stops the producer when closed early"
+    produced = []
+    def counting():
+      for n in range(1000):
+        produced.append(n)
+        yield n
+    it = background_iter(counting(), maxsize=1)
+    self.assertEqual(next(it), 0)
+    it.close()
+    time.sleep(0.1)
+    self.assertLess(len(produced), 10)
+
+  def test_background_iter_close_waits(self):
+    "background_iter() waits for the producer to finish its item when closed"
+    busy = []
+    def slow():
+      for n in range(10):
+        busy.append(n)
+        time.sleep(0.2)
+        busy.remove(n)
+        yield n
+    it = background_iter(slow(), maxsize=1)
+    self.assertEqual(next(it), 0)
+    time.sleep(0.05)   # the producer is now busy with the next item
+    it.close()
+    self.assertEqual(busy, [])
+
+
+class TestCompileFilters(unittest.TestCase):
+
+  def test_globs(self):
+    "compile_filters() matches plain globs against the filename"
+    f = compile_filters(('05*', '*.mp3', '0[!7]-x?.flac'))
+    self.assertTrue(f.search('/music/album/05 - Track.flac'))
+    self.assertTrue(f.search('/music/album/01 - Track.mp3'))
+    self.assertTrue(f.search('/music/album/03-xy.flac'))
+    self.assertFalse(f.search('/music/album/07-xy.flac'))
+    self.assertFalse(f.search('/music/05 album/01 - Track.flac'))
+    self.assertIsNone(compile_filters(()))
+
+  def test_paths(self):
+    "compile_filters() matches globs with a '/' against trailing components"
+    f = compile_filters(('disc 2/*',))
+    self.assertTrue(f.search('/music/album/disc 2/01 - Track.flac'))
+    self.assertFalse(f.search('/music/album/disc 1/01 - Track.flac'))
+    self.assertFalse(f.search('/music/album/disc 2/extra/01 - Track.flac'))
+    f = compile_filters(('/music/*/*.flac',))
+    self.assertTrue(f.search('/music/album/01 - Track.flac'))
+    self.assertFalse(f.search('/other/music/album/01 - Track.flac'))
+
+  def test_regex(self):
+    "compile_filters() searches for re: patterns anywhere in the path"
+    f = compile_filters((r're:/0[1-3] - [^/]*$', '10*'))
+    self.assertTrue(f.search('/music/album/02 - Track.flac'))
+    self.assertTrue(f.search('/music/album/10 - Track.flac'))
+    self.assertFalse(f.search('/music/album/04 - Track.flac'))
+
+  def test_regex_flags_groups(self):
+    "compile_filters() keeps each re: pattern's flags and groups to itself"
+    f = compile_filters(('re:(?i)bonus', r're:/(\d)\1 - ', '*.mp3'))
+    self.assertTrue(f.search('/music/album/13 - BONUS Track.flac'))
+    self.assertTrue(f.search('/music/album/22 - Track.flac'))
+    self.assertTrue(f.search('/music/album/01 - Track.mp3'))
+    self.assertFalse(f.search('/music/album/12 - Track.flac'))
@@ -1,7 +1,7 @@
 import unittest
 import tempfile
 from pathlib import Path
-from subprocess import CalledProcessError
+from subprocess import CalledProcessError, TimeoutExpired
 
 from wrappers import ExternalCommandWrapper, R128gainWrapper, FFmpegWrapper, \
                      SoxWrapper, ExternalCommandError, NothingToDoError
@@ -41,6 +41,13 @@ class TestExternalCommandWrapper(unittest.TestCase):
     with self.assertRaises(FileNotFoundError):
       ecr.run()
 
+  def test_timeout(self):
+    "ExternalCommandWrapper kills commands that outlive their timeout"
+    ecr = ExternalCommandWrapper(binary=find_in_path('sleep'), args=['10'])
+    ecr.timeout = 0.2
+    with self.assertRaises(TimeoutExpired):
+      ecr.run()
+
   def test_expected_outputs(self):
     "ExternalCommandWrapper checks for expected outputs"
     file_present = Path(self.TEMPDIR.name) / 'empty_file'
@@ -115,6 +122,39 @@ class TestFFmpegWrapper(unittest.TestCase):
     ffmpeg.appendOutputCopy(output_file_copy)
     ffmpeg.run()
 
+  def test_split(self):
+    "FFmpegWrapper splits into one job per output"
+    ffmpeg = FFmpegWrapper(self.INPUT_FLAC, metadata=self.METADATA)
+    self.assertEqual(ffmpeg.split(), [ffmpeg])
+    output_file_opus = Path(self.TEMPDIR.name) / 'test_split.opus'
+    ffmpeg.appendOutputOpus(output_file_opus)
+    self.assertEqual(ffmpeg.split(), [ffmpeg])
+    output_file_mp3 = Path(self.TEMPDIR.name) / 'test_split.mp3'
+    ffmpeg.appendOutputLame(output_file_mp3)
+    job_opus, job_mp3 = ffmpeg.split()
+    self.assertEqual(job_opus.expected_outputs, [output_file_opus])
+    self.assertEqual(job_opus.output_codecs, ['opus'])
+    self.assertNotIn(str(output_file_mp3), job_opus.args)
+    self.assertEqual(job_mp3.expected_outputs, [output_file_mp3])
+    self.assertNotIn(str(output_file_opus), job_mp3.args)
+    self.assertEqual(len(ffmpeg), 2)  # original is untouched
+    job_opus.run()
+    job_mp3.run()
+
+  def test_threads(self):
+    "FFmpegWrapper limits decoding and every output to `threads` threads"
+    ffmpeg = FFmpegWrapper(self.INPUT_FLAC, threads=2)
+    output_file_opus = Path(self.TEMPDIR.name) / 'test_threads.opus'
+    ffmpeg.appendOutputOpus(output_file_opus)
+    output_file_mp3 = Path(self.TEMPDIR.name) / 'test_threads.mp3'
+    ffmpeg.appendOutputLame(output_file_mp3)
+    self.assertEqual(ffmpeg.args.count('-threads'), 3)
+    self.assertLess(ffmpeg.args.index('-threads'), ffmpeg.args.index('-i'))
+    job_opus, job_mp3 = ffmpeg.split()
+    self.assertEqual(job_mp3.args.count('-threads'), 2)
+    ffmpeg.run()
+    self.assertTrue(output_file_mp3.is_file())
+
 
 class TestR128gainWrapper(unittest.TestCase):
   """ Test r128gain command wrapper against an empty temp dir """
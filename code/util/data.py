@@ -2,6 +2,17 @@
 
 import collections.abc
 import os
+import queue
+import re
+import threading
+
+import yaml
+
+# libyaml's C implementation is many times faster, where it's available
+try:
+  from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+  from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
 
 def dict_deep_merge(a, b):
@@ -26,9 +37,90 @@ def dict_not_nulls(d, unwanted=(None, {}, [])):
   return new
 
 
+def yaml_load(stream):
+  """ Safely parse yaml from `stream`, which may also be a string """
+  return yaml.load(stream, Loader=YamlLoader)
+
+
+def yaml_dump(data, stream=None, **kwargs):
+  """ Safely dump `data` as yaml, as yaml.safe_dump() does """
+  return yaml.dump(data, stream, Dumper=YamlDumper, **kwargs)
+
+
+def background_iter(iterable, maxsize=1):
+  """ Iterate over `iterable` in a background thread, passing its items
+      through a queue of at most `maxsize` so the producer never runs far ahead
+      of the consumer.  Exceptions raised by the producer are re-raised in the
+      consumer.  Once the consumer stops, e.g. by closing the generator, the
+      producer is waited for, so nothing it touches is left in use.  """
+  q = queue.Queue(maxsize=maxsize)
+  stop = threading.Event()
+  done = object()
+  def produce():
+    try:
+      for item in iterable:
+        if stop.is_set():
+          return
+        q.put((item, None))
+      q.put((done, None))
+    except Exception as e:
+      q.put((done, e))
+  producer = threading.Thread(target=produce, daemon=True)
+  producer.start()
+  try:
+    while True:
+      item, exc = q.get()
+      if item is done:
+        if exc is not None:
+          raise exc
+        return
+      yield item
+  finally:
+    stop.set()
+    while producer.is_alive():
+      try:    # unblock the producer so it can notice we've stopped
+        while True:
+          q.get_nowait()
+      except queue.Empty:
+        pass
+      producer.join(0.05)
+
+
 def available_cpu_count():
   """ Return a sensible estimate for the max. number of cores available """
   try:
     return len(os.sched_getaffinity(0))
   except AttributeError:
     return os.cpu_count()
+
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+RE_DURATION = re.compile(r'([0-9]+(?:\.[0-9]+)?)([smhd]?)')
+
+def parse_duration(duration):
+  """ Return the number of seconds given by `duration`, which may be a number
+      or a string of suffixed parts like '90m' or '4h30m'; an unsuffixed part
+      is seconds.  None is returned unchanged.  """
+  if duration is None or isinstance(duration, (int, float)):
+    return duration
+  s = str(duration).strip().lower().replace(' ', '')
+  parts = RE_DURATION.findall(s)
+  if not s or ''.join(n + u for n, u in parts) != s:
+    raise ValueError("Invalid duration '{}'".format(duration))
+  return sum(float(n) * DURATION_UNITS[u or 's'] for n, u in parts)
+
+
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parse_size(size):
+  """ Return the number of bytes given by `size`, which may be an int or a
+      string with an optional suffix like '512M' or '2G'.  None is returned
+      unchanged, which is useful for handling config settings.  """
+  if size is None or isinstance(size, int):
+    return size
+  s = str(size).strip().upper().rstrip('B')
+  suffix = s[-1:] if s[-1:] in SIZE_SUFFIXES else ''
+  try:
+    return int(float(s[:len(s)-len(suffix)]) * SIZE_SUFFIXES[suffix])
+  except ValueError:
+    raise ValueError("Invalid size '{}'".format(size))
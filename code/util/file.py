@@ -2,6 +2,14 @@
 
 from pathlib import Path
 import os.path
+import errno
+import functools
+import grp
+import pwd
+import pickle
+import re
+import shutil
+import threading
 
 
 ##
@@ -25,19 +33,224 @@ IMAGE_FORMATS = dict.fromkeys([
 ])
 
 
+##
+# Utility classes
+##
+
+class DirSnapshot(object):
+  """ A listing of a single directory taken in one os.scandir() pass.  Its
+      DirEntry objects cache their stat() results, so repeated existence, type
+      and mtime checks cost no further syscalls.  Call refresh() once the dir
+      has been changed behind our back.  """
+
+  def __init__(self, path):
+    """ Initialize a snapshot of the dir at `path`, which needn't exist """
+    super(DirSnapshot, self).__init__()
+    self.path = Path(path)
+    self.refresh()
+
+  def refresh(self):
+    """ (Re)read the directory listing """
+    try:
+      with os.scandir(str(self.path)) as it:
+        self.entries = {e.name: e for e in it}
+    except FileNotFoundError:
+      self.entries = {}
+
+  def __contains__(self, name):
+    """ Return True if `name` exists in the dir """
+    return name in self.entries
+
+  def __iter__(self):
+    """ Iterate over the names of everything in the dir """
+    return iter(list(self.entries))
+
+  def __len__(self):
+    return len(self.entries)
+
+  def add(self, name):
+    """ Record that we've created `name` in the dir """
+    self.entries[name] = None   # stat()ed on demand
+
+  def discard(self, name):
+    """ Record that `name` has been removed from the dir """
+    self.entries.pop(name, None)
+
+  def is_file(self, name):
+    """ Return True if `name` is a regular file """
+    entry = self.entries[name]
+    if entry is None:
+      return self.path.joinpath(name).is_file()
+    return entry.is_file()
+
+  def files(self):
+    """ Return a list of the names of regular files in the dir """
+    return [name for name in self.entries if self.is_file(name)]
+
+  def stat(self, name):
+    """ Return the stat() result for `name` """
+    entry = self.entries[name]
+    if entry is None:
+      return self.path.joinpath(name).stat()
+    return entry.stat()
+
+  def stat_path(self, path):
+    """ Return the stat() result for Path `path`, from the snapshot if it
+        lies within our dir """
+    if path.parent == self.path and path.name in self.entries:
+      return self.stat(path.name)
+    return path.stat()
+
+
+class SourceFileCache(object):
+  """ Base for on-disk caches of data derived from source files.  Entries are
+      keyed by path and only returned while the file's (size, mtime) still
+      match those it had when the data was derived.  The whole cache is
+      pickled to a single file in the user's cache dir.  """
+
+  CACHE_FILE_NAME = None
+
+  # Bump this whenever the format of cached data changes
+  VERSION = 1
+
+  def __init__(self, path=None, load=True):
+    """ Initialize the cache, loading it from `path` if that exists and `load`
+        is True """
+    super(SourceFileCache, self).__init__()
+    self.path = Path(path) if path else user_cache_dir() / self.CACHE_FILE_NAME
+    self.entries = {}   # str(source) -> (fingerprint, data)
+    self.lock = threading.Lock()
+    self.dirty = False
+    if load:
+      self.load()
+
+  @staticmethod
+  def fingerprint(source_path, st=None):
+    """ Return a key representing the state of the file at `source_path`.  Pass
+        its stat() result as `st` if you already have it.  """
+    if st is None:
+      st = os.stat(str(source_path))
+    return (st.st_size, st.st_mtime_ns)
+
+  def get(self, source_path, st=None):
+    """ Return data cached for `source_path`, or None if we don't have any or
+        the file has changed """
+    try:
+      fingerprint, data = self.entries[str(source_path)]
+    except KeyError:
+      return None
+    if self.fingerprint(source_path, st) != fingerprint:
+      return None
+    return data
+
+  def put(self, source_path, data, fingerprint=None):
+    """ Store `data` for `source_path` """
+    if fingerprint is None:
+      fingerprint = self.fingerprint(source_path)
+    with self.lock:
+      self.entries[str(source_path)] = (fingerprint, data)
+      self.dirty = True
+
+  def load(self):
+    """ Load the cache from disk.  A missing or unreadable cache is treated as
+        empty; it will be rebuilt.  """
+    try:
+      with self.path.open('rb') as stream:
+        version, entries = pickle.load(stream)
+    except (OSError, EOFError, ValueError, TypeError, AttributeError,
+            pickle.UnpicklingError):
+      return
+    if version == self.VERSION:
+      self.entries = entries
+
+  def save(self):
+    """ Save the cache to disk, if it has changed """
+    if not self.dirty:
+      return
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = self.path.with_name(self.path.name + '.tmp')
+    with self.lock:
+      with tmp_path.open('wb') as stream:
+        pickle.dump((self.VERSION, self.entries), stream, pickle.HIGHEST_PROTOCOL)
+      self.dirty = False
+    os.replace(str(tmp_path), str(self.path))
+
+
 ##
 # Utility functions
 ##
 
-def filename_matches_globs(path, globs=[]):
-  """ Return True if the *filename* at end of `path` matches any of the
-      supplied list of glob patterns  """
-  f = path.relative_to(path.parent)
-  # print("filename for matching: {}".format(f))
-  for g in globs:
-    if f.match(g):
-      return True
-  return False
+def glob_to_regex(glob):
+  """ Translate a glob into a regex string.  Unlike fnmatch, wildcards never
+      match across a '/', as with PurePath.match().  """
+  i, n, res = 0, len(glob), ''
+  while i < n:
+    c = glob[i]
+    i += 1
+    if c == '*':
+      res += '[^/]*'
+    elif c == '?':
+      res += '[^/]'
+    elif c == '[':
+      j = i
+      if j < n and glob[j] == '!':
+        j += 1
+      if j < n and glob[j] == ']':
+        j += 1
+      j = glob.find(']', j)
+      if j < 0:
+        res += re.escape(c)
+      else:
+        stuff = glob[i:j].replace('\\', '\\\\')
+        if stuff.startswith('!'):
+          stuff = '^' + stuff[1:]
+        res += '[{}]'.format(stuff)
+        i = j + 1
+    else:
+      res += re.escape(c)
+  return res
+
+
+class PathFilter(object):
+  """ A set of compiled filters, any of which may match a path """
+
+  def __init__(self, regexes):
+    """ Initialize the filter from a list of compiled regexes """
+    super(PathFilter, self).__init__()
+    self.regexes = regexes
+
+  def search(self, path_s):
+    """ Return True if any of our regexes is found in posix path `path_s` """
+    return any(r.search(path_s) for r in self.regexes)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_filters(patterns):
+  """ Compile a tuple of filter `patterns` into a PathFilter to be searched
+      for in a path's posix string.  Returns None if there are no patterns.
+
+      - plain globs (`05*`, `*.flac`) match the filename
+      - globs containing a '/' (`disc 2/*`) match the trailing components of
+        the path; a leading '/' anchors them to its start
+      - patterns starting `re:` are regexes searched for anywhere in the path
+
+      Globs are joined into a single regex.  Each `re:` pattern is compiled on
+      its own, so its inline flags and group numbers work as written.  Raises
+      re.error for an invalid regex.  """
+  if not patterns:
+    return None
+  regexes = []
+  alternatives = []
+  for p in patterns:
+    if p.startswith('re:'):
+      regexes.append(re.compile(p[3:]))
+    elif p.startswith('/'):
+      alternatives.append('(?:^{}\\Z)'.format(glob_to_regex(p)))
+    else:
+      alternatives.append('(?:(?:^|/){}\\Z)'.format(glob_to_regex(p)))
+  if alternatives:
+    regexes.insert(0, re.compile('|'.join(alternatives)))
+  return PathFilter(regexes)
 
 
 def is_audio_dir(path):
@@ -50,12 +263,93 @@ def is_audio_dir(path):
   return False
 
 
+def lookup_uid(user):
+  """ Return the numeric uid for `user`, a name or id.  None is returned
+      unchanged.  Raises KeyError for unknown users.  """
+  if user is None or isinstance(user, int):
+    return user
+  return int(user) if str(user).isdigit() else pwd.getpwnam(user).pw_uid
+
+
+def lookup_gid(group):
+  """ Return the numeric gid for `group`, a name or id.  None is returned
+      unchanged.  Raises KeyError for unknown groups.  """
+  if group is None or isinstance(group, int):
+    return group
+  return int(group) if str(group).isdigit() else grp.getgrnam(group).gr_gid
+
+
+def fix_permissions(path, mode=None, uid=None, gid=None, st=None):
+  """ Give `path` the permission bits `mode` and ownership `uid`/`gid`, each
+      of which may be None to leave it alone.  chmod()/chown() are only called
+      if the file doesn't already match; pass its lstat() result as `st` if you
+      have it.  Returns True if anything was changed.  """
+  if st is None:
+    st = os.lstat(str(path))
+  changed = False
+  if mode is not None and (st.st_mode & 0o7777) != mode:
+    os.chmod(str(path), mode)
+    changed = True
+  if (uid is not None and st.st_uid != uid) or \
+     (gid is not None and st.st_gid != gid):
+    os.chown(
+      str(path), -1 if uid is None else uid, -1 if gid is None else gid,
+      follow_symlinks=False
+    )
+    changed = True
+  return changed
+
+
+def dir_size(path):
+  """ Return the total size in bytes of the files within dir `path`, or of
+      `path` itself if it is a file.  Symlinks aren't followed.  """
+  st = os.lstat(str(path))
+  if not os.path.isdir(str(path)) or os.path.islink(str(path)):
+    return st.st_size
+  total = 0
+  for dirpath, dirnames, filenames in os.walk(str(path)):
+    for name in filenames:
+      try:
+        total += os.lstat(os.path.join(dirpath, name)).st_size
+      except FileNotFoundError:
+        pass
+  return total
+
+
+def move_file(source, dest):
+  """ Move file `source` to `dest`, which may be on another filesystem.  In
+      that case the data is copied under a temporary dotfile name first so a
+      half-written `dest` is never left behind.  """
+  try:
+    os.replace(str(source), str(dest))
+  except OSError as e:
+    if e.errno != errno.EXDEV:
+      raise
+    dest = Path(dest)
+    partial = dest.with_name('.' + dest.name + '.part')
+    shutil.copyfile(str(source), str(partial))
+    os.replace(str(partial), str(dest))
+    os.unlink(str(source))
+
+
 def expandvars(s=None):
   """ Return a copy of string `s` with ${ENV_VAR}s templated in.  If `s` was
       None return None, which is useful for handling config settings.  """
   return os.path.expandvars(s) if s is not None else None
 
 
+def user_cache_dir():
+  """ Return the Path of the dir Bulklift should keep its caches in """
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+  return Path(base) / 'bulklift'
+
+
+def user_config_dir():
+  """ Return the Path of the dir Bulklift keeps host-local config in """
+  base = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+  return Path(base) / 'bulklift'
+
+
 def first_existing_path(paths):
   """ Return first path in supplied `paths` that actually exists; use this for
       autodetecting binaries to use on a system """
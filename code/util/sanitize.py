@@ -1,6 +1,9 @@
 """ Utility functions to sanitize filenames """
 
+import functools
+import os.path
 import string
+import unicodedata
 from pathlib import Path
 
 
@@ -9,20 +12,157 @@ def dummy_sanitize(path, replace=''):
   return Path(path)
 
 
+# Characters with no decomposition that ascii_transliterate() should still keep
+TRANSLITERATIONS = str.maketrans({
+  'ß': 'ss', 'æ': 'ae', 'Æ': 'AE', 'œ': 'oe', 'Œ': 'OE', 'ø': 'o', 'Ø': 'O',
+  'đ': 'd', 'Đ': 'D', 'ð': 'd', 'Ð': 'D', 'þ': 'th', 'Þ': 'Th', 'ł': 'l',
+  'Ł': 'L', 'ı': 'i', '‘': "'", '’': "'", '“': '"', '”': '"', '–': '-',
+  '—': '-'
+})
+
+def ascii_transliterate(s):
+  """ Return a copy of `s` with accents stripped and other non-ascii characters
+      replaced by an ascii lookalike where one exists, or else removed """
+  s = unicodedata.normalize('NFKD', s.translate(TRANSLITERATIONS))
+  return s.encode('ascii', 'ignore').decode('ascii')
+
+
+class CharTable(dict):
+  """ A table for str.translate() which replaces characters not in `allowed`
+      (if given) or in `disallowed` with `replace`.  Control characters are
+      always replaced.  Entries are computed on first use and remembered, so
+      the table covers the whole of unicode without being built up front.  """
+
+  def __init__(self, replace='', allowed=None, disallowed=''):
+    """ Initialize an empty table """
+    super(CharTable, self).__init__()
+    self.replace = replace
+    self.allowed = None if allowed is None else frozenset(allowed)
+    self.disallowed = frozenset(disallowed)
+
+  def __missing__(self, code):
+    c = chr(code)
+    if code < 32 or c in self.disallowed or \
+        (self.allowed is not None and c not in self.allowed):
+      value = self.replace
+    else:
+      value = c
+    self[code] = value
+    return value
+
+
+class Sanitizer(object):
+  """ Sanitize paths for a particular kind of filesystem.  Each component of
+      the path is optionally transliterated to ascii, has disallowed characters
+      replaced by a precompiled translate table, loses any characters the
+      filesystem won't accept at the end of a name, has reserved names escaped,
+      becomes '_' if nothing is left of it and is finally truncated to fit `max_bytes` once encoded as `encoding`.
+      Extensions survive truncation.  Components are memoized since the same
+      album paths get sanitized over and over.  '/' is always permitted as a
+      dir separator.  """
+
+  def __init__(self, allowed=None, disallowed='', transliterate=False,
+               strip_trailing='', reserved=(), encoding='utf-8', max_bytes=255):
+    """ Initialize the sanitizer for a filesystem's rules """
+    super(Sanitizer, self).__init__()
+    self.allowed = allowed
+    self.disallowed = disallowed
+    self.transliterate = transliterate
+    self.strip_trailing = strip_trailing
+    self.reserved = frozenset(reserved)
+    self.encoding = encoding
+    self.max_bytes = max_bytes
+    self.tables = {}    # replacement string -> CharTable
+    self.sanitizeComponent = functools.lru_cache(maxsize=4096)(
+      self._sanitizeComponent
+    )
+
+  def __call__(self, path, replace=''):
+    """ Return a sanitized copy of `path`, substituting `replace` for any
+        disallowed characters """
+    path = Path(path)
+    if path.is_absolute():
+      return Path(path.root, *[
+        self.sanitizeComponent(p, replace) for p in path.parts[1:]
+      ])
+    else:
+      return Path(*[self.sanitizeComponent(p, replace) for p in path.parts])
+
+  def _sanitizeComponent(self, s, replace):
+    """ Sanitize a single path component `s` """
+    if self.transliterate:
+      s = ascii_transliterate(s)
+    try:
+      table = self.tables[replace]
+    except KeyError:
+      table = self.tables[replace] = CharTable(
+        replace, allowed=self.allowed, disallowed=self.disallowed
+      )
+    s = s.translate(table)
+    if self.strip_trailing:
+      s = s.rstrip(self.strip_trailing)
+    if not s:     # e.g. an album called '...'; don't lose a level of the path
+      s = '_'
+    if self.reserved and s.split('.')[0].upper() in self.reserved:
+      s = '_' + s
+    return self.truncate(s)
+
+  def truncate(self, s):
+    """ Return `s` shortened, if necessary, to fit within our byte limit.  A
+        short extension is kept intact.  """
+    if len(s.encode(self.encoding)) <= self.max_bytes:
+      return s
+    stem, ext = os.path.splitext(s)
+    ext_bytes = len(ext.encode(self.encoding))
+    if ext_bytes > self.max_bytes // 4:
+      stem, ext, ext_bytes = s, '', 0
+    stem = stem.encode(self.encoding)[:self.max_bytes - ext_bytes].decode(
+      self.encoding, 'ignore'
+    )
+    if self.strip_trailing:
+      stem = stem.rstrip(self.strip_trailing)
+    return stem + ext
+
+
 # INVALID_VFAT_CHARS = '?<>\\:*|"'
 VALID_VFAT_CHARS = string.ascii_letters + string.digits + '._+-()[]& '
 
-def vfat_sanitize(path, replace=''):
-  """ Return a version of `path` sanitized for fat32/vfat filesystems by
-      removing disallowed characters.  '/' is not valid in fat32 filenames but
-      we permit it as a dir specifier.   """
-  path = Path(path)
-  def sanitize(s):
-    return ''.join([c if c in VALID_VFAT_CHARS else replace for c in str(s)])
-  if path.is_absolute():
-    return Path(path.root, *map(sanitize, path.parts[1:]))
-  else:
-    return Path(*map(sanitize, path.parts))
+# Forbidden by Windows, and so by exfat, ntfs and most MTP devices
+INVALID_WINDOWS_CHARS = '"*/:<>?\\|'
+
+# Names Windows reserves for devices, regardless of extension
+RESERVED_WINDOWS_NAMES = ['CON', 'PRN', 'AUX', 'NUL'] \
+  + ['COM{}'.format(n) for n in range(1, 10)] \
+  + ['LPT{}'.format(n) for n in range(1, 10)]
+
+# Sanitize for fat32/vfat filesystems by removing disallowed characters.  '/'
+# is not valid in fat32 filenames but we permit it as a dir specifier.  Long
+# names are limited to 255 UTF-16 code units.
+vfat_sanitize = Sanitizer(
+  allowed=VALID_VFAT_CHARS, encoding='utf-16-le', max_bytes=510
+)
+
+exfat_sanitize = Sanitizer(
+  disallowed=INVALID_WINDOWS_CHARS, strip_trailing='. ',
+  encoding='utf-16-le', max_bytes=510
+)
+
+ntfs_sanitize = Sanitizer(
+  disallowed=INVALID_WINDOWS_CHARS, strip_trailing='. ',
+  reserved=RESERVED_WINDOWS_NAMES, encoding='utf-16-le', max_bytes=510
+)
+
+# Android devices store files on ext4/f2fs but are commonly browsed from
+# Windows, so stick to what it accepts
+mtp_sanitize = Sanitizer(
+  disallowed=INVALID_WINDOWS_CHARS, strip_trailing='. ',
+  reserved=RESERVED_WINDOWS_NAMES, encoding='utf-8', max_bytes=255
+)
+
+ascii_transliterate_sanitize = Sanitizer(
+  disallowed=INVALID_WINDOWS_CHARS, transliterate=True, strip_trailing='. ',
+  reserved=RESERVED_WINDOWS_NAMES, encoding='ascii', max_bytes=255
+)
 
 
 # Publish a map of sanitizers for easy access
@@ -30,5 +170,9 @@ FILENAME_SANITIZERS = {
   None: dummy_sanitize,
   False: dummy_sanitize,
   'none': dummy_sanitize,
-  'vfat': vfat_sanitize
+  'vfat': vfat_sanitize,
+  'exfat': exfat_sanitize,
+  'ntfs': ntfs_sanitize,
+  'mtp': mtp_sanitize,
+  'ascii-transliterate': ascii_transliterate_sanitize
 }
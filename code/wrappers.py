@@ -1,7 +1,8 @@
 import subprocess as sp
+import copy
 from itertools import chain
 from clint.textui import puts, indent
-from util.file import find_in_path
+from util.file import find_in_path, move_file
 
 
 class ExternalCommandError(Exception):
@@ -17,20 +18,27 @@ class ExternalCommandWrapper(object):
 
   DEFAULT_BINARY = find_in_path('true')
 
-  def __init__(self, binary=None, args=[], expected_outputs=[]):
-    """ Initialize the wrapper for arbitrary external commands """
+  def __init__(self, binary=None, args=[], expected_outputs=[], priority=None):
+    """ Initialize the wrapper for arbitrary external commands.  `priority` is
+        an optional ProcessPriority to run the command with.  """
     super(ExternalCommandWrapper, self).__init__()
 
     self.binary = binary or self.DEFAULT_BINARY
     self.args = [self.binary] + args
     self.expected_outputs = list(expected_outputs) # copy it!
+    self.priority = priority
+    self.timeout = None   # seconds before the command is killed, if any
 
   def run(self, output=False):
     """ Execute the wrapped command in a subprocess """
     if output:
       puts("cmd is {}".format(self.args))
       puts("expected_outputs is {}".format(self.expected_outputs))
-    cp = sp.run(self.args, check=True, stdout=sp.PIPE, stderr=sp.PIPE)
+    cp = sp.run(
+      self.args, check=True, stdout=sp.PIPE, stderr=sp.PIPE,
+      preexec_fn=self.priority.apply if self.priority else None,
+      timeout=self.timeout
+    )
     if not all([p.is_file() for p in self.expected_outputs]):
       raise ExternalCommandError("An expected output file was not created")
     if output:
@@ -72,10 +80,12 @@ class R128gainWrapper(ExternalCommandWrapper):
 
   def __init__(self, target_dir='.', album_gain=True, threads=None,
                ffmpeg_binary=None, verbosity='warning', dry_run=False,
-               binary=None):
+               binary=None, target_dirs=None, priority=None):
     """ Initialize the r128gain wrapper.  If we aren't doing album gain we skip
-        files with existing tags, beause they won't have changed.  """
-    super(R128gainWrapper, self).__init__(binary=binary)
+        files with existing tags, beause they won't have changed.  Pass a list
+        of `target_dirs` to process several at once; with album gain each is
+        treated as a separate album.  """
+    super(R128gainWrapper, self).__init__(binary=binary, priority=priority)
     self.args += chain.from_iterable([
       ['--opus-output-gain', '--recursive'],
       ['--verbosity', verbosity],
@@ -84,22 +94,59 @@ class R128gainWrapper(ExternalCommandWrapper):
       # no longer using --skip-tagged
       ['--album-gain'] if album_gain else [],
       ['--thread-count', str(threads)] if threads else [],
-      [str(target_dir)]
+      [str(d) for d in (target_dirs or [target_dir])]
     ])
 
 
+class LoudnessWrapper(ExternalCommandWrapper):
+  """ Wrap ffmpeg's ebur128 filter to measure the loudness of a file.  The
+      filter logs momentary loudness every 100ms, plus a summary including the
+      sample peak, to stderr.  """
+
+  DEFAULT_BINARY = find_in_path('ffmpeg')
+
+  def __init__(self, source_path, binary=None, priority=None):
+    """ Initialize the wrapper to measure the first audio stream of
+        `source_path` """
+    super(LoudnessWrapper, self).__init__(binary=binary, priority=priority)
+    self.source_path = source_path
+    self.args += [
+      '-hide_banner', '-nostats', '-i', str(source_path),
+      '-map', '0:a:0', '-filter:a', 'ebur128=framelog=info:peak=sample',
+      '-f', 'null', '-'
+    ]
+
+  def measure(self):
+    """ Run ffmpeg and return the text it logged """
+    cp = self.run()
+    return cp.stderr.decode('utf8', 'replace')
+
+
 class FFmpegWrapper(ExternalCommandWrapper):
   """ Wrap ffmpeg, with methods to add multiple output files """
 
   DEFAULT_BINARY = find_in_path('ffmpeg')
 
-  def __init__(self, source_path, metadata={}, loglevel='error', binary=None):
-    """ Initialize the ffmpeg wrapper """
-    super(FFmpegWrapper, self).__init__(binary=binary)
+  def __init__(self, source_path, metadata={}, loglevel='error', binary=None,
+               duration=None, priority=None, threads=None):
+    """ Initialize the ffmpeg wrapper.  `duration` is the length of the
+        source in seconds, if known.  `threads` limits the threads ffmpeg may
+        use to decode and to encode each output; None lets it choose.  """
+    super(FFmpegWrapper, self).__init__(binary=binary, priority=priority)
     self.source_path = source_path
-    self.args += ['-y', '-loglevel', loglevel, '-i', str(source_path)]
+    self.duration = duration
+    self.threads = threads
+    self.args += ['-y', '-loglevel', loglevel]
+    if threads:
+      self.args += ['-threads', str(threads)]
+    self.args += ['-i', str(source_path)]
+    self.args_input = list(self.args)
     self.args_metadata = self.metadataOpts(metadata)
     self.output_codecs = []
+    self.output_args = []   # args for each output, used by split()
+    self.destinations = {}  # staged output path -> final path
+    self.callbacks = {}     # output path -> [functions to call when complete]
+    self.abandon_callbacks = {}   # output path -> [functions to call if not run]
 
   def run(self, *args, **kwargs):
     """ run() method overridden to create destination dirs and raise an error
@@ -108,6 +155,81 @@ class FFmpegWrapper(ExternalCommandWrapper):
       raise NothingToDoError("No outputs to transcode")
     super(FFmpegWrapper, self).run(*args, **kwargs)
 
+  def split(self):
+    """ Return a list of FFmpegWrappers that each write one of our outputs.
+        Every one of them decodes the source again, so only do this when there
+        are idle cores to soak up.  """
+    if len(self) < 2:
+      return [self]
+    jobs = []
+    for output_path, codec, args in zip(self.expected_outputs,
+                                        self.output_codecs, self.output_args):
+      job = copy.copy(self)
+      job.args = self.args_input + args
+      job.expected_outputs = [output_path]
+      job.output_codecs = [codec]
+      job.output_args = [args]
+      job.destinations = {
+        p: d for p, d in self.destinations.items() if p == output_path
+      }
+      job.callbacks = {
+        p: c for p, c in self.callbacks.items() if p == output_path
+      }
+      job.abandon_callbacks = {
+        p: c for p, c in self.abandon_callbacks.items() if p == output_path
+      }
+      jobs.append(job)
+    return jobs
+
+  def retarget(self, input_path):
+    """ Read the source from `input_path`, e.g. a prefetched local copy of
+        it, instead of `source_path` """
+    i = self.args_input.index('-i') + 1
+    self.args_input = self.args_input[:i] + [str(input_path)] \
+                      + self.args_input[i+1:]
+    self.args = self.args_input + list(chain.from_iterable(self.output_args))
+
+  def stage(self, output_path, destination):
+    """ Mark `output_path` as being written to a staging dir, from which
+        unstage() will move it to `destination` """
+    self.destinations[output_path] = destination
+
+  def unstage(self):
+    """ Move any staged outputs to their final destinations """
+    for output_path, destination in self.destinations.items():
+      move_file(output_path, destination)
+
+  def onComplete(self, output_path, func):
+    """ Arrange for `func` to be called, with no args, by complete() """
+    self.callbacks.setdefault(output_path, []).append(func)
+
+  def complete(self):
+    """ Call the functions registered for our outputs with onComplete().  Do
+        this once the job has run and any staged outputs are in place.  """
+    for output_path in self.expected_outputs:
+      for func in self.callbacks.get(output_path, []):
+        func()
+
+  def onAbandon(self, output_path, func):
+    """ Arrange for `func` to be called, with no args, by abandon() """
+    self.abandon_callbacks.setdefault(output_path, []).append(func)
+
+  def abandon(self):
+    """ Call the functions registered for our outputs with onAbandon().  Do
+        this if the job will not be run, e.g. because a run is out of time.  """
+    for output_path in self.expected_outputs:
+      for func in self.abandon_callbacks.get(output_path, []):
+        func()
+
+  def _appendOutput(self, output_path, codec, args):
+    """ Add a single output, with its `args`, to the ffmpeg command """
+    if self.threads:
+      args = ['-threads', str(self.threads)] + args
+    self.args += args
+    self.expected_outputs.append(output_path)
+    self.output_codecs.append(codec)
+    self.output_args.append(args)
+
   @staticmethod
   def metadataOpts(metadata={}):
     """ Translate a dict of metadata into ffmpeg -metadata foo=bar options """
@@ -120,40 +242,36 @@ class FFmpegWrapper(ExternalCommandWrapper):
 
   def appendOutputCopy(self, output_path):
     """ Add arguments to write a file with same codec as input """
-    self.args += ['-map', '0:a']
-    self.args += ['-codec:a', 'copy']
-    self.args += self.args_metadata
-    self.args += [str(output_path)]
-    self.expected_outputs.append(output_path)
-    self.output_codecs.append('copy')
+    args = ['-map', '0:a']
+    args += ['-codec:a', 'copy']
+    args += self.args_metadata
+    args += [str(output_path)]
+    self._appendOutput(output_path, 'copy', args)
 
   def appendOutputLame(self, output_path, vbr=3):
     """ Add arguments to write an mp3 file """
-    self.args += ['-map', '0:a']
-    self.args += ['-codec:a', 'libmp3lame', '-q:a', str(vbr)]
-    self.args += self.args_metadata
-    self.args += ['-id3v2_version', '3', '-write_id3v1', '1', '-write_xing', '1']
-    self.args += [str(output_path)]
-    self.expected_outputs.append(output_path)
-    self.output_codecs.append('mp3')
+    args = ['-map', '0:a']
+    args += ['-codec:a', 'libmp3lame', '-q:a', str(vbr)]
+    args += self.args_metadata
+    args += ['-id3v2_version', '3', '-write_id3v1', '1', '-write_xing', '1']
+    args += [str(output_path)]
+    self._appendOutput(output_path, 'mp3', args)
 
   def appendOutputOpus(self, output_path, bitrate='128k'):
     """ Add arguments to write an opus file """
-    self.args += ['-map', '0:a']
-    self.args += ['-codec:a', 'libopus']
-    self.args += ['-compression_level', '10', '-vbr', 'on', '-b:a', str(bitrate)]
-    self.args += self.args_metadata
-    self.args += [str(output_path)]
-    self.expected_outputs.append(output_path)
-    self.output_codecs.append('opus')
+    args = ['-map', '0:a']
+    args += ['-codec:a', 'libopus']
+    args += ['-compression_level', '10', '-vbr', 'on', '-b:a', str(bitrate)]
+    args += self.args_metadata
+    args += [str(output_path)]
+    self._appendOutput(output_path, 'opus', args)
 
   def appendOutputM4a(self, output_path, vbr=3):
     """ Add arguments to write an opus file """
-    self.args += ['-map', '0:a']
-    self.args += ['-codec:a', 'libfdk_aac']
-    self.args += ['-vbr', str(vbr)]
-    self.args += self.args_metadata
-    self.args += [str(output_path)]
-    self.expected_outputs.append(output_path)
-    self.output_codecs.append('m4a')
+    args = ['-map', '0:a']
+    args += ['-codec:a', 'libfdk_aac']
+    args += ['-vbr', str(vbr)]
+    args += self.args_metadata
+    args += [str(output_path)]
+    self._appendOutput(output_path, 'm4a', args)
 